@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import List
+
+from contractupdater import runAccounts
+from metrics import metrics
+from replayserver import ReplayEnvironment, PATH_FIXTURES_MAILS
+
+""" End-to-End Benchmark gegen replayserver.py: Kompletter Lauf (Vertragsverlaengerungs-Mail finden, Login mit PIN,
+Verlaengerung mit PIN) fuer einen und fuer N gleichzeitige Accounts, ohne euserv.com und ohne echtes Postfach.
+Gemessen werden Laufzeit, HTTP-Requests und IMAP-Befehle (client- und serverseitig). """
+
+COUNTERS = ('euserv_http_requests_total', 'euserv_http_bytes_total', 'euserv_http_retries_total', 'euserv_imap_commands_total',
+            'euserv_imap_bytes_total')
+
+
+def runScenario(numberofAccounts: int, workers: int, contractsPerAccount: int, httpLatency: float, imapLatency: float, mailDelay: float,
+                sharedMailbox: bool, singlePendingPIN: bool, seedPath: str, httpErrorRate: float = 0, unroutablePINs: bool = False) -> dict:
+    environment = ReplayEnvironment(httpLatency=httpLatency, imapLatency=imapLatency, mailDelay=mailDelay, seedPath=seedPath,
+                                    singlePendingPIN=singlePendingPIN, httpErrorRate=httpErrorRate, unroutablePINs=unroutablePINs)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configpaths = []
+            for number in range(1, numberofAccounts + 1):
+                configpath = os.path.join(workdir, f'account{number}.json')
+                with open(configpath, 'w', encoding='utf-8') as outfile:
+                    json.dump(environment.addAccount(number, sharedMailbox=sharedMailbox, contractsPerAccount=contractsPerAccount), outfile)
+                configpaths.append(configpath)
+            countersBefore = {name: metrics.getCounter(name) for name in COUNTERS}
+            imapCommandsBefore = environment.imapServer.commandCount
+            timeStarted = time.perf_counter()
+            exitcode = runAccounts(configpaths=configpaths, statepath=os.path.join(workdir, 'state.sqlite'), testLogins=False, maxWorkers=workers)
+            secondsNeeded = time.perf_counter() - timeStarted
+        result = dict(accounts=numberofAccounts, workers=workers, contracts=numberofAccounts * contractsPerAccount, exitcode=exitcode,
+                      seconds=round(secondsNeeded, 3), extended=len(environment.httpServer.extensions),
+                      server_http_requests=environment.httpServer.requestCount, server_http_errors=environment.httpServer.errorCount,
+                      server_imap_commands=environment.imapServer.commandCount - imapCommandsBefore)
+        for name in COUNTERS:
+            result[name] = metrics.getCounter(name) - countersBefore[name]
+        return result
+    finally:
+        environment.close()
+
+
+def printResults(results: List[dict]):
+    columns = ['accounts', 'contracts', 'extended', 'exitcode', 'seconds', 'server_http_requests', 'server_http_errors', 'server_imap_commands'] + \
+        list(COUNTERS)
+    print(' | '.join(columns))
+    for result in results:
+        print(' | '.join(str(result[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('-n', '--accounts', help='Anzahl gleichzeitiger Accounts, je Wert ein Szenario.', type=int, nargs='+', default=[1, 10])
+    my_parser.add_argument('-w', '--workers', help='Max. Anzahl gleichzeitig bearbeiteter Accounts (Standard: alle).', type=int, default=None)
+    my_parser.add_argument('--contracts', help='Vertraege pro Account.', type=int, default=1)
+    my_parser.add_argument('--http-latency', help='Verzoegerung pro HTTP-Request in Sekunden.', type=float, default=0.05)
+    my_parser.add_argument('--imap-latency', help='Verzoegerung pro IMAP-Befehl in Sekunden.', type=float, default=0.02)
+    my_parser.add_argument('--mail-delay', help='Sekunden bis eine angeforderte PIN-Mail im Postfach liegt.', type=float, default=0.5)
+    my_parser.add_argument('--seed', help='Ordner mit .eml Dateien, die zusaetzlich in jedem Postfach liegen.', default=PATH_FIXTURES_MAILS)
+    my_parser.add_argument('--shared-mailbox', help='Alle Accounts teilen sich ein Postfach.', action='store_true')
+    my_parser.add_argument('--single-pending-pin', help='Neue PIN-Anfrage verwirft alle vorherigen PINs.', action='store_true')
+    my_parser.add_argument('--http-error-rate', help='Anteil der HTTP-Requests, die mit 429 abgewiesen werden.', type=float, default=0)
+    my_parser.add_argument('--unroutable-pins', help='PIN-Mails ohne Kundennummer bzw. Vertrags-ID.', action='store_true')
+    my_parser.add_argument('--json', help='Ergebnisse zusaetzlich als JSON in diese Datei schreiben.', default=None)
+    args = my_parser.parse_args()
+
+    results = []
+    for numberofAccounts in args.accounts:
+        results.append(runScenario(numberofAccounts=numberofAccounts, workers=args.workers or numberofAccounts, contractsPerAccount=args.contracts,
+                                   httpLatency=args.http_latency, imapLatency=args.imap_latency, mailDelay=args.mail_delay,
+                                   sharedMailbox=args.shared_mailbox, singlePendingPIN=args.single_pending_pin, seedPath=args.seed,
+                                   httpErrorRate=args.http_error_rate, unroutablePINs=args.unroutable_pins))
+    printResults(results)
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as outfile:
+            json.dump(results, outfile, indent=2)
@@ -0,0 +1,821 @@
+import functools
+from datetime import datetime, timezone, timedelta
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Optional, List, Dict, Set, Tuple, Iterable, Sequence
+
+import pydantic
+from imap_tools import AND, U
+
+from euservclient import EuservClient, getMainpageURL, EUSERV_BASE
+from euservparser import isLoggedInEuserv, isPINRequired, isCaptchaRequired, isExtensionConfirmed, findCustomerID, findExtendedUntil, \
+    findContractExtensionURLs, findContractExtensionURL, formatPageForLog
+from mailparser import parseMail, ParsedMail, MAIL_SEARCH_SUBJECTS, MAIL_TYPE_LOGIN_PIN, MAIL_TYPE_CONTRACT_EXTEND_PIN, MAIL_TYPE_CONTRACT_NOTICE
+from mailservice import MailService, getMailService, releaseMailService
+from metrics import metrics, timedMethod
+from precheck import PATH_CONFIG, MIN_DAYS_UNTIL_NEXT_ATTEMPT, getNextAttemptDate, getLoginBlockedUntil, getNoticeKey, \
+    NOTICE_HANDLED_OUTCOMES
+from statestore import StateStore, PATH_STATE, HISTORY_RETENTION_DAYS, CONTRACT_OUTCOME_EXTENDED, CONTRACT_OUTCOME_FAILED, \
+    CONTRACT_OUTCOME_NOT_ON_ACCOUNT
+
+PATH_COOKIES = os.path.join('cookies.txt')
+MAIL_NOTICE_MAX_AGE_HOURS = 48
+# Accounts im selben Postfach verwenden so lange das Ergebnis einer Suche nach Vertragsverlaengerungs-Mails (siehe MailService.callShared)
+MAIL_NOTICE_SCAN_SHARE_SECONDS = 60
+# Daemon: Abstand der regulaeren Pruefungen, Wartezeit nach Fehlern (verdoppelt sich pro Fehler) und zufaellige Abweichung
+DAEMON_CHECK_INTERVAL_SECONDS = 6 * 60 * 60
+DAEMON_RETRY_DELAY_SECONDS = 5 * 60
+DAEMON_JITTER = 0.1
+# Ist das Vertragsende weiter als DAEMON_DEADLINE_LEAD_DAYS entfernt, wird nur in diesem Abstand geprueft (neue Mails kommen per IDLE)
+DAEMON_IDLE_CHECK_INTERVAL_SECONDS = 24 * 60 * 60
+DAEMON_DEADLINE_LEAD_DAYS = 7
+# So lange nach der letzten erfolgreichen Pruefung gilt eine Session ohne erneute Pruefung als gueltig
+SESSION_VALIDATION_TTL_SECONDS = 15 * 60
+
+
+def parseContractEndDate(value: Optional[str]) -> Optional[datetime]:
+    """ Vertragsende wie von EUserv angezeigt (z.B. '16.11.2026'), None wenn unbekannt. """
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%d.%m.%Y').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+class ContractNotice(pydantic.BaseModel):
+    uid: int
+    contract_id: str
+    date: datetime
+    message_id: Optional[str] = None
+
+    def getKey(self) -> str:
+        return getNoticeKey(self.message_id, self.uid)
+
+
+class MailScanState(pydantic.BaseModel):
+    """ Stand der inkrementellen Suche nach Vertragsverlaengerungs-Mails in einem IMAP-Ordner. """
+    uidvalidity: int
+    last_uid: int
+    notices: List[ContractNotice] = []
+
+
+class SessionCache(pydantic.BaseModel):
+    """ Zuletzt erfolgreich verwendete EUserv Session. Die Cookies dazu liegen in der Cookie-Datei des Accounts. """
+    sess_id: str
+    phpsessid: str
+    customer_id: Optional[str]
+    created: datetime
+    last_validated: datetime
+
+
+class ContractExtensionResult(pydantic.BaseModel):
+    contract_id: str
+    success: bool
+    # Vertrag gehoert nicht zu diesem Account (kein Verlaengerungs-Link), zaehlt nicht als Fehler
+    skipped: bool = False
+    extended_until: Optional[str] = None
+    error: Optional[str] = None
+    pin_uid: Optional[int] = None
+    seconds: Optional[float] = None
+
+    def getReport(self) -> str:
+        if self.success:
+            return f'Vertrag {self.contract_id} verlaengert bis {self.extended_until}'
+        if self.skipped:
+            return f'Vertrag {self.contract_id} übersprungen: Gehoert zu einem anderen Account im selben Postfach'
+        return f'Vertrag {self.contract_id} fehlgeschlagen: {self.error}'
+
+
+class Config(pydantic.BaseModel):
+    """ Zugangsdaten eines Accounts, wird nur gelesen. Der Laufzeit-Status steht in AccountState. """
+    imap_server: str
+    imap_login: str
+    imap_password: str
+    imap_port: int = 993
+    # False nur fuer lokale Testserver (replayserver.py)
+    imap_ssl: bool = True
+    euserv_mail_or_user_id: str
+    euserv_password: str
+    euserv_base_url: str = EUSERV_BASE
+
+
+class AccountState(pydantic.BaseModel):
+    """ Laufzeit-Status eines Accounts, jedes Feld ist ein eigener Eintrag im StateStore. """
+    last_date_extended_contract: Optional[datetime] = None
+    last_contract_extended_until: Optional[str] = None
+    last_date_login_attempt_failed: Optional[datetime] = None
+    last_date_login_attempt_failed_captcha: Optional[datetime] = None
+    # Fehlgeschlagene Logins seit dem letzten erfolgreichen Login (verlaengert die Login-Sperre, siehe getLoginBlockedUntil)
+    login_failures: int = 0
+    last_contract_id: Optional[str] = None
+    session: Optional[SessionCache] = None
+    mail_scan_state: Dict[str, MailScanState] = {}
+    # Vertrags-ID -> Zeitpunkt der letzten Verlaengerung, damit jede Vertragsverlaengerungs-Mail nur einmal bearbeitet wird
+    extended_contracts: Dict[str, datetime] = {}
+
+
+def getConfig(configpath: str = PATH_CONFIG) -> Config:
+    print(f'Loading config from {configpath}')
+    with open(configpath, encoding='utf-8') as infile:
+        jsondict = json.load(infile)
+        return Config(**jsondict)
+
+
+def getCookiesPath(configpath: str) -> str:
+    """ Jeder Account bekommt seine eigene Cookie-Datei, die Standard-Config behaelt 'cookies.txt'. """
+    if os.path.abspath(configpath) == os.path.abspath(PATH_CONFIG):
+        return PATH_COOKIES
+    return os.path.splitext(configpath)[0] + '_cookies.txt'
+
+
+class ContractUpdater:
+
+    def __init__(self, configpath: str = PATH_CONFIG, statepath: str = PATH_STATE, mailboxAccounts: Sequence[str] = ()):
+        self.configpath = configpath
+        try:
+            self.config = getConfig(configpath)
+        except Exception as e:
+            print(e)
+            print(f'Kaputte config {configpath}: Ein- oder mehrere Eintraege fehlen!')
+            raise e
+        self.account = self.config.euserv_mail_or_user_id
+        self.statestore = StateStore(statepath)
+        self.state = self.loadState()
+        # Andere konfigurierte Accounts, deren Mails im selben Postfach landen (siehe getMailboxAccounts)
+        self.mailboxAccounts = list(mailboxAccounts)
+        # HTTP-Session und IMAP-Verbindung werden erst bei Bedarf erzeugt, ein Lauf ohne Aktion braucht keine von beiden
+        self._client: Optional[EuservClient] = None
+        self._mailservice: Optional[MailService] = None
+        self.closed = False
+        # Startseite aus der Pruefung der Session, wird von extendContract wiederverwendet statt erneut geladen
+        self.mainpageHTML: Optional[str] = None
+        # Vertrags-ID -> Schluessel der zugehoerigen Vertragsverlaengerungs-Mails aus getPendingContractIDs
+        self.pendingNoticeKeys: Dict[str, List[str]] = {}
+        # Frühester neuer Versuch für Verträge aus getPendingContractIDs, die erst vor kurzem verlängert wurden
+        self.blockedUntil: Optional[datetime] = None
+
+    @property
+    def client(self) -> EuservClient:
+        if self._client is None:
+            self._client = EuservClient(getCookiesPath(self.configpath), baseURL=self.config.euserv_base_url, account=self.account)
+        return self._client
+
+    @property
+    def mailservice(self) -> Optional[MailService]:
+        if self._mailservice is None and not self.closed:
+            self._mailservice = getMailService(server=self.config.imap_server, login=self.config.imap_login, password=self.config.imap_password,
+                                               port=self.config.imap_port, ssl=self.config.imap_ssl)
+        return self._mailservice
+
+    def loadState(self) -> AccountState:
+        values = self.statestore.getAll(self.account)
+        if len(values) > 0:
+            return AccountState.parse_obj(values)
+        # Uebernimmt den Status aus alten config.json Dateien, in denen er frueher mitgespeichert wurde
+        state = AccountState.parse_obj(loadJson(self.configpath))
+        self.statestore.setMany(self.account, json.loads(state.json()))
+        return state
+
+    def saveState(self, *keys: str):
+        """ Schreibt nur die angegebenen Felder des Status (eine kleine Transaktion statt die ganze Datei neu zu schreiben). """
+        values = json.loads(self.state.json(include=set(keys)))
+        self.statestore.setMany(self.account, values)
+
+    def mergeState(self, key: str, entries: Dict[str, object], removed: Iterable[str] = ()):
+        """ Wie saveState fuer ein dict-Feld, schreibt aber nur die geaenderten bzw. entfernten Eintraege (siehe StateStore.mergeMany) und
+        uebernimmt dabei Eintraege, die ein anderer Prozess (z.B. Cronjob neben dem Daemon) inzwischen gespeichert hat. """
+        values = json.loads(self.state.copy(update={key: entries}).json(include={key}))
+        merged = self.statestore.mergeMany(self.account, values, {key: list(removed)})
+        setattr(self.state, key, getattr(AccountState.parse_obj({key: merged[key]}), key))
+
+    def ensureMailLogin(self):
+        self.mailservice.ensureLogin()
+
+    def close(self):
+        """ Gibt die (evtl. mit anderen Accounts geteilte) IMAP-Verbindung und die HTTP-Verbindung frei. """
+        self.closed = True
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._mailservice is not None:
+            releaseMailService(self._mailservice)
+            self._mailservice = None
+        self.statestore.close()
+
+    def isSessionRecentlyValidated(self) -> bool:
+        session = self.state.session
+        if session is None or not self.client.hasCookies():
+            return False
+        return (datetime.now(tz=timezone.utc) - session.last_validated).total_seconds() < SESSION_VALIDATION_TTL_SECONDS
+
+    def invalidateSession(self):
+        self.state.session = None
+        self.mainpageHTML = None
+        self.saveState('session')
+
+    def getLoginBlockedUntil(self) -> Optional[datetime]:
+        """ Circuit Breaker: Nach Captcha bzw. fehlgeschlagenen Logins wird eine Zeit lang kein vollstaendiger Login versucht. """
+        return getLoginBlockedUntil(self.state.last_date_login_attempt_failed, self.state.last_date_login_attempt_failed_captcha,
+                                    self.state.login_failures)
+
+    @timedMethod('login')
+    def loginEuserv(self):
+        session = self.state.session
+        if self.isSessionRecentlyValidated():
+            print(f'Verwende zuletzt vor weniger als {SESSION_VALIDATION_TTL_SECONDS} Sekunden geprüfte Session {session.sess_id}')
+            return
+        if self.client.hasCookies() and session is not None:
+            # Try to login via stored cookies first. Die Startseite wird fuer die Verlaengerung ohnehin benoetigt -> Kein Extra-Request
+            print(f'Versuche Login ueber zuvor gespeicherte Cookies mit sess_id={session.sess_id} ...')
+            html = self.client.openMainpage(session.sess_id)
+            if isLoggedInEuserv(html):
+                print("Cookie login erfolgreich")
+                session.last_validated = datetime.now(tz=timezone.utc)
+                self.mainpageHTML = html
+                self.client.saveCookies()
+                self.saveState('session')
+                return
+            print("Cookie login fehlgeschlagen")
+            self.invalidateSession()
+        loginBlockedUntil = self.getLoginBlockedUntil()
+        if loginBlockedUntil is not None:
+            raise Exception(f"Login pausiert bis {loginBlockedUntil} nach fehlgeschlagenem Login/Captcha -> Kein neuer Versuch")
+        print("Versuche vollständigen Login")
+        self.client.clearCookies()
+        # Ohne Kundennummer in der Login-PIN-Mail loggen sich Accounts im selben Postfach nacheinander ein
+        with self.mailservice.exclusivePIN(MAIL_TYPE_LOGIN_PIN):
+            sess_id = self.client.openSession()
+            print("Aktive Session: " + sess_id)
+            html = self.client.submitCredentials(sess_id, self.config.euserv_mail_or_user_id, self.config.euserv_password)
+            customer_id = None
+            if isPINRequired(html):
+                print('PIN benoetigt')
+                customer_id = findCustomerID(html)
+                if customer_id is None:
+                    raise Exception("Konnte c_id nicht finden")
+                pin = self.mailFindLoginPIN(customerID=customer_id)
+                html = self.client.submitPIN(sess_id, customer_id, pin)
+            else:
+                print('Keine PIN benoetigt')
+        if not isLoggedInEuserv(html):
+            self.state.login_failures += 1
+            if isCaptchaRequired(html):
+                print("Euserv Login fehlgeschlagen - Login-Captcha benötigt!")
+                # EUserv drosselt Logins -> Auch die Logins aller anderen Accounts dieses Prozesses verlangsamen
+                self.client.throttleLogins()
+                self.state.last_date_login_attempt_failed_captcha = datetime.now(tz=timezone.utc)
+                self.saveState('last_date_login_attempt_failed_captcha', 'login_failures')
+                self.statestore.addHistory(self.account, 'login_failed_captcha')
+            else:
+                print('Euserv Login fehlgeschlagen - Ungueltige Zugangsdaten?')
+                self.state.last_date_login_attempt_failed = datetime.now(tz=timezone.utc)
+                self.saveState('last_date_login_attempt_failed', 'login_failures')
+                self.statestore.addHistory(self.account, 'login_failed')
+            print('html: ' + formatPageForLog(html))
+            raise Exception("Login fehlgeschlagen")
+        phpsessid = self.client.getCookie('PHPSESSID')
+        if phpsessid is None:
+            # This should never happen!
+            raise Exception("Ungueltiger Loginstatus")
+        print('Euserv Login erfolgreich')
+        now = datetime.now(tz=timezone.utc)
+        self.state.session = SessionCache(sess_id=sess_id, phpsessid=phpsessid, customer_id=customer_id, created=now, last_validated=now)
+        self.state.last_date_login_attempt_failed = None
+        self.state.last_date_login_attempt_failed_captcha = None
+        self.state.login_failures = 0
+        # Store cookies in file so we can try to re-use them next time
+        self.client.saveCookies()
+        self.saveState('session', 'last_date_login_attempt_failed', 'last_date_login_attempt_failed_captcha', 'login_failures')
+        self.statestore.addHistory(self.account, 'login', {'sess_id': sess_id, 'customer_id': customer_id})
+
+    def mailScanContractNotices(self, mailbox, notBefore: datetime) -> Tuple[str, MailScanState]:
+        """ Liefert (Ordner, neuer Stand) mit allen Vertragsverlaengerungs-Mails seit notBefore. Bereits bekannte Mails kommen aus dem
+        gespeicherten Stand (UIDVALIDITY + hoechste gesehene UID pro Ordner), vom Server werden nur neue UIDs geholt. Der gespeicherte
+        Stand wird nicht veraendert: Bricht die Verbindung mittendrin ab, wiederholt MailService.runJobs den ganzen Scan. """
+        folder = mailbox.folder.get()
+        status = mailbox.folder.status(folder, options=['UIDVALIDITY'])
+        scanState = self.state.mail_scan_state.get(folder)
+        subject = MAIL_SEARCH_SUBJECTS[MAIL_TYPE_CONTRACT_NOTICE]
+        if scanState is None or scanState.uidvalidity != status['UIDVALIDITY']:
+            # Erster Durchlauf oder Ordner wurde neu aufgebaut -> Alte UIDs sind wertlos
+            scanState = MailScanState(uidvalidity=status['UIDVALIDITY'], last_uid=0)
+            criteria = AND(subject=subject, date_gte=notBefore.date())
+        else:
+            scanState = scanState.copy(deep=True)
+            criteria = AND(subject=subject, uid=U(str(scanState.last_uid + 1), '*'))
+        knownUIDs = {notice.uid for notice in scanState.notices}
+        highestUID = scanState.last_uid
+        # Solange wie die ID des Vertrags im Betreff steht, können wir uns das Laden vom Inhalt der Mail sparen :)
+        # Die hoechste UID kommt nur von tatsaechlich gelieferten Mails, nicht aus UIDNEXT: Der Status kann Mails enthalten, die die
+        # Suche in dieser Sitzung noch nicht sieht, die waeren sonst fuer immer uebersprungen
+        for msg in mailbox.fetch(mark_seen=False, criteria=criteria, headers_only=True):
+            uid = int(msg.uid)
+            if uid <= scanState.last_uid:
+                # 'n:*' liefert immer mindestens die letzte Mail, auch wenn deren UID kleiner n ist
+                continue
+            highestUID = max(highestUID, uid)
+            if uid in knownUIDs:
+                continue
+            mail = parseMail(msg)
+            if mail is None or mail.mailType != MAIL_TYPE_CONTRACT_NOTICE or mail.contractID is None:
+                print(f"Warnung: Konnte Vertrags-ID nicht finden in Email {uid}: {msg.subject}")
+                continue
+            scanState.notices.append(ContractNotice(uid=uid, contract_id=mail.contractID, date=mail.date, message_id=mail.messageID))
+            knownUIDs.add(uid)
+        scanState.last_uid = highestUID
+        scanState.notices = [notice for notice in scanState.notices if notice.date >= notBefore]
+        return folder, scanState
+
+    @timedMethod('mail_find_contract_id')
+    def mailFindContractNotices(self) -> List[ContractNotice]:
+        """ Sucht nach "Vertragsverlängerungs Emails" der letzten MAIL_NOTICE_MAX_AGE_HOURS Stunden (evtl. leer). """
+        print('Sammle Vertragsverlaengerungs-E-Mails ...')
+        notBefore = datetime.now(tz=timezone.utc) - timedelta(hours=MAIL_NOTICE_MAX_AGE_HOURS)
+        # Die Mails sind fuer alle Accounts im Postfach dieselben -> Gleichzeitige Suchen mehrerer Accounts laufen nur einmal
+        folder, scanState = self.mailservice.callShared(MAIL_TYPE_CONTRACT_NOTICE, lambda mailbox: self.mailScanContractNotices(mailbox, notBefore),
+                                                        MAIL_NOTICE_SCAN_SHARE_SECONDS)
+        # Stand direkt sichern, damit auch ein Lauf ohne Ergebnis den naechsten Scan verkuerzt. Nur dieser Ordner, Staende anderer
+        # Ordner bleiben wie gespeichert
+        self.mergeState('mail_scan_state', {folder: scanState})
+        return list(self.state.mail_scan_state[folder].notices)
+
+    def isContractNoticeHandled(self, contractID: str, noticeDate: datetime, noticeKey: Optional[str] = None) -> bool:
+        """ True, wenn der Vertrag zu dieser Vertragsverlaengerungs-Mail bereits verlaengert wurde oder nicht zu diesem Account gehoert. Zuerst per Index im Verlauf,
+        Verlaengerungen aus aelteren Versionen (ohne Verlauf pro Mail) ueber das Datum der letzten Verlaengerung des Vertrags. """
+        if noticeKey is not None and self.statestore.getNoticeOutcome(self.account, noticeKey) in NOTICE_HANDLED_OUTCOMES:
+            return True
+        extended = self.state.extended_contracts.get(contractID)
+        return extended is not None and extended >= noticeDate
+
+    def findContractOwner(self, contractID: str) -> Optional[str]:
+        """ Anderer Account im selben Postfach, der diesen Vertrag bereits verlaengert hat, sonst None. """
+        for account in self.mailboxAccounts:
+            if self.statestore.hasExtendedContract(account, contractID):
+                return account
+        return None
+
+    def getPendingContractIDs(self, notices: Optional[List[ContractNotice]] = None) -> List[str]:
+        """ IDs aller Vertraege mit Vertragsverlaengerungs-Mail (siehe mailFindContractNotices) ohne die, deren Mail bereits bearbeitet
+        wurde oder die erst vor kurzem verlaengert wurden (siehe getNextAttemptDate). Letztere stehen mit dem fruehesten neuen Versuch in
+        blockedUntil. """
+        if notices is None:
+            notices = self.mailFindContractNotices()
+        self.pendingNoticeKeys = {}
+        self.blockedUntil = None
+        for notice in notices:
+            noticeKey = notice.getKey()
+            nextAttempt = self.getNextAttemptDate(notice.contract_id)
+            if self.isContractNoticeHandled(notice.contract_id, notice.date, noticeKey):
+                print(f"Vertrag {notice.contract_id}: Vertragsverlaengerungs-Mail {noticeKey} wurde bereits bearbeitet -> Überspringe")
+            elif nextAttempt is not None:
+                print(f"Vertrag {notice.contract_id}: Zuletzt verlängert vor weniger als {MIN_DAYS_UNTIL_NEXT_ATTEMPT} Tagen -> Überspringe bis {nextAttempt}")
+                self.blockedUntil = nextAttempt if self.blockedUntil is None else min(self.blockedUntil, nextAttempt)
+            else:
+                self.pendingNoticeKeys.setdefault(notice.contract_id, []).append(noticeKey)
+        return list(self.pendingNoticeKeys)
+
+    @timedMethod('mail_wait_login_pin')
+    def mailFindLoginPIN(self, customerID: Optional[str] = None) -> str:
+        return self.mailservice.waitForPIN(mailType=MAIL_TYPE_LOGIN_PIN, pinDescription='Login-PIN', key=customerID)
+
+    @timedMethod('mail_wait_contract_extend_pin')
+    def mailFindContractExtendPIN(self, contractID: Optional[str] = None) -> ParsedMail:
+        """ PIN-Mails, deren PIN laut Verlauf bereits verwendet wurde, werden uebergangen. """
+        return self.mailservice.waitForPINMail(mailType=MAIL_TYPE_CONTRACT_EXTEND_PIN, pinDescription='Vertragsverlängerungs-PIN', key=contractID,
+                                               isUsed=lambda uid: self.statestore.isPINMailUsed(self.account, uid))
+
+    def openMainpageLoggedIn(self) -> str:
+        """ Liefert die Startseite des Kundencenters. Ist eine als gueltig angenommene Session doch abgelaufen, wird neu eingeloggt. """
+        html = self.mainpageHTML
+        self.mainpageHTML = None
+        if html is None:
+            mainurl = getMainpageURL(self.state.session.sess_id)
+            print(f"Vorbereitung: Öffne Startseite: {mainurl}")
+            html = self.client.openPage(mainurl)
+        if not isLoggedInEuserv(html):
+            print("Session ist abgelaufen -> Erneuter Login")
+            self.invalidateSession()
+            self.loginEuserv()
+            html = self.mainpageHTML or self.client.openPage(getMainpageURL(self.state.session.sess_id))
+            self.mainpageHTML = None
+        return html
+
+    def requestContractExtensionPIN(self, phpsessid: str, contractID: str, prolongContractURL: str):
+        print(f"Vertrag {contractID}: Öffne URL: {prolongContractURL} und frage Vertragsverlängerung an")
+        with metrics.timer('extend_step_request_pin', account=self.account):
+            self.client.requestExtensionPIN(phpsessid, prolongContractURL)
+
+    def confirmContractExtension(self, phpsessid: str, result: ContractExtensionResult) -> Optional[str]:
+        """ Wartet auf die PIN-Mail des Vertrags und schliesst die Verlaengerung ab. Gibt das neue Vertragsende zurueck (evtl. None).
+        Die UID der verwendeten PIN-Mail landet in result. """
+        contractID = result.contract_id
+        print(f"Vertrag {contractID}: Warte auf Email mit PIN")
+        pinMail = self.mailFindContractExtendPIN(contractID=contractID)
+        result.pin_uid = pinMail.uid
+        contractExtendPIN = pinMail.pin
+        print(f"Vertrag {contractID}: Sende PIN {contractExtendPIN}")
+        with metrics.timer('extend_step_submit_pin', account=self.account):
+            parsedJson = self.client.submitExtensionPIN(phpsessid, contractID, contractExtendPIN)
+        status = parsedJson.get('rs')
+        if status != 'success':
+            raise Exception("Vertragsverlängerung fehlgeschlagen! | Fehler: " + str(status))
+        token = parsedJson['token']['value']
+        print(f"Vertrag {contractID}: Bestätige Vertragsverlängerung Teil 1")
+        with metrics.timer('extend_step_confirmation_dialog', account=self.account):
+            html = self.client.getExtensionConfirmationDialog(phpsessid, token)
+        contractExtendDate = findExtendedUntil(html)
+        if contractExtendDate is None:
+            print("Warnung: Verlängerungsdatum konnte nicht gefunden werden | HTML:")
+            print(formatPageForLog(html))
+        print(f"Vertrag {contractID}: Bestätige Vertragsverlängerung Teil 2: Vertrag wird verlängert bis: {contractExtendDate}")
+        with metrics.timer('extend_step_confirm', account=self.account):
+            html = self.client.confirmExtension(phpsessid, contractID, token)
+        if isExtensionConfirmed(html) or (contractExtendDate is not None and contractExtendDate in html):
+            print(f"Vertrag {contractID} wurde erfolgreich verlängert | Die Verlängerung wird dir zusätzlich per Email bestätigt.")
+        else:
+            print('Warnung: Vertragsverlängerung evtl. fehlgeschlagen -> Prüfe deine Emails!')
+        return contractExtendDate
+
+    def onContractExtended(self, contractID: str, contractExtendDate: Optional[str]):
+        now = datetime.now(tz=timezone.utc)
+        self.state.last_date_extended_contract = now
+        notBefore = now - timedelta(days=HISTORY_RETENTION_DAYS)
+        self.mergeState('extended_contracts', {contractID: now}, removed=[key for key, value in self.state.extended_contracts.items() if value < notBefore])
+        if contractExtendDate is not None:
+            self.state.last_contract_extended_until = contractExtendDate
+        self.saveState('last_date_extended_contract', 'last_contract_extended_until')
+        self.statestore.addHistory(self.account, 'contract_extended', {'contract_id': contractID, 'extended_until': contractExtendDate})
+
+    def saveContractResult(self, result: ContractExtensionResult):
+        """ Ergebnis pro Vertragsverlaengerungs-Mail im Verlauf, bereits verlaengerte Mails werden danach uebersprungen. """
+        # Ohne bekannte Mail (extendContract direkt aufgerufen) wird unter einem leeren Schluessel gespeichert
+        noticeKeys = self.pendingNoticeKeys.get(result.contract_id) or ['']
+        if result.success:
+            outcome = CONTRACT_OUTCOME_EXTENDED
+        elif result.skipped:
+            outcome = CONTRACT_OUTCOME_NOT_ON_ACCOUNT
+        else:
+            outcome = CONTRACT_OUTCOME_FAILED
+        self.statestore.setContractResult(self.account, result.contract_id, noticeKeys, outcome, extendedUntil=result.extended_until,
+                                          pinUID=result.pin_uid, seconds=result.seconds, error=result.error)
+
+    @timedMethod('extend_contract')
+    def extendContracts(self, contractIDs: List[str]) -> List[ContractExtensionResult]:
+        """ Verlaengert alle Vertraege dieses Accounts in einer Session. Die Startseite wird nur einmal geladen. Enthaelt die PIN-Mail
+        die Vertrags-ID, werden die PINs aller weiteren Vertraege auf einmal angefragt, so laufen die PIN-Mails parallel ein (der
+        MailService ordnet sie ueber die Vertrags-ID zu). Sonst koennte eine PIN beim falschen Vertrag landen -> Dann wird immer nur
+        eine PIN angefragt und abgewartet. Fehler eines Vertrags brechen die uebrigen nicht ab. Fehlt der Verlaengerungs-Link, ist das
+        ein Fehler (naechster Lauf versucht es erneut), ausser der Vertrag gehoert nachweislich zu einem anderen Account im selben
+        Postfach (siehe findContractOwner): Dann wird er als uebersprungen gespeichert und nicht erneut versucht. """
+        self.loginEuserv()
+        with metrics.timer('extend_step_mainpage', account=self.account):
+            html = self.openMainpageLoggedIn()
+        extensionURLs = findContractExtensionURLs(html)
+        results = {contractID: ContractExtensionResult(contract_id=contractID, success=False) for contractID in contractIDs}
+        prolongContractURLs = []
+        for contractID in contractIDs:
+            prolongContractURL = findContractExtensionURL(extensionURLs, contractID)
+            if prolongContractURL is None:
+                owner = self.findContractOwner(contractID)
+                if owner is not None:
+                    print(f"Vertrag {contractID}: Gehoert zu Account {owner} im selben Postfach -> Überspringe")
+                    results[contractID].skipped = True
+                else:
+                    print(f"Vertrag {contractID}: Kein Verlaengerungs-Link auf der Startseite gefunden")
+                    results[contractID].error = 'Failed to find prolongContractURL'
+                self.saveContractResult(results[contractID])
+            else:
+                prolongContractURLs.append((contractID, prolongContractURL))
+        phpsessid = self.client.getCookie('PHPSESSID')
+        print(f"Starte Vertragsverlängerung für {len(prolongContractURLs)} Vertrag/Verträge")
+        # Ob PIN-Mails die Vertrags-ID enthalten, zeigt erst die erste PIN-Mail -> Bis dahin nur einzeln und auch nicht gleichzeitig
+        # mit anderen Accounts im selben Postfach
+        while len(prolongContractURLs) > 0:
+            with self.mailservice.exclusivePIN(MAIL_TYPE_CONTRACT_EXTEND_PIN):
+                batchSize = len(prolongContractURLs) if self.mailservice.isPINMailRoutable(MAIL_TYPE_CONTRACT_EXTEND_PIN) else 1
+                self.extendContractBatch(phpsessid, prolongContractURLs[:batchSize], results)
+            prolongContractURLs = prolongContractURLs[batchSize:]
+        return list(results.values())
+
+    def extendContractBatch(self, phpsessid: str, prolongContractURLs: List[Tuple[str, str]], results: Dict[str, ContractExtensionResult]):
+        """ Fragt die PINs aller Vertraege an und schliesst danach jeden Vertrag ab. Scheitert ein Vertrag, weil EUserv eine fruehere
+        PIN-Anfrage verworfen hat, wird dessen PIN einmal einzeln neu angefragt. """
+        requested = []
+        timesStarted = {}
+        # Vertrag der zuletzt angefragten PIN: Nur dessen PIN kann nicht durch eine spaetere Anfrage verworfen worden sein
+        lastRequestedContractID = None
+        for contractID, prolongContractURL in prolongContractURLs:
+            timesStarted[contractID] = time.perf_counter()
+            try:
+                self.requestContractExtensionPIN(phpsessid, contractID, prolongContractURL)
+                requested.append((contractID, prolongContractURL))
+                lastRequestedContractID = contractID
+            except Exception as e:
+                results[contractID].error = str(e)
+                results[contractID].seconds = time.perf_counter() - timesStarted[contractID]
+                self.saveContractResult(results[contractID])
+        for contractID, prolongContractURL in requested:
+            result = results[contractID]
+            try:
+                try:
+                    contractExtendDate = self.confirmContractExtension(phpsessid, result)
+                except Exception as e:
+                    if contractID == lastRequestedContractID:
+                        raise e
+                    print(f"Vertrag {contractID}: {e} -> Frage PIN einzeln erneut an")
+                    lastRequestedContractID = contractID
+                    self.requestContractExtensionPIN(phpsessid, contractID, prolongContractURL)
+                    contractExtendDate = self.confirmContractExtension(phpsessid, result)
+                self.onContractExtended(contractID, contractExtendDate)
+                result.success = True
+                result.extended_until = contractExtendDate
+            except Exception as e:
+                print(f"Vertrag {contractID}: Verlängerung fehlgeschlagen: {e}")
+                result.error = str(e)
+            result.seconds = time.perf_counter() - timesStarted[contractID]
+            self.saveContractResult(result)
+
+    def extendContract(self, contractID: str):
+        result = self.extendContracts([contractID])[0]
+        if not result.success:
+            raise Exception(result.getReport())
+
+    def testLogins(self) -> str:
+        self.ensureMailLogin()
+        print("Email Login OK")
+        self.loginEuserv()
+        print("Euserv Login OK")
+        return 'Logins OK'
+
+    def getNextAttemptDate(self, contractID: str) -> Optional[datetime]:
+        """ Frühester Zeitpunkt für den nächsten Verlängerungsversuch dieses Vertrags oder None, wenn sofort ein Versuch erlaubt ist.
+        Andere Verträge des Accounts sind davon nicht betroffen. """
+        return getNextAttemptDate(self.state.extended_contracts.get(contractID))
+
+    @timedMethod('run')
+    def run(self) -> str:
+        """ Verlaengert den Vertrag falls noetig und gibt eine kurze Statusmeldung zurueck. Fehler werden als Exception geworfen. """
+        loginBlockedUntil = self.getLoginBlockedUntil()
+        if loginBlockedUntil is not None and self.state.session is None:
+            print(f"Login nach fehlgeschlagenem Login/Captcha pausiert bis {loginBlockedUntil} -> Beende ohne Aktion")
+            return 'Keine Aktion'
+
+        notices = self.mailFindContractNotices()
+        if len(notices) == 0:
+            raise Exception(f"Keine Vertragsverlaengerungsemail in Mails der letzten {MAIL_NOTICE_MAX_AGE_HOURS} Stunden gefunden")
+        contractIDs = self.getPendingContractIDs(notices)
+        if len(contractIDs) == 0:
+            # Check if contract was extended within the last days -> Then don't even try
+            print("Alle Vertragsverlaengerungs-Mails bereits bearbeitet bzw. Verträge erst vor kurzem verlängert -> Beende ohne Aktion")
+            return 'Keine Aktion'
+        return self.extendPendingContracts(contractIDs)
+
+    def extendPendingContracts(self, contractIDs: List[str]) -> str:
+        """ Verlaengert alle Vertraege und gibt den Bericht pro Vertrag zurueck. Ist mindestens ein Vertrag fehlgeschlagen, wird der
+        Bericht als Exception geworfen (die erfolgreichen Verlaengerungen sind dann bereits gespeichert). Uebersprungene Vertraege
+        (gehoeren zu einem anderen Account im selben Postfach) stehen im Bericht, sind aber kein Fehler. """
+        print(f'Vertrags-IDs zum Verlaengern gefunden: {contractIDs} | Letzte Vertrags-ID: {self.state.last_contract_id}')
+        self.state.last_contract_id = contractIDs[0]
+        self.saveState('last_contract_id')
+        results = self.extendContracts(contractIDs)
+        report = ' | '.join(result.getReport() for result in results)
+        if not all(result.success or result.skipped for result in results):
+            raise Exception(report)
+        return report
+
+
+class Daemon:
+    """ Dauerhaft laufender Modus: Alle Accounts bleiben geladen (IMAP-Verbindung und HTTP-Session bleiben offen) und werden
+    nur dann bearbeitet, wenn es etwas zu tun gibt. Pro Account wird der naechste Pruefzeitpunkt berechnet:
+    - Regelmaessig (inkrementelle Suche nach neuen Vertragsverlaengerungs-Mails, nur bei offenen Vertraegen wird eingeloggt)
+    - Hat ein erst vor kurzem verlaengerter Vertrag eine neue Mail, sobald fuer diesen Vertrag ein neuer Versuch erlaubt ist
+    - Nach Fehlern mit exponentiell wachsender Wartezeit
+    - Sofort, sobald eine neue Vertragsverlaengerungs-Mail eingeht (IDLE bzw. Polling ueber den MailService)
+    - Ist das Vertragsende (last_contract_extended_until) noch weit weg, seltener; ab DAEMON_DEADLINE_LEAD_DAYS davor wieder regelmaessig
+    Alle Zeitpunkte bekommen eine zufaellige Abweichung, damit nicht alle Accounts gleichzeitig anfragen. """
+
+    def __init__(self, configpaths: List[str], statepath: str, maxWorkers: int, metricsPromPath: Optional[str] = None):
+        mailboxAccounts = getMailboxAccounts(configpaths)
+        self.updaters = [ContractUpdater(configpath, statepath, mailboxAccounts.get(configpath, ())) for configpath in configpaths]
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='account')
+        self.metricsPromPath = metricsPromPath
+        # Fuer accountuebergreifende Aufgaben (Loeschen alter Verlaufseintraege)
+        self.statestore = StateStore(statepath)
+        now = datetime.now(tz=timezone.utc)
+        self.nextCheck: Dict[str, datetime] = {updater.account: now for updater in self.updaters}
+        self.failures: Dict[str, int] = {updater.account: 0 for updater in self.updaters}
+        self.wakeEvent = threading.Event()
+        # Accounts, fuer die seit der letzten Pruefung eine neue Vertragsverlaengerungs-Mail eingegangen ist
+        self.triggered: Set[str] = set()
+        # Accounts, deren Pruefung gerade laeuft, und Anzahl seit dem letzten Aufraeumen abgeschlossener Pruefungen
+        self.running: Set[str] = set()
+        self.checksCompleted = 0
+        self.lock = threading.Lock()
+        # Ein Listener pro (evtl. von mehreren Accounts geteiltem) Postfach
+        self.noticeListeners = []
+        for updater in self.updaters:
+            if any(mailservice is updater.mailservice for mailservice, _ in self.noticeListeners):
+                continue
+            listener = functools.partial(self.onContractNotice, updater.mailservice)
+            updater.mailservice.addNoticeListener(listener)
+            self.noticeListeners.append((updater.mailservice, listener))
+
+    def close(self):
+        for mailservice, listener in self.noticeListeners:
+            mailservice.removeNoticeListener(listener)
+        self.executor.shutdown(wait=True)
+        for updater in self.updaters:
+            updater.close()
+        self.statestore.close()
+
+    def onContractNotice(self, mailservice: MailService, mail: ParsedMail):
+        """ Wird im IMAP-Thread aufgerufen: Markiert die betroffenen Accounts als sofort faellig und weckt den Daemon. """
+        updaters = [updater for updater in self.updaters if updater.mailservice is mailservice]
+        # Bei mehreren Accounts im selben Postfach bevorzugt den Account, der den Vertrag bereits kennt
+        owners = [updater for updater in updaters if mail.contractID in updater.state.extended_contracts or updater.state.last_contract_id == mail.contractID]
+        if len(owners) > 0:
+            updaters = owners
+        now = datetime.now(tz=timezone.utc)
+        with self.lock:
+            for updater in updaters:
+                if updater.isContractNoticeHandled(mail.contractID, mail.date, getNoticeKey(mail.messageID, mail.uid)):
+                    continue
+                self.triggered.add(updater.account)
+                self.nextCheck[updater.account] = now
+        self.wakeEvent.set()
+
+    def check(self, updater: ContractUpdater) -> str:
+        """ Die Suche nach neuen Vertragsverlaengerungs-Mails ist inkrementell und damit billig, eingeloggt wird nur bei offenen Vertraegen. """
+        contractIDs = updater.getPendingContractIDs()
+        if len(contractIDs) == 0:
+            return 'Keine offene Vertragsverlaengerung'
+        return updater.extendPendingContracts(contractIDs)
+
+    def schedule(self, updater: ContractUpdater, success: bool) -> datetime:
+        now = datetime.now(tz=timezone.utc)
+        if not success:
+            self.failures[updater.account] += 1
+            delay = min(DAEMON_RETRY_DELAY_SECONDS * 2 ** (self.failures[updater.account] - 1), DAEMON_CHECK_INTERVAL_SECONDS)
+            nextCheck = now + timedelta(seconds=delay * random.uniform(1, 1 + DAEMON_JITTER))
+            loginBlockedUntil = updater.getLoginBlockedUntil()
+            if loginBlockedUntil is not None and updater.state.session is None:
+                # Vorher waere nur ein Login mit Cookies moeglich, die gibt es aber nicht mehr
+                nextCheck = max(nextCheck, loginBlockedUntil + timedelta(seconds=delay * random.uniform(0, DAEMON_JITTER)))
+            return nextCheck
+        self.failures[updater.account] = 0
+        nextCheck = now + timedelta(seconds=DAEMON_CHECK_INTERVAL_SECONDS * random.uniform(1 - DAEMON_JITTER, 1 + DAEMON_JITTER))
+        deadline = parseContractEndDate(updater.state.last_contract_extended_until)
+        if deadline is not None and deadline - timedelta(days=DAEMON_DEADLINE_LEAD_DAYS) > nextCheck:
+            # Vertragsende noch weit weg: Vertragsverlaengerungs-Mails kommen ohnehin per IDLE/Polling, die regelmaessige Pruefung
+            # faengt nur verpasste Mails ab -> Seltener, spaetestens ab DAEMON_DEADLINE_LEAD_DAYS vor dem Ende wieder regelmaessig
+            nextCheck = min(now + timedelta(seconds=DAEMON_IDLE_CHECK_INTERVAL_SECONDS * random.uniform(1 - DAEMON_JITTER, 1 + DAEMON_JITTER)),
+                            deadline - timedelta(days=DAEMON_DEADLINE_LEAD_DAYS))
+        if updater.blockedUntil is not None:
+            # Ein erst vor kurzem verlaengerter Vertrag hat eine neue Vertragsverlaengerungs-Mail -> Sobald erlaubt erneut pruefen
+            nextCheck = min(nextCheck, updater.blockedUntil + timedelta(seconds=DAEMON_RETRY_DELAY_SECONDS * random.uniform(0, DAEMON_JITTER)))
+        return nextCheck
+
+    def submitDueChecks(self):
+        """ Startet die Pruefung aller faelligen Accounts, die nicht schon laufen. Jeder Account wird unabhaengig von den anderen
+        eingeplant (siehe onCheckDone), ein langsamer Account haelt die uebrigen also nicht auf. """
+        now = datetime.now(tz=timezone.utc)
+        with self.lock:
+            due = [updater for updater in self.updaters if updater.account not in self.running and self.nextCheck[updater.account] <= now]
+            for updater in due:
+                self.running.add(updater.account)
+                self.triggered.discard(updater.account)
+        for updater in due:
+            future = self.executor.submit(self.check, updater)
+            future.add_done_callback(functools.partial(self.onCheckDone, updater))
+
+    def onCheckDone(self, updater: ContractUpdater, future: Future):
+        """ Wird im Thread des Accounts aufgerufen: Plant dessen naechste Pruefung und weckt den Daemon. """
+        try:
+            message = future.result()
+            success = True
+        except Exception as e:
+            message = str(e)
+            success = False
+            updater.statestore.addHistory(updater.account, 'failed', {'error': message})
+        nextCheck = self.schedule(updater, success)
+        with self.lock:
+            # Ist waehrend der Pruefung eine neue Vertragsverlaengerungs-Mail eingegangen, bleibt der Account sofort faellig
+            if updater.account not in self.triggered:
+                self.nextCheck[updater.account] = nextCheck
+            self.running.discard(updater.account)
+            self.checksCompleted += 1
+            nextCheck = self.nextCheck[updater.account]
+        print(f"{'OK    ' if success else 'FEHLER'} {updater.account}: {message} | Naechste Pruefung: {nextCheck}")
+        self.wakeEvent.set()
+
+    def getSecondsUntilNextCheck(self) -> Optional[float]:
+        """ None, wenn gerade alle Accounts geprueft werden (dann weckt erst onCheckDone den Daemon). """
+        with self.lock:
+            waiting = [self.nextCheck[updater.account] for updater in self.updaters if updater.account not in self.running]
+        if len(waiting) == 0:
+            return None
+        return (min(waiting) - datetime.now(tz=timezone.utc)).total_seconds()
+
+    def onChecksCompleted(self):
+        """ Accountuebergreifende Aufgaben nach abgeschlossenen Pruefungen, nur im Hauptthread (eine Datei, eine Datenbankverbindung). """
+        with self.lock:
+            if self.checksCompleted == 0:
+                return
+            self.checksCompleted = 0
+        self.statestore.expireHistory()
+        if self.metricsPromPath is not None:
+            metrics.writePrometheus(self.metricsPromPath)
+
+    def run(self):
+        print(f"Daemon gestartet mit {len(self.updaters)} Account(s)")
+        while True:
+            self.wakeEvent.clear()
+            self.onChecksCompleted()
+            self.submitDueChecks()
+            secondsUntilNextCheck = self.getSecondsUntilNextCheck()
+            if secondsUntilNextCheck is None or secondsUntilNextCheck > 0:
+                self.wakeEvent.wait(timeout=secondsUntilNextCheck)
+
+
+def getMailboxAccounts(configpaths: List[str]) -> Dict[str, List[str]]:
+    """ Config-Datei -> Account-IDs der anderen Config-Dateien mit demselben Postfach. Kaputte Configs werden ignoriert, den
+    Fehler meldet der Lauf des Accounts selbst. """
+    mailboxes = {}
+    for configpath in configpaths:
+        try:
+            config = getConfig(configpath)
+        except Exception:
+            continue
+        mailboxes[configpath] = ((config.imap_server, config.imap_port, config.imap_login), config.euserv_mail_or_user_id)
+    return {configpath: [account for other, (otherMailbox, account) in mailboxes.items() if other != configpath and otherMailbox == mailbox]
+            for configpath, (mailbox, _) in mailboxes.items()}
+
+
+def runAccount(configpath: str, statepath: str, testLogins: bool, mailboxAccounts: Sequence[str] = ()) -> str:
+    updater = ContractUpdater(configpath, statepath, mailboxAccounts)
+    try:
+        if testLogins:
+            return updater.testLogins()
+        return updater.run()
+    except Exception as e:
+        updater.statestore.addHistory(updater.account, 'failed', {'error': str(e)})
+        raise e
+    finally:
+        updater.close()
+
+
+def runAccounts(configpaths: List[str], statepath: str, testLogins: bool, maxWorkers: int) -> int:
+    """ Bearbeitet alle Accounts parallel (ein Thread pro Account, max. maxWorkers gleichzeitig) und gibt den Exit-Code zurueck:
+    0 wenn alle Accounts erfolgreich waren, sonst 1. """
+    results = {}
+    mailboxAccounts = getMailboxAccounts(configpaths)
+    if len(configpaths) == 1 or maxWorkers <= 1:
+        for configpath in configpaths:
+            try:
+                results[configpath] = (True, runAccount(configpath, statepath, testLogins, mailboxAccounts.get(configpath, ())))
+            except Exception as e:
+                results[configpath] = (False, str(e))
+    else:
+        with ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='account') as executor:
+            futures = {executor.submit(runAccount, configpath, statepath, testLogins, mailboxAccounts.get(configpath, ())): configpath
+                       for configpath in configpaths}
+            for future in as_completed(futures):
+                configpath = futures[future]
+                try:
+                    results[configpath] = (True, future.result())
+                except Exception as e:
+                    results[configpath] = (False, str(e))
+    print(f"Ergebnis fuer {len(configpaths)} Account(s):")
+    for configpath in configpaths:
+        success, message = results[configpath]
+        print(f"{'OK    ' if success else 'FEHLER'} {configpath}: {message}")
+    statestore = StateStore(statepath)
+    try:
+        statestore.expireHistory()
+    finally:
+        statestore.close()
+    return 0 if all(success for success, _ in results.values()) else 1
+
+
+def loadJson(filepath: str):
+    readFile = open(filepath, 'r')
+    settingsJson = readFile.read()
+    readFile.close()
+    return json.loads(settingsJson)
+
+
+list_response_pattern = re.compile(r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
+
+
+# According to docs/example: https://pymotw.com/2/imaplib/
+def parse_list_response(line):
+    line = line.decode('utf-8', 'ignore')
+    flags, delimiter, mailbox_name = list_response_pattern.match(line).groups()
+    mailbox_name = mailbox_name.strip('"')
+    return flags, delimiter, mailbox_name
@@ -0,0 +1,375 @@
+import json
+import os
+import time
+from http.cookiejar import LWPCookieJar
+from typing import Generator, List, Match, Optional, Pattern, Tuple
+
+import httpx
+
+from euservparser import PATTERN_SESS_ID, PATTERN_EXTENSION_CONFIRMED, findSessionID
+from metrics import metrics
+from ratelimit import scheduler, getBackoffDelay, RATE_KIND_HTTP, RATE_KIND_LOGIN, BACKOFF_MAX_SECONDS
+
+EUSERV_BASE = 'https://support.euserv.com/'
+EUSERV_INDEX = 'index.iphp'
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36',
+    'Origin': 'https://support.euserv.com',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8,en-US;q=0.7',
+    'Cache-Control': 'max-age=0',
+    # Ohne 'br': httpx kann Brotli nur mit Zusatzpaket
+    'Accept-Encoding': 'gzip, deflate',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Ch-Ua': "\"Not/A)Brand\";v=\"99\", \"Google Chrome\";v=\"115\", \"Chromium\";v=\"115\"",
+    'Sec-Ch-Ua-Mobile': '?0',
+    'Sec-Ch-Ua-Platform': "\"Windows\"",
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'same-origin',
+    'Sec-Fetch-User': '?1',
+}
+TIMEOUT_SECONDS = 30
+EXTEND_CONTRACT_PREFIX = 'kc2_customer_contract_details_extend_contract_'
+# Obergrenze fuer den gespeicherten Text einer Antwort, der Rest wird nicht mehr gelesen
+PAGE_MAX_CHARS = 1024 * 1024
+# Nach dem Fund wird der Rest der Antwort bis zu dieser Groesse noch verworfen, damit die Verbindung wiederverwendet werden kann
+DRAIN_MAX_CHARS = 256 * 1024
+# Versuche pro Request bei voruebergehenden Fehlern (Verbindungsabbruch, Timeout, 429/5xx), dazwischen exponentielles Backoff
+REQUEST_ATTEMPTS = 4
+# Status, mit denen der Server Ueberlastung meldet -> Rate fuer diesen Host senken
+STATUS_THROTTLE = (429, 503)
+STATUS_TRANSIENT = (429, 500, 502, 503, 504)
+# POST-Requests, die nichts veraendern und deshalb wie GET-Requests wiederholt werden duerfen
+IDEMPOTENT_SUBACTIONS = ('kc2_customer_contract_details_get_extend_contract_confirmation_dialog',)
+
+
+class PageReader:
+    """ Nimmt den Text einer Antwort stueckweise (bereits dekodiert) entgegen und speichert hoechstens maxChars Zeichen.
+    Mit stopPattern endet das Lesen beim ersten Treffer. Durchsucht wird jeweils nur das neue Stueck plus die letzten overlap
+    Zeichen davor, damit auch Treffer ueber Stueckgrenzen hinweg gefunden werden, ohne die Seite mehrfach zu durchsuchen.
+    Ein Treffer, der genau am Ende des bisher Gelesenen endet, zaehlt noch nicht: Er koennte im naechsten Stueck weitergehen
+    (z.B. eine abgeschnittene sess_id). Erst finish() am Ende der Antwort akzeptiert ihn. """
+
+    def __init__(self, stopPattern: Optional[Pattern] = None, maxChars: int = PAGE_MAX_CHARS, overlap: int = 256):
+        self.stopPattern = stopPattern
+        self.maxChars = maxChars
+        self.overlap = overlap
+        self.chunks: List[str] = []
+        self.length = 0
+        self.tail = ''
+        self.match: Optional[Match] = None
+        self.truncated = False
+
+    def feed(self, chunk: str) -> bool:
+        """ Gibt True zurueck, sobald der Rest der Antwort nicht mehr benoetigt wird. """
+        if self.length + len(chunk) > self.maxChars:
+            chunk = chunk[:self.maxChars - self.length]
+            self.truncated = True
+        self.chunks.append(chunk)
+        self.length += len(chunk)
+        if self.stopPattern is not None and self.match is None:
+            window = self.tail + chunk
+            match = self.stopPattern.search(window)
+            if match is not None and match.end() < len(window):
+                self.match = match
+            self.tail = window[-self.overlap:]
+        return self.match is not None or self.length >= self.maxChars
+
+    def finish(self):
+        """ Die Antwort ist vollstaendig gelesen, ein Treffer am Ende kann nicht mehr weitergehen. """
+        if self.stopPattern is not None and self.match is None:
+            self.match = self.stopPattern.search(self.tail)
+
+    def getText(self) -> str:
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if len(self.chunks) > 0 else ''
+
+    def reset(self):
+        """ Verwirft bereits Gelesenes, bevor ein Request wiederholt wird. """
+        self.chunks = []
+        self.length = 0
+        self.tail = ''
+        self.match = None
+        self.truncated = False
+
+
+def discardPage() -> PageReader:
+    """ Fuer Antworten, deren Inhalt nicht benoetigt wird. """
+    return PageReader(maxChars=0)
+
+
+""" Die einzelnen Schritte sind Generatoren, die Requests (url, Formulardaten oder None fuer GET, PageReader) liefern und den
+damit gelesenen PageReader zurueckbekommen. Die Logik der Schritte ist so unabhaengig davon, wie EuservClient die Requests sendet. """
+Request = Tuple[str, Optional[dict], PageReader]
+Steps = Generator[Request, PageReader, object]
+
+
+def getMainpageURL(sessionid: str) -> str:
+    return EUSERV_INDEX + '?sess_id=' + sessionid + '&action=show_default'
+
+
+def stepsOpenPage(url: str) -> Steps:
+    page = yield url, None, PageReader()
+    return page.getText()
+
+
+def stepsOpenSession() -> Steps:
+    page = yield EUSERV_INDEX, None, PageReader(stopPattern=PATTERN_SESS_ID)
+    sess_id = findSessionID(page.getText())
+    if sess_id is None:
+        raise Exception("Konnte session_id nicht finden")
+    # Important! Accessing this fake image activates the current session_id and allows us to use it to login.
+    yield 'pic/logo_small.png', None, discardPage()
+    yield EUSERV_INDEX + '?sess_id=' + sess_id, None, discardPage()
+    return sess_id
+
+
+def stepsSubmitCredentials(sess_id: str, user: str, password: str) -> Steps:
+    page = yield EUSERV_INDEX, {
+        'email': user,
+        'password': password,
+        'form_selected_language': 'de',
+        'Submit': 'Anmelden',
+        'subaction': 'login',
+        'sess_id': sess_id,
+    }, PageReader()
+    return page.getText()
+
+
+def stepsSubmitPIN(sess_id: str, customer_id: str, pin: str) -> Steps:
+    page = yield EUSERV_INDEX, {
+        'pin': pin,
+        'save_for_auto_login': 'on',
+        'Submit': 'Besttigen',
+        'subaction': 'login',
+        'sess_id': sess_id,
+        'c_id': customer_id,
+    }, PageReader()
+    return page.getText()
+
+
+def stepsRequestExtensionPIN(phpsessid: str, prolongContractURL: str) -> Steps:
+    # Beide Antworten werden nicht ausgewertet
+    yield prolongContractURL, None, discardPage()
+    yield EUSERV_INDEX, {
+        'sess_id': phpsessid,
+        'subaction': 'show_kc2_security_password_dialog',
+        'prefix': EXTEND_CONTRACT_PREFIX,
+        'type': 1,
+    }, discardPage()
+
+
+def stepsSubmitExtensionPIN(phpsessid: str, contractID: str, pin: str) -> Steps:
+    page = yield EUSERV_INDEX, {
+        'sess_id': phpsessid,
+        'subaction': 'kc2_security_password_get_token',
+        'prefix': EXTEND_CONTRACT_PREFIX,
+        'type': 1,
+        'auth': pin,
+        'ident': EXTEND_CONTRACT_PREFIX + contractID,
+    }, PageReader()
+    return json.loads(page.getText())
+
+
+def stepsGetExtensionConfirmationDialog(phpsessid: str, token: str) -> Steps:
+    page = yield EUSERV_INDEX, {
+        'sess_id': phpsessid,
+        'subaction': 'kc2_customer_contract_details_get_extend_contract_confirmation_dialog',
+        'token': token,
+    }, PageReader()
+    return json.loads(page.getText())['html']['value']
+
+
+def stepsConfirmExtension(phpsessid: str, contractID: str, token: str) -> Steps:
+    page = yield EUSERV_INDEX, {
+        'sess_id': phpsessid,
+        'ord_id': contractID,
+        'subaction': 'kc2_customer_contract_details_extend_contract_term',
+        'token': token,
+    }, PageReader(stopPattern=PATTERN_EXTENSION_CONFIRMED)
+    return page.getText()
+
+
+def isIdempotentRequest(data: Optional[dict]) -> bool:
+    return data is None or data.get('subaction') in IDEMPOTENT_SUBACTIONS
+
+
+def isRetryableError(e: httpx.HTTPError, idempotent: bool) -> bool:
+    """ Nicht gesendete Requests (Verbindungsaufbau) und 429 duerfen immer wiederholt werden, alle anderen voruebergehenden Fehler
+    nur bei idempotenten Requests: Ein abgebrochener Login oder eine halb bestaetigte Verlaengerung wird nicht blind wiederholt. """
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        return status == 429 or (idempotent and status in STATUS_TRANSIENT)
+    return idempotent and isinstance(e, httpx.TransportError)
+
+
+def getRetryAfterSeconds(response: httpx.Response) -> Optional[float]:
+    """ Retry-After in Sekunden (die Form mit Datum wird ignoriert). """
+    try:
+        return min(float(response.headers['Retry-After']), BACKOFF_MAX_SECONDS)
+    except (KeyError, ValueError):
+        return None
+
+
+def loadCookieJar(cookiespath: str) -> LWPCookieJar:
+    """ Gleiches Dateiformat wie zuvor mit mechanize, bestehende Cookie-Dateien bleiben gueltig. """
+    cookiejar = LWPCookieJar(cookiespath)
+    if os.path.exists(cookiespath):
+        cookiejar.load(ignore_discard=True, ignore_expires=True)
+    return cookiejar
+
+
+class EuservClient:
+    """ EUserv Kundencenter ueber eine httpx-Session mit keep-alive. Formulare werden direkt befuellt statt aus dem HTML gelesen.
+    Mehrere Accounts laufen parallel in eigenen Threads mit je einem EuservClient (siehe runAccounts). """
+
+    def __init__(self, cookiespath: str, baseURL: str = EUSERV_BASE, account: str = ''):
+        self.cookiejar = loadCookieJar(cookiespath)
+        self.baseURL = baseURL
+        self.account = account
+        self.session = httpx.Client(**self.getClientArgs())
+
+    def countResponse(self, response: httpx.Response):
+        metrics.inc('euserv_http_requests_total', account=self.account)
+        metrics.inc('euserv_http_bytes_total', response.num_bytes_downloaded, account=self.account)
+
+    def buildRequest(self, url: str, data: Optional[dict]) -> httpx.Request:
+        if data is None:
+            return self.session.build_request('GET', url)
+        return self.session.build_request('POST', url, data=data)
+
+    def throttleLogins(self):
+        """ Nach einem Captcha: Logins aller Accounts bei diesem Host verlangsamen. """
+        scheduler.getBucket(httpx.URL(self.baseURL).host, RATE_KIND_LOGIN).throttle()
+
+    def reserveRequest(self, request: httpx.Request, data: Optional[dict]) -> float:
+        """ Sekunden bis der Request laut Rate-Limit gesendet werden darf. Logins zaehlen zusaetzlich gegen das Login-Limit. """
+        host = request.url.host
+        delay = scheduler.reserve(host, RATE_KIND_HTTP)
+        if data is not None and 'password' in data:
+            delay = max(delay, scheduler.reserve(host, RATE_KIND_LOGIN))
+        return delay
+
+    def onResponse(self, response: httpx.Response):
+        bucket = scheduler.getBucket(response.request.url.host, RATE_KIND_HTTP)
+        if response.status_code in STATUS_THROTTLE:
+            bucket.throttle(getRetryAfterSeconds(response))
+        else:
+            bucket.recover()
+
+    def getRetryDelay(self, e: httpx.HTTPError, url: str, data: Optional[dict], attempt: int) -> Optional[float]:
+        """ Wartezeit vor dem naechsten Versuch oder None, wenn der Fehler weitergegeben werden soll. """
+        if attempt + 1 >= REQUEST_ATTEMPTS or not isRetryableError(e, isIdempotentRequest(data)):
+            return None
+        delay = getBackoffDelay(attempt)
+        if isinstance(e, httpx.HTTPStatusError):
+            delay = max(delay, getRetryAfterSeconds(e.response) or 0)
+        metrics.inc('euserv_http_retries_total', account=self.account)
+        reason = f'HTTP {e.response.status_code}' if isinstance(e, httpx.HTTPStatusError) else repr(e)
+        print(f"Request {url} fehlgeschlagen: {reason} -> Versuch {attempt + 2}/{REQUEST_ATTEMPTS} in {delay:.1f} Sekunden")
+        return delay
+
+    def getClientArgs(self) -> dict:
+        # Eine Verbindung pro Account reicht, sie wird ueber alle Schritte hinweg per keep-alive wiederverwendet
+        return dict(base_url=self.baseURL, headers=HEADERS, cookies=self.cookiejar, follow_redirects=True, timeout=TIMEOUT_SECONDS,
+                    limits=httpx.Limits(max_connections=2, max_keepalive_connections=2))
+
+    def hasCookies(self) -> bool:
+        return len(self.cookiejar) > 0
+
+    def getCookie(self, key: str) -> Optional[str]:
+        for cookie in self.cookiejar:
+            if cookie.name == key:
+                return cookie.value
+        return None
+
+    def clearCookies(self):
+        self.cookiejar.clear()
+
+    def saveCookies(self):
+        self.cookiejar.save(ignore_discard=True, ignore_expires=True)
+
+    def close(self):
+        self.session.close()
+
+    def request(self, url: str, data: Optional[dict], reader: PageReader) -> PageReader:
+        """ Haelt das Rate-Limit ein und wiederholt den Request bei voruebergehenden Fehlern (siehe isRetryableError). """
+        attempt = 0
+        while True:
+            request = self.buildRequest(url, data)
+            delay = self.reserveRequest(request, data)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return self.requestOnce(request, reader)
+            except httpx.HTTPError as e:
+                delay = self.getRetryDelay(e, url, data, attempt)
+                if delay is None:
+                    raise e
+            reader.reset()
+            attempt += 1
+            time.sleep(delay)
+
+    def requestOnce(self, request: httpx.Request, reader: PageReader) -> PageReader:
+        """ Liest die Antwort nur so weit wie noetig (siehe PageReader). """
+        response = self.session.send(request, stream=True)
+        try:
+            self.onResponse(response)
+            response.raise_for_status()
+            chunks = response.iter_text()
+            for chunk in chunks:
+                if reader.feed(chunk):
+                    break
+            else:
+                reader.finish()
+            drained = 0
+            for chunk in chunks:
+                drained += len(chunk)
+                if drained > DRAIN_MAX_CHARS:
+                    break
+        finally:
+            response.close()
+            self.countResponse(response)
+        # Wie ein Browser: Die zuletzt geoeffnete Seite ist der Referer fuer den naechsten Request
+        self.session.headers['Referer'] = str(response.url)
+        return reader
+
+    def runSteps(self, steps: Steps):
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(self.request(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    def openPage(self, url: str) -> str:
+        return self.runSteps(stepsOpenPage(url))
+
+    def openMainpage(self, sessionid: str) -> str:
+        return self.openPage(getMainpageURL(sessionid))
+
+    def openSession(self) -> str:
+        return self.runSteps(stepsOpenSession())
+
+    def submitCredentials(self, sess_id: str, user: str, password: str) -> str:
+        return self.runSteps(stepsSubmitCredentials(sess_id, user, password))
+
+    def submitPIN(self, sess_id: str, customer_id: str, pin: str) -> str:
+        return self.runSteps(stepsSubmitPIN(sess_id, customer_id, pin))
+
+    def requestExtensionPIN(self, phpsessid: str, prolongContractURL: str):
+        self.runSteps(stepsRequestExtensionPIN(phpsessid, prolongContractURL))
+
+    def submitExtensionPIN(self, phpsessid: str, contractID: str, pin: str) -> dict:
+        return self.runSteps(stepsSubmitExtensionPIN(phpsessid, contractID, pin))
+
+    def getExtensionConfirmationDialog(self, phpsessid: str, token: str) -> str:
+        return self.runSteps(stepsGetExtensionConfirmationDialog(phpsessid, token))
+
+    def confirmExtension(self, phpsessid: str, contractID: str, token: str) -> str:
+        return self.runSteps(stepsConfirmExtension(phpsessid, contractID, token))
@@ -0,0 +1,76 @@
+import re
+from typing import List, Optional
+
+""" Extraktion aus den Seiten des EUserv Kundencenters. Alle Muster beginnen mit einem festen Text (schnelle Suche nach dem
+Anfang) und enthalten keine Platzhalter, die ueber Attributgrenzen (") hinweg zuruecklaufen koennen -> Laufzeit linear zur
+Seitengroesse, auch fuer Seiten, auf denen das Gesuchte fehlt. """
+
+PATTERN_SESS_ID = re.compile(r'sess_id=([a-f0-9]+)')
+PATTERN_CUSTOMER_ID_INPUT = re.compile(r'name="c_id"[^>]*value="(\d+)"')
+PATTERN_CONTRACT_EXTENSION_URL = re.compile(r'"(/index\.iphp\?[^"]*show_contract_extension=1[^"]*)"')
+PATTERN_EXTENDED_UNTIL = re.compile(r'bis zum (\d{2}\.\d{2}\.\d{4})')
+PATTERN_EXTENSION_CONFIRMED = re.compile(r'Der Vertrag wurde verl')
+
+MARKER_LOGOUT = 'action=logout'
+MARKER_CUSTOMER_BOX = 'class="kc2_customer_box_content"'
+MARKER_PIN_REQUIRED = 'step2_anmeldung'
+MARKER_CAPTCHA = 'securimage_show'
+
+# So viel einer Seite wird hoechstens ins Log geschrieben (Anfang und Ende)
+PAGE_LOG_MAX_CHARS = 2000
+
+
+def isLoggedInEuserv(html: Optional[str]) -> bool:
+    """ Important: 'action=logout' will also exist when we are only partially logged in e.g.
+    username + pw -> PIN or captcha (not logged in yet!) so we need to check for the presence of other elements """
+    if html is None:
+        return False
+    return MARKER_LOGOUT in html and MARKER_CUSTOMER_BOX in html
+
+
+def isPINRequired(html: str) -> bool:
+    return MARKER_PIN_REQUIRED in html
+
+
+def isCaptchaRequired(html: str) -> bool:
+    return MARKER_CAPTCHA in html
+
+
+def isExtensionConfirmed(html: str) -> bool:
+    return PATTERN_EXTENSION_CONFIRMED.search(html) is not None
+
+
+def findSessionID(html: str) -> Optional[str]:
+    regex = PATTERN_SESS_ID.search(html)
+    return regex.group(1) if regex is not None else None
+
+
+def findCustomerID(html: str) -> Optional[str]:
+    regex = PATTERN_CUSTOMER_ID_INPUT.search(html)
+    return regex.group(1) if regex is not None else None
+
+
+def findExtendedUntil(html: str) -> Optional[str]:
+    regex = PATTERN_EXTENDED_UNTIL.search(html)
+    return regex.group(1) if regex is not None else None
+
+
+def findContractExtensionURLs(html: str) -> List[str]:
+    """ Alle Verlaengerungs-Links der Startseite in einem Durchlauf. """
+    return PATTERN_CONTRACT_EXTENSION_URL.findall(html)
+
+
+def findContractExtensionURL(extensionURLs: List[str], contractID: str) -> Optional[str]:
+    contractIDRegex = re.compile(r'(?<!\d)' + re.escape(contractID) + r'(?!\d)')
+    for url in extensionURLs:
+        if contractIDRegex.search(url):
+            return url
+    return None
+
+
+def formatPageForLog(html: str, maxChars: int = PAGE_LOG_MAX_CHARS) -> str:
+    """ Kuerzt eine Seite fuers Log auf Anfang und Ende, insgesamt hoechstens maxChars Zeichen. """
+    if len(html) <= maxChars:
+        return html
+    half = maxChars // 2
+    return f'{html[:half]}\n[... {len(html) - 2 * half} Zeichen ausgelassen ...]\n{html[-half:]}'
@@ -0,0 +1,163 @@
+import binascii
+import email
+import os
+import re
+from datetime import datetime, timezone
+from email.message import Message
+from typing import Dict, List, Optional, Pattern, Tuple
+
+MAIL_TYPE_LOGIN_PIN = 'login_pin'
+MAIL_TYPE_CONTRACT_EXTEND_PIN = 'contract_extend_pin'
+MAIL_TYPE_CONTRACT_NOTICE = 'contract_notice'
+MAIL_TYPE_CONTRACT_CONFIRMATION = 'contract_confirmation'
+
+# Betreff fuer die serverseitige IMAP-Suche (SEARCH SUBJECT, Teilstring ohne Gross-/Kleinschreibung)
+MAIL_SEARCH_SUBJECTS = {
+    MAIL_TYPE_LOGIN_PIN: 'EUserv - Versuchter Login',
+    MAIL_TYPE_CONTRACT_EXTEND_PIN: 'EUserv - PIN zur',
+    MAIL_TYPE_CONTRACT_NOTICE: 'Anstehende manuelle Vertragsverlaengerung fuer Vertrag',
+}
+MAIL_PIN_TYPES = (MAIL_TYPE_LOGIN_PIN, MAIL_TYPE_CONTRACT_EXTEND_PIN)
+
+PART_SUBJECT = 'subject'
+PART_HTML = 'html'
+PART_TEXT = 'text'
+
+PATTERN_PIN_HTML = re.compile(r'(?i)PIN\s*:\s*<br>\s*(\d{6})')
+# Weitergeleitete Mails haben meist nur noch einen Text-Teil
+PATTERN_PIN_TEXT = re.compile(r'(?i)PIN\s*:\s*\r?\n(\d{6})')
+PATTERN_CUSTOMER_ID = re.compile(r'(?i)Kundennummer\s*:?\s*(\d+)')
+PATTERN_CONTRACT_ID = re.compile(r'(?i)Vertrag\s*:?\s*(\d+)')
+PATTERN_CONTRACT_ID_SUBJECT = re.compile(r'(?i)fuer Vertrag (\d+)')
+PATTERN_CONTRACT_ID_NOTICE_TEXT = re.compile(r'(?i)Sie den Vertrag (\d+) aus')
+PATTERN_EXTENDED_UNTIL = re.compile(r'bis zum (\d{2}\.\d{2}\.\d{4})')
+PATTERN_NOT_BASE64 = re.compile(rb'[^A-Za-z0-9+/=]')
+
+""" Pro Mailtyp: Erkennungsmuster fuer den Betreff und pro Feld eine Liste (Mailteil, Muster), der erste Treffer gewinnt.
+Die Reihenfolge der Typen ist relevant, der erste passende Betreff bestimmt den Typ. """
+MAIL_TYPE_TABLE: List[Tuple[str, Pattern, Dict[str, List[Tuple[str, Pattern]]]]] = [
+    (MAIL_TYPE_LOGIN_PIN, re.compile(r'(?i)EUserv - Versuchter Login'), {
+        'pin': [(PART_HTML, PATTERN_PIN_HTML), (PART_TEXT, PATTERN_PIN_TEXT)],
+        'customer_id': [(PART_TEXT, PATTERN_CUSTOMER_ID), (PART_HTML, PATTERN_CUSTOMER_ID)],
+    }),
+    (MAIL_TYPE_CONTRACT_EXTEND_PIN, re.compile(r'(?i)EUserv - PIN zur'), {
+        'pin': [(PART_HTML, PATTERN_PIN_HTML), (PART_TEXT, PATTERN_PIN_TEXT)],
+        'customer_id': [(PART_TEXT, PATTERN_CUSTOMER_ID), (PART_HTML, PATTERN_CUSTOMER_ID)],
+        'contract_id': [(PART_TEXT, PATTERN_CONTRACT_ID), (PART_HTML, PATTERN_CONTRACT_ID)],
+    }),
+    (MAIL_TYPE_CONTRACT_NOTICE, re.compile(r'(?i)Anstehende manuelle Vertragsverl(?:ae|ä)ngerung'), {
+        # Solange wie die ID des Vertrags im Betreff steht, muss der Inhalt der Mail nicht geladen werden
+        'contract_id': [(PART_SUBJECT, PATTERN_CONTRACT_ID_SUBJECT), (PART_TEXT, PATTERN_CONTRACT_ID_NOTICE_TEXT)],
+    }),
+    (MAIL_TYPE_CONTRACT_CONFIRMATION, re.compile(r'(?i)Vertragsverl(?:ae|ä)ngerung.*best(?:ae|ä)tig|Best(?:ae|ä)tigung.*Vertragsverl(?:ae|ä)ngerung'), {
+        'contract_id': [(PART_SUBJECT, PATTERN_CONTRACT_ID), (PART_TEXT, PATTERN_CONTRACT_ID), (PART_HTML, PATTERN_CONTRACT_ID)],
+        'extended_until': [(PART_TEXT, PATTERN_EXTENDED_UNTIL), (PART_HTML, PATTERN_EXTENDED_UNTIL)],
+    }),
+]
+
+
+class ParsedMail:
+
+    def __init__(self, uid: Optional[int], mailType: str, date: datetime, fields: Dict[str, str], messageID: Optional[str] = None):
+        self.uid = uid
+        self.mailType = mailType
+        self.date = date
+        self.messageID = messageID
+        self.pin = fields.get('pin')
+        self.customerID = fields.get('customer_id')
+        self.contractID = fields.get('contract_id')
+        self.extendedUntil = fields.get('extended_until')
+
+    def getRoutingKey(self) -> Optional[str]:
+        """ Ordnet PIN-Mails mehrerer Accounts im selben Postfach zu: Login-PIN ueber die Kundennummer, Vertragsverlaengerungs-PIN
+        ueber die Vertragsnummer. """
+        if self.mailType == MAIL_TYPE_LOGIN_PIN:
+            return self.customerID
+        return self.contractID
+
+
+class PartialMail:
+    """ Ersatz fuer eine MailMessage, von der nur die Header und ein (evtl. abgeschnittener) Teil des Inhalts geladen wurden. """
+
+    def __init__(self, headerMsg, text: str = '', html: str = ''):
+        self.uid = headerMsg.uid
+        self.subject = headerMsg.subject
+        self.date = headerMsg.date
+        self.headers = headerMsg.headers
+        self.text = text
+        self.html = html
+
+
+def getMailPartHeaders(obj: Message) -> bytes:
+    """ Die fuer das Dekodieren des Inhalts noetigen Header einer Mail (email.message.Message). """
+    headers = ''
+    for key in ('Content-Type', 'Content-Transfer-Encoding'):
+        value = obj.get(key)
+        if value is not None:
+            headers += f'{key}: {value}\r\n'
+    return (headers + '\r\n').encode('utf-8')
+
+
+def decodeMailPart(partHeaders: bytes, partBody: bytes) -> Tuple[str, str]:
+    """ Dekodiert einen einzeln geladenen Mailteil (Transfer-Encoding + Zeichensatz) und gibt (Content-Type, Text) zurueck.
+    Abgeschnittene Teile (Partial Fetch) werden so weit wie moeglich dekodiert. """
+    part = email.message_from_bytes(partHeaders + partBody)
+    if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+        # Nur vollstaendige 4er-Bloecke: Bei einem angefangenen Block gibt email sonst den undekodierten Text zurueck
+        data = PATTERN_NOT_BASE64.sub(b'', partBody)
+        payload = binascii.a2b_base64(data[:len(data) - len(data) % 4])
+    else:
+        payload = part.get_payload(decode=True) or b''
+    try:
+        text = payload.decode(part.get_content_charset() or 'utf-8', 'ignore')
+    except LookupError:
+        text = payload.decode('utf-8', 'ignore')
+    return part.get_content_type(), text
+
+
+def mailGetDate(msg) -> datetime:
+    """ Datum einer Mail, Mails ohne Zeitzone werden als UTC interpretiert. """
+    date = msg.date
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def mailGetMessageID(msg) -> Optional[str]:
+    values = msg.headers.get('message-id')
+    if not values or not values[0].strip():
+        return None
+    return values[0].strip()
+
+
+def parseMail(msg) -> Optional[ParsedMail]:
+    """ Bestimmt den Typ einer Mail (imap_tools MailMessage) und liest alle Felder dieses Typs in einem Durchlauf aus.
+    Unbekannte Mails ergeben None, fehlende Felder bleiben None (z.B. bei headers_only). """
+    subject = msg.subject
+    for mailType, subjectPattern, fieldPatterns in MAIL_TYPE_TABLE:
+        if not subjectPattern.search(subject):
+            continue
+        parts = {PART_SUBJECT: subject}
+        fields = {}
+        for field, candidates in fieldPatterns.items():
+            for part, pattern in candidates:
+                if part not in parts:
+                    parts[part] = getattr(msg, part) or ''
+                regex = pattern.search(parts[part])
+                if regex is not None:
+                    fields[field] = regex.group(1)
+                    break
+        uid = int(msg.uid) if msg.uid is not None else None
+        return ParsedMail(uid=uid, mailType=mailType, date=mailGetDate(msg), fields=fields, messageID=mailGetMessageID(msg))
+    return None
+
+
+def loadCorpus(path: str) -> list:
+    """ Alle .eml Dateien eines Ordners als imap_tools MailMessage (Tests und Benchmark, siehe tests/). """
+    from imap_tools import MailMessage
+    messages = []
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.eml'):
+            with open(os.path.join(path, filename), 'rb') as infile:
+                messages.append(MailMessage.from_bytes(infile.read()))
+    return messages
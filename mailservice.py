@@ -0,0 +1,481 @@
+import contextlib
+import imaplib
+import queue
+import select
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from imap_tools import MailBox, MailBoxUnencrypted, AND, OR, U, MailboxLoginError
+
+from metrics import metrics
+from ratelimit import scheduler, getBackoffDelay, RATE_KIND_IMAP_LOGIN
+from mailparser import parseMail, decodeMailPart, getMailPartHeaders, ParsedMail, PartialMail, MAIL_PIN_TYPES, MAIL_SEARCH_SUBJECTS, \
+    MAIL_TYPE_CONTRACT_NOTICE
+
+# PIN-Mails die aelter sind, gehoeren zu einem frueheren Versuch
+MAIL_PIN_MAX_AGE_SECONDS = 5 * 60
+# Die PIN steht am Anfang der Mail, der Rest (grosse HTML-Mails) wird nicht geladen
+MAIL_PIN_BODY_MAX_BYTES = 8 * 1024
+MAIL_WATCHED_TYPES = MAIL_PIN_TYPES + (MAIL_TYPE_CONTRACT_NOTICE,)
+# Versuche bei voruebergehenden IMAP-Fehlern (Verbindungsabbruch, Timeout), dazwischen exponentielles Backoff. Erst danach
+# scheitern wartende PIN-Abfragen bzw. Jobs
+IMAP_ATTEMPTS = 5
+# Nach anderen Fehlern (z.B. falsche Zugangsdaten) wartet der IMAP-Thread so lange, bevor er sich erneut verbindet. Die Wartezeit
+# verdoppelt sich mit jedem weiteren Fehler bis IMAP_ERROR_DELAY_MAX_SECONDS. Neue Abfragen (PIN, Jobs) versuchen es trotzdem sofort
+IMAP_ERROR_DELAY_SECONDS = 30
+IMAP_ERROR_DELAY_MAX_SECONDS = 60 * 60
+
+
+def isTransientIMAPError(e: Exception) -> bool:
+    # Falsche Zugangsdaten (MailboxLoginError) & Co. werden durch Wiederholen nicht besser
+    return isinstance(e, (imaplib.IMAP4.abort, OSError))
+
+
+def countIMAPTraffic(client: imaplib.IMAP4, mailboxLabel: str):
+    """ Zaehlt gesendete IMAP-Befehle und empfangene Bytes, indem die Methoden der imaplib-Instanz umhuellt werden. """
+    command = client._command
+    readline = client.readline
+    read = client.read
+
+    def countingCommand(*args):
+        metrics.inc('euserv_imap_commands_total', mailbox=mailboxLabel)
+        return command(*args)
+
+    def countingReadline():
+        line = readline()
+        metrics.inc('euserv_imap_bytes_total', len(line), mailbox=mailboxLabel)
+        return line
+
+    def countingRead(size):
+        data = read(size)
+        metrics.inc('euserv_imap_bytes_total', len(data), mailbox=mailboxLabel)
+        return data
+
+    client._command = countingCommand
+    client.readline = countingReadline
+    client.read = countingRead
+
+
+def hasBufferedResponse(client: imaplib.IMAP4) -> bool:
+    """ imaplib liest gepuffert: Schickt der Server direkt nach '+ idling' schon '* n EXISTS' (z.B. fuer eine Mail, die kurz vor
+    IDLE eingegangen ist), liegt das evtl. bereits im Puffer und select() auf den Socket wuerde es nie melden. """
+    sock = client.sock
+    if isinstance(sock, ssl.SSLSocket) and sock.pending() > 0:
+        return True
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return len(client.file.peek(1)) > 0
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+class PINWaiter:
+
+    def __init__(self, mailType: str, notBefore: datetime, key: Optional[str], isUsed: Optional[Callable[[int], bool]] = None):
+        self.mailType = mailType
+        self.notBefore = notBefore
+        self.key = key
+        # isUsed(uid): True fuer bereits (evtl. in einem frueheren Lauf) verwendete PIN-Mails
+        self.isUsed = isUsed
+        self.event = threading.Event()
+        self.mail: Optional[ParsedMail] = None
+        self.error: Optional[Exception] = None
+
+    def accepts(self, mail: ParsedMail) -> bool:
+        if mail.mailType != self.mailType or mail.date < self.notBefore:
+            return False
+        if self.isUsed is not None and self.isUsed(mail.uid):
+            return False
+        # Ohne Schluessel auf einer der beiden Seiten wird nach Zeitpunkt der Anfrage zugeordnet
+        mailKey = mail.getRoutingKey()
+        return self.key is None or mailKey is None or self.key == mailKey
+
+    def resolve(self, mail: Optional[ParsedMail] = None, error: Optional[Exception] = None):
+        self.mail = mail
+        self.error = error
+        self.event.set()
+
+
+class MailService:
+    """ Haelt eine einzige IMAP-Verbindung pro Postfach, ueber die alle Accounts ihre Mails abfragen.
+    Saemtliche IMAP-Befehle laufen in einem eigenen Thread: neue Mails werden einmal abgeholt (IDLE bzw. Polling, nur neue
+    UIDs) und an die jeweils wartenden PINWaiter bzw. die Listener fuer Vertragsverlaengerungs-Mails verteilt. Andere Abfragen werden per call() in diesem Thread ausgefuehrt. """
+
+    def __init__(self, server: str, login: str, password: str, port: int = 993, ssl: bool = True):
+        self.server = server
+        self.login = login
+        self.password = password
+        self.port = port
+        self.ssl = ssl
+        self.mailbox: Optional[MailBox] = None
+        self.lock = threading.Lock()
+        self.waiters: List[PINWaiter] = []
+        self.noticeListeners: List[Callable[[ParsedMail], None]] = []
+        self.unclaimedMails: List[ParsedMail] = []
+        # PIN-Art -> Enthielt die zuletzt zugeordnete PIN-Mail einen Schluessel (Kundennummer bzw. Vertrags-ID)? Bis das bekannt ist bzw.
+        # solange er fehlt, wartet per exclusivePIN immer nur ein Account auf eine PIN-Mail dieser Art
+        self.pinMailsRoutable: Dict[str, bool] = {}
+        self.pinLocks = {mailType: threading.Lock() for mailType in MAIL_PIN_TYPES}
+        self.jobs = queue.Queue()
+        # Ergebnisse von callShared: Schluessel -> (Zeitpunkt der Anfrage, Future)
+        self.sharedCalls: Dict[str, Tuple[float, Future]] = {}
+        self.lastUID: Optional[int] = None
+        self.users = 0
+        self.stopped = False
+        # Aufeinanderfolgende (voruebergehende bzw. dauerhafte) Fehler im Thread, werden nach jeder erfolgreichen Abfrage zurueckgesetzt
+        self.numberofErrors = 0
+        self.numberofFatalErrors = 0
+        self.secondsPollDelayMin = 2
+        self.secondsPollDelayMax = 30
+        self.secondsPollDelay = self.secondsPollDelayMin
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.thread = threading.Thread(target=self.loop, name=f'mailservice-{login}', daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        self.wakeWrite.send(b'x')
+
+    def call(self, function: Callable[[MailBox], object]):
+        """ Fuehrt function(mailbox) im IMAP-Thread aus (eingeloggt) und gibt das Ergebnis zurueck. """
+        future = Future()
+        self.jobs.put((function, future))
+        self.wake()
+        return future.result()
+
+    def callShared(self, key: str, function: Callable[[MailBox], object], maxAgeSeconds: float):
+        """ Wie call(), fuer Abfragen, deren Ergebnis fuer alle Accounts im Postfach gleich ist: Laeuft bereits eine Abfrage mit
+        diesem Schluessel oder ist ihr Ergebnis juenger als maxAgeSeconds, bekommt der Aufrufer dieses Ergebnis, ohne dass weitere
+        IMAP-Befehle gesendet werden. Neu eingegangene Mails verwerfen alle geteilten Ergebnisse. Das Ergebnis darf nicht veraendert werden. """
+        with self.lock:
+            shared = self.sharedCalls.get(key)
+            if shared is not None:
+                requested, future = shared
+                if future.done() and (future.exception() is not None or time.monotonic() - requested >= maxAgeSeconds):
+                    shared = None
+            if shared is None:
+                future = Future()
+                self.sharedCalls[key] = (time.monotonic(), future)
+                self.jobs.put((function, future))
+        self.wake()
+        return future.result()
+
+    def ensureLogin(self):
+        self.call(lambda mailbox: None)
+
+    def isPINMailRoutable(self, mailType: str) -> bool:
+        return self.pinMailsRoutable.get(mailType, False)
+
+    @contextlib.contextmanager
+    def exclusivePIN(self, mailType: str):
+        """ Umschliesst Anfrage und Abholen einer PIN: Ohne Schluessel in der PIN-Mail ordnet der MailService nach Zeitpunkt zu,
+        gleichzeitig wartende Accounts im selben Postfach bekaemen dann die PIN des anderen (siehe PINWaiter.accepts). Deshalb
+        nacheinander, ausser PIN-Mails dieser Art haben zuletzt einen Schluessel enthalten. """
+        if self.isPINMailRoutable(mailType):
+            yield
+            return
+        with self.pinLocks[mailType]:
+            yield
+
+    def waitForPIN(self, mailType: str, pinDescription: str, key: Optional[str] = None, secondsWaitMax: float = 1 * 60 * 60) -> str:
+        """ Wartet auf eine PIN-Mail des gegebenen Typs (MAIL_PIN_TYPES) und gibt die PIN zurueck. """
+        return self.waitForPINMail(mailType=mailType, pinDescription=pinDescription, key=key, secondsWaitMax=secondsWaitMax).pin
+
+    def waitForPINMail(self, mailType: str, pinDescription: str, key: Optional[str] = None, secondsWaitMax: float = 1 * 60 * 60,
+                       isUsed: Optional[Callable[[int], bool]] = None) -> ParsedMail:
+        """ Wie waitForPIN, gibt aber die ganze Mail zurueck. Bereits eingegangene, noch nicht zugeordnete PIN-Mails der letzten
+        Minuten werden beruecksichtigt (die neueste gewinnt), ausser isUsed(uid) kennt sie bereits. """
+        waiter = PINWaiter(mailType=mailType, notBefore=datetime.now(tz=timezone.utc) - timedelta(seconds=MAIL_PIN_MAX_AGE_SECONDS), key=key,
+                           isUsed=isUsed)
+        with self.lock:
+            mail = self.claimUnclaimedMail(waiter)
+            if mail is not None:
+                waiter.resolve(mail=mail)
+            else:
+                self.waiters.append(waiter)
+                self.secondsPollDelay = self.secondsPollDelayMin
+        self.wake()
+        print(f"Warte auf {pinDescription}")
+        if not waiter.event.wait(timeout=secondsWaitMax):
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            if not waiter.event.is_set():
+                raise Exception(f"Fatal: Timeout: {pinDescription}-Mail nicht innerhalb von {secondsWaitMax} Sekunden gefunden")
+        if waiter.error is not None:
+            raise waiter.error
+        self.pinMailsRoutable[mailType] = waiter.mail.getRoutingKey() is not None
+        print(f"{pinDescription} gefunden: {waiter.mail.pin}")
+        return waiter.mail
+
+    def claimUnclaimedMail(self, waiter: PINWaiter) -> Optional[ParsedMail]:
+        candidates = [mail for mail in self.unclaimedMails if waiter.accepts(mail)]
+        if len(candidates) == 0:
+            return None
+        if len(candidates) > 1:
+            print(f"Warnung: Es wurden mehrere ({len(candidates)}) PINs gefunden: {[mail.pin for mail in candidates]} | Es wird nur die neueste probiert")
+        mail = max(candidates, key=lambda m: m.uid)
+        self.unclaimedMails.remove(mail)
+        return mail
+
+    def dispatch(self, mails: List[ParsedMail]):
+        with self.lock:
+            self.unclaimedMails.extend(mails)
+            for waiter in list(self.waiters):
+                mail = self.claimUnclaimedMail(waiter)
+                if mail is not None:
+                    self.waiters.remove(waiter)
+                    waiter.resolve(mail=mail)
+            notBefore = datetime.now(tz=timezone.utc) - timedelta(seconds=MAIL_PIN_MAX_AGE_SECONDS)
+            self.unclaimedMails = [mail for mail in self.unclaimedMails if mail.date >= notBefore]
+
+    def addNoticeListener(self, listener: Callable[[ParsedMail], None]):
+        """ listener(mail) wird fuer jede neu eingehende Vertragsverlaengerungs-Mail aufgerufen (im IMAP-Thread, muss also schnell
+        zurueckkehren). Solange es Listener gibt, wird das Postfach dauerhaft per IDLE bzw. Polling beobachtet. """
+        with self.lock:
+            self.noticeListeners.append(listener)
+        self.wake()
+
+    def removeNoticeListener(self, listener: Callable[[ParsedMail], None]):
+        with self.lock:
+            self.noticeListeners.remove(listener)
+
+    def notifyNoticeListeners(self, mails: List[ParsedMail]):
+        with self.lock:
+            listeners = list(self.noticeListeners)
+        for mail in mails:
+            print(f"Neue Vertragsverlaengerungs-Mail fuer Vertrag {mail.contractID}")
+            for listener in listeners:
+                listener(mail)
+
+    def failAllWaiters(self, error: Exception):
+        with self.lock:
+            waiters = self.waiters
+            self.waiters = []
+        for waiter in waiters:
+            waiter.resolve(error=error)
+
+    def connect(self):
+        if self.mailbox is not None:
+            return
+        scheduler.acquire(self.server, RATE_KIND_IMAP_LOGIN)
+        if self.ssl:
+            mailbox = MailBox(self.server, self.port)
+        else:
+            # Nur fuer lokale Testserver (replayserver.py)
+            mailbox = MailBoxUnencrypted(self.server, self.port)
+        countIMAPTraffic(mailbox.client, self.login)
+        try:
+            with metrics.timer('imap_login', mailbox=self.login):
+                mailbox.login(self.login, self.password)
+        except MailboxLoginError as me:
+            print("Ungueltige Email Zugangsdaten")
+            raise me
+        self.mailbox = mailbox
+
+    def disconnect(self):
+        if self.mailbox is None:
+            return
+        try:
+            self.mailbox.logout()
+        except Exception:
+            pass
+        self.mailbox = None
+
+    def supportsIdle(self) -> bool:
+        return 'IDLE' in self.mailbox.client.capabilities
+
+    def fetchPINMailBody(self, headerMsg) -> Optional[ParsedMail]:
+        """ Laedt von einer PIN-Mail nur den ersten Body-Teil (max. MAIL_PIN_BODY_MAX_BYTES) statt der kompletten Mail.
+        Steht die PIN nicht darin (z.B. anderer Aufbau der Mail), wird doch die ganze Mail geladen. """
+        if headerMsg.obj.get_content_maintype() == 'multipart':
+            command = f'(BODY.PEEK[1.MIME] BODY.PEEK[1]<0.{MAIL_PIN_BODY_MAX_BYTES}>)'
+        else:
+            command = f'(BODY.PEEK[TEXT]<0.{MAIL_PIN_BODY_MAX_BYTES}>)'
+        fetchResult = self.mailbox.client.uid('FETCH', headerMsg.uid, command)
+        partHeaders = None
+        partBody = b''
+        if fetchResult[0] == 'OK':
+            for item in fetchResult[1]:
+                if not isinstance(item, tuple):
+                    continue
+                if b'.MIME]' in item[0]:
+                    partHeaders = item[1]
+                else:
+                    partBody = item[1]
+        if partHeaders is None:
+            # Mail ohne Unterteile: Kodierung steht im Header der Mail selbst
+            partHeaders = getMailPartHeaders(headerMsg.obj)
+        partType, partText = decodeMailPart(partHeaders, partBody)
+        if partType in ('text/plain', 'text/html'):
+            mail = parseMail(PartialMail(headerMsg, text=partText if partType == 'text/plain' else '', html=partText if partType == 'text/html' else ''))
+            if mail is not None and mail.pin is not None:
+                return mail
+        for msg in self.mailbox.fetch(mark_seen=False, uid_list=[headerMsg.uid]):
+            return parseMail(msg)
+        return None
+
+    def fetchMails(self, criteria, notBefore: Optional[datetime] = None) -> List[ParsedMail]:
+        """ Holt zuerst nur die Header aller Treffer und laedt nur fuer erkannte PIN-Mails einen Teil des Inhalts.
+        Bei Vertragsverlaengerungs-Mails steht alles Noetige im Betreff. """
+        mails = []
+        for msg in self.mailbox.fetch(mark_seen=False, criteria=criteria, headers_only=True, bulk=True):
+            uid = int(msg.uid)
+            if self.lastUID is not None and uid <= self.lastUID:
+                # 'n:*' liefert immer mindestens die letzte Mail, auch wenn deren UID kleiner n ist
+                continue
+            headerMail = parseMail(msg)
+            if headerMail is None or (notBefore is not None and headerMail.date < notBefore):
+                continue
+            if headerMail.mailType == MAIL_TYPE_CONTRACT_NOTICE and headerMail.contractID is not None:
+                mails.append(headerMail)
+                continue
+            if headerMail.mailType not in MAIL_PIN_TYPES:
+                continue
+            mail = self.fetchPINMailBody(msg)
+            if mail is None:
+                continue
+            if mail.pin is None:
+                print(f"Warnung: Konnte PIN nicht finden in Email {uid}: {msg.subject}")
+                continue
+            mails.append(mail)
+        return mails
+
+    def getHighestUID(self) -> int:
+        """ Hoechste UID, die die Suche im ausgewaehlten Ordner liefert (0 fuer einen leeren Ordner). """
+        uids = self.mailbox.uids('UID *')
+        return max((int(uid) for uid in uids), default=0)
+
+    def fetchNewMails(self) -> List[ParsedMail]:
+        # Alle PIN-Mails werden immer gemeinsam abgefragt, damit keine Mail verloren geht, auf die noch niemand wartet
+        subjectCriteria = OR(*[AND(subject=MAIL_SEARCH_SUBJECTS[mailType]) for mailType in MAIL_WATCHED_TYPES])
+        if self.lastUID is None:
+            # Erster Durchlauf: Nur Mails der letzten Minuten betrachten, danach nur noch neue UIDs. Die Ausgangs-UID kommt aus einer
+            # Suche (vor der eigentlichen Suche), nicht aus STATUS UIDNEXT: STATUS kann Mails zaehlen, die die Suche in dieser Sitzung
+            # noch nicht liefert, die waeren sonst fuer immer uebersprungen (meist genau die gerade angeforderte PIN-Mail)
+            highestUID = self.getHighestUID()
+            notBefore = datetime.now(tz=timezone.utc) - timedelta(seconds=MAIL_PIN_MAX_AGE_SECONDS)
+            mails = self.fetchMails(AND(subjectCriteria, date_gte=notBefore.date()), notBefore=notBefore)
+            self.lastUID = highestUID
+        else:
+            mails = self.fetchMails(AND(subjectCriteria, uid=U(str(self.lastUID + 1), '*')))
+        for mail in mails:
+            self.lastUID = max(self.lastUID, mail.uid)
+        return mails
+
+    def waitForActivity(self, secondsPollDelay: Optional[float]) -> None:
+        """ Blockiert bis eine neue Mail eingeht (IMAP IDLE), bis zum naechsten Poll (Server ohne IDLE) oder bis wake() aufgerufen wird. """
+        sockets = [self.wakeRead]
+        if self.mailbox is not None and self.supportsIdle():
+            self.mailbox.idle.start()
+            try:
+                # rfc2177: IDLE muss spaetestens alle 29 Minuten erneuert werden
+                if not hasBufferedResponse(self.mailbox.client):
+                    select.select(sockets + [self.mailbox.client.sock], [], [], 25 * 60)
+            finally:
+                self.mailbox.idle.stop()
+        else:
+            select.select(sockets, [], [], secondsPollDelay)
+        self.wakeRead.setblocking(False)
+        try:
+            while self.wakeRead.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            self.wakeRead.setblocking(True)
+
+    def runJobs(self):
+        while True:
+            try:
+                function, future = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            for attempt in range(IMAP_ATTEMPTS):
+                try:
+                    self.connect()
+                    future.set_result(function(self.mailbox))
+                    break
+                except Exception as e:
+                    if attempt + 1 >= IMAP_ATTEMPTS or not isTransientIMAPError(e):
+                        future.set_exception(e)
+                        break
+                    # z.B. Server hat die (lange ungenutzte) Verbindung geschlossen -> Sofort neu verbinden, danach mit Backoff
+                    self.disconnect()
+                    if attempt > 0:
+                        time.sleep(getBackoffDelay(attempt - 1))
+
+    def isWatching(self) -> bool:
+        with self.lock:
+            return len(self.waiters) > 0 or len(self.noticeListeners) > 0
+
+    def loop(self):
+        while not self.stopped:
+            try:
+                self.runJobs()
+                if not self.isWatching():
+                    self.waitForActivity(secondsPollDelay=None)
+                    continue
+                self.connect()
+                with metrics.timer('imap_fetch_new_mails', mailbox=self.login):
+                    mails = self.fetchNewMails()
+                self.numberofErrors = 0
+                self.numberofFatalErrors = 0
+                if len(mails) > 0:
+                    with self.lock:
+                        self.sharedCalls.clear()
+                self.dispatch([mail for mail in mails if mail.mailType in MAIL_PIN_TYPES])
+                self.notifyNoticeListeners([mail for mail in mails if mail.mailType == MAIL_TYPE_CONTRACT_NOTICE])
+                if self.isWatching() and self.jobs.empty():
+                    self.waitForActivity(secondsPollDelay=self.secondsPollDelay)
+                    self.secondsPollDelay = min(self.secondsPollDelay * 2, self.secondsPollDelayMax)
+            except Exception as e:
+                self.disconnect()
+                self.numberofErrors += 1
+                if isTransientIMAPError(e) and self.numberofErrors < IMAP_ATTEMPTS:
+                    delay = getBackoffDelay(self.numberofErrors - 1)
+                    print(f"Email Fehler: {e!r} -> Versuch {self.numberofErrors + 1}/{IMAP_ATTEMPTS} in {delay:.1f} Sekunden")
+                    metrics.inc('euserv_imap_retries_total', mailbox=self.login)
+                    # Ohne Verbindung wartet waitForActivity nur auf wake(), z.B. zum Beenden
+                    self.waitForActivity(secondsPollDelay=delay)
+                    continue
+                self.numberofErrors = 0
+                self.failAllWaiters(e)
+                delay = min(IMAP_ERROR_DELAY_SECONDS * 2 ** self.numberofFatalErrors, IMAP_ERROR_DELAY_MAX_SECONDS)
+                self.numberofFatalErrors += 1
+                print(f"Email Fehler: {e} -> Nächster Versuch in {delay} Sekunden")
+                metrics.inc('euserv_imap_errors_total', mailbox=self.login)
+                self.waitForActivity(secondsPollDelay=delay)
+        self.disconnect()
+
+
+mailServices: Dict[Tuple[str, int, str], MailService] = {}
+mailServicesLock = threading.Lock()
+
+
+def getMailService(server: str, login: str, password: str, port: int = 993, ssl: bool = True) -> MailService:
+    """ Liefert den gemeinsamen MailService fuer dieses Postfach. Jeder Aufruf muss mit releaseMailService beendet werden. """
+    with mailServicesLock:
+        service = mailServices.get((server, port, login))
+        if service is None:
+            service = MailService(server=server, login=login, password=password, port=port, ssl=ssl)
+            mailServices[(server, port, login)] = service
+        service.users += 1
+        return service
+
+
+def releaseMailService(service: MailService):
+    with mailServicesLock:
+        service.users -= 1
+        if service.users > 0:
+            return
+        del mailServices[(service.server, service.port, service.login)]
+        service.stopped = True
+    service.wake()
@@ -0,0 +1,109 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, TextIO, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def toLabels(**labels: str) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """ Sammelt Laufzeiten der einzelnen Phasen (Login, PIN-Warten, Verlaengerungsschritte, ...) sowie Zaehler fuer Requests und
+    Bytes. Jede beendete Phase wird optional sofort als JSON-Zeile geschrieben, am Ende koennen alle Werte im Prometheus
+    Textformat (node_exporter textfile collector) ausgegeben werden. Thread-sicher, eine Instanz fuer den ganzen Prozess. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations: Dict[Labels, Tuple[int, float]] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.jsonLog: Optional[TextIO] = None
+
+    def setJSONLog(self, path: str):
+        self.jsonLog = open(path, 'a', encoding='utf-8')
+
+    def logJSON(self, record: dict):
+        if self.jsonLog is None:
+            return
+        record = dict(time=time.time(), **record)
+        with self.lock:
+            self.jsonLog.write(json.dumps(record) + '\n')
+            self.jsonLog.flush()
+
+    def observe(self, phase: str, seconds: float, **labels: str):
+        key = toLabels(phase=phase, **labels)
+        with self.lock:
+            count, total = self.durations.get(key, (0, 0.0))
+            self.durations[key] = (count + 1, total + seconds)
+        self.logJSON(dict(event='phase', phase=phase, seconds=round(seconds, 6), **labels))
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, toLabels(**labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def getCounter(self, name: str) -> float:
+        """ Summe eines Zaehlers ueber alle Labels. """
+        with self.lock:
+            return sum(value for (counterName, _), value in self.counters.items() if counterName == name)
+
+    @contextmanager
+    def timer(self, phase: str, **labels: str):
+        """ with metrics.timer('login', account=...): misst die Dauer des Blocks, auch wenn er mit einer Exception endet. """
+        timeStarted = time.perf_counter()
+        success = 'false'
+        try:
+            yield
+            success = 'true'
+        finally:
+            self.observe(phase, time.perf_counter() - timeStarted, success=success, **labels)
+
+    def getPrometheusText(self) -> str:
+        lines = ['# HELP euserv_phase_duration_seconds Laufzeit der einzelnen Phasen.', '# TYPE euserv_phase_duration_seconds summary']
+        with self.lock:
+            durations = dict(self.durations)
+            counters = dict(self.counters)
+        for labels, (count, total) in sorted(durations.items()):
+            lines.append(f'euserv_phase_duration_seconds_sum{formatLabels(labels)} {total}')
+            lines.append(f'euserv_phase_duration_seconds_count{formatLabels(labels)} {count}')
+        for name in sorted(set(name for name, _ in counters)):
+            lines.append(f'# TYPE {name} counter')
+            for (counterName, labels), value in sorted(counters.items()):
+                if counterName == name:
+                    lines.append(f'{name}{formatLabels(labels)} {value}')
+        lines.append('# TYPE euserv_last_run_timestamp_seconds gauge')
+        lines.append(f'euserv_last_run_timestamp_seconds {time.time()}')
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self, path: str):
+        # Atomar ersetzen, damit der node_exporter nie eine halb geschriebene Datei liest
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as outfile:
+            outfile.write(self.getPrometheusText())
+        os.replace(tmppath, path)
+
+
+def formatLabels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+metrics = MetricsRegistry()
+
+
+def timedMethod(phase: str):
+    """ Decorator fuer Methoden von Objekten mit Attribut 'account': Misst jeden Aufruf als Phase dieses Accounts. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with metrics.timer(phase, account=self.account):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
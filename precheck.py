@@ -0,0 +1,133 @@
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from statestore import CONTRACT_OUTCOME_EXTENDED, CONTRACT_OUTCOME_NOT_ON_ACCOUNT
+
+""" Schnelle Vorpruefung ohne pydantic, httpx und imap_tools. Ein Lauf endet ohne Aktion, wenn
+- alle bisher verlaengerten Vertraege des Accounts noch in ihrer Sperre nach der Verlaengerung sind (siehe getNextAttemptDate) und jede
+  Vertragsverlaengerungs-Mail aus dem letzten Scan bearbeitet ist bzw. zu einem dieser Vertraege gehoert (der uebliche taegliche Lauf
+  nach einer Verlaengerung). Neue Mails zu diesen Vertraegen wuerden ohnehin uebersprungen, oder
+- der vollstaendige Login nach Captcha/Fehlschlag gesperrt ist und es keine Session gibt.
+Dafuer reichen die Account-ID aus der Config und wenige Eintraege aus der SQLite-Datenbank. """
+
+PATH_CONFIG = os.path.join('config.json')
+MIN_DAYS_UNTIL_NEXT_ATTEMPT = 3
+# Nach einem Login mit Captcha bzw. fehlgeschlagenem Login wird so lange kein neuer Login versucht (Circuit Breaker). Die Pause nach
+# fehlgeschlagenen Logins verdoppelt sich mit jedem weiteren Fehlschlag bis LOGIN_BACKOFF_MAX_HOURS
+LOGIN_BACKOFF_CAPTCHA_HOURS = 24
+LOGIN_BACKOFF_FAILED_MINUTES = 30
+LOGIN_BACKOFF_MAX_HOURS = 24
+# Eintraege aus account_state (siehe StateStore), die fuer die Vorpruefung gebraucht werden
+PRECHECK_STATE_KEYS = ('last_date_login_attempt_failed', 'last_date_login_attempt_failed_captcha', 'login_failures', 'extended_contracts',
+                       'mail_scan_state')
+# Ergebnisse einer Vertragsverlaengerungs-Mail, nach denen sie nicht erneut bearbeitet wird
+NOTICE_HANDLED_OUTCOMES = (CONTRACT_OUTCOME_EXTENDED, CONTRACT_OUTCOME_NOT_ON_ACCOUNT)
+
+
+def getNoticeKey(messageID: Optional[str], uid: Optional[int]) -> str:
+    """ Schluessel einer Vertragsverlaengerungs-Mail im Verlauf: Die Message-ID, nur falls sie fehlt die UID. """
+    if messageID is not None:
+        return messageID
+    return f'uid:{uid}'
+
+
+def getNextAttemptDate(lastDateExtendedContract: Optional[datetime]) -> Optional[datetime]:
+    """ Frühester Zeitpunkt für den nächsten Verlängerungsversuch eines Vertrags oder None, wenn sofort ein Versuch erlaubt ist. """
+    if lastDateExtendedContract is None:
+        return None
+    nextAttempt = lastDateExtendedContract + timedelta(days=MIN_DAYS_UNTIL_NEXT_ATTEMPT + 1)
+    if nextAttempt <= datetime.now(tz=timezone.utc):
+        return None
+    return nextAttempt
+
+
+def getLoginBlockedUntil(lastFailed: Optional[datetime], lastFailedCaptcha: Optional[datetime], numberofFailures: int) -> Optional[datetime]:
+    """ Bis wann kein neuer Login versucht werden soll oder None, wenn ein Login erlaubt ist. """
+    blockedUntil = []
+    if lastFailedCaptcha is not None:
+        blockedUntil.append(lastFailedCaptcha + timedelta(hours=LOGIN_BACKOFF_CAPTCHA_HOURS))
+    if lastFailed is not None:
+        minutes = LOGIN_BACKOFF_FAILED_MINUTES * 2 ** max(numberofFailures - 1, 0)
+        blockedUntil.append(lastFailed + timedelta(minutes=min(minutes, LOGIN_BACKOFF_MAX_HOURS * 60)))
+    if len(blockedUntil) == 0 or max(blockedUntil) <= datetime.now(tz=timezone.utc):
+        return None
+    return max(blockedUntil)
+
+
+def getContractsBlockedUntil(values: Dict[str, Any], noticeOutcomes: Dict[str, str]) -> Optional[datetime]:
+    """ Ende der ersten Sperre, wenn alle verlaengerten Vertraege (extended_contracts) gesperrt sind und keine Mail aus dem letzten
+    Scan (mail_scan_state) offen ist, sonst None. noticeOutcomes: Schluessel der Mail -> letztes Ergebnis aus contract_history. """
+    extendedContracts = {contractID: parseDate(value) for contractID, value in values.get('extended_contracts', {}).items()}
+    nextAttempts = [getNextAttemptDate(date) for date in extendedContracts.values()]
+    if len(nextAttempts) == 0 or None in nextAttempts:
+        return None
+    for scanState in values.get('mail_scan_state', {}).values():
+        for notice in scanState.get('notices', []):
+            if notice['contract_id'] in extendedContracts:
+                continue
+            if noticeOutcomes.get(getNoticeKey(notice.get('message_id'), notice['uid'])) not in NOTICE_HANDLED_OUTCOMES:
+                return None
+    return min(nextAttempts)
+
+
+def parseDate(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def loadAccountID(configpath: str) -> str:
+    with open(configpath, encoding='utf-8') as infile:
+        return json.load(infile)['euserv_mail_or_user_id']
+
+
+def loadPrecheckState(statepath: str, account: str) -> Tuple[Dict[str, Any], bool, Dict[str, str]]:
+    """ Liest nur PRECHECK_STATE_KEYS, ob eine Session gespeichert ist und die Ergebnisse der Mails aus dem letzten Scan. Die Datenbank
+    wird nur lesend geoeffnet: Kein Anlegen von Tabellen, kein Umstellen auf WAL und keine Sperre fuer gleichzeitig schreibende Prozesse. """
+    connection = sqlite3.connect(f'file:{statepath}?mode=ro', uri=True)
+    try:
+        rows = connection.execute(f'SELECT key, value FROM account_state WHERE account = ? AND key IN ({", ".join("?" * len(PRECHECK_STATE_KEYS))})',
+                                  (account,) + PRECHECK_STATE_KEYS).fetchall()
+        # Eine ungueltige Session wird als null gespeichert
+        hasSession = connection.execute("SELECT 1 FROM account_state WHERE account = ? AND key = 'session' AND value != 'null'",
+                                        (account,)).fetchone() is not None
+        values = {key: json.loads(value) for key, value in rows}
+        noticeKeys = [getNoticeKey(notice.get('message_id'), notice['uid']) for scanState in values.get('mail_scan_state', {}).values()
+                      for notice in scanState.get('notices', [])]
+        noticeOutcomes = {}
+        if len(noticeKeys) > 0:
+            # Aelteste zuerst -> Das letzte Ergebnis pro Mail gewinnt
+            noticeOutcomes = dict(connection.execute(f'SELECT notice_key, outcome FROM contract_history WHERE account = ? AND notice_key IN '
+                                                     f'({", ".join("?" * len(noticeKeys))}) ORDER BY time', [account] + noticeKeys).fetchall())
+    finally:
+        connection.close()
+    return values, hasSession, noticeOutcomes
+
+
+def getNoActionReason(configpath: str, statepath: str) -> Optional[Tuple[datetime, str]]:
+    """ Gibt (naechster erlaubter Versuch, Grund) zurueck, wenn fuer diesen Account sicher nichts zu tun ist (siehe oben), sonst None.
+    Im Zweifel (kaputte Config, noch kein Status in der Datenbank, ...) None, dann entscheidet der normale Lauf. """
+    if not os.path.exists(statepath):
+        return None
+    try:
+        account = loadAccountID(configpath)
+        values, hasSession, noticeOutcomes = loadPrecheckState(statepath, account)
+        contractsBlockedUntil = getContractsBlockedUntil(values, noticeOutcomes)
+        if contractsBlockedUntil is not None:
+            return contractsBlockedUntil, 'Alle Verträge erst vor kurzem verlängert, keine offene Vertragsverlaengerungs-Mail'
+        if hasSession:
+            # Login ueber gespeicherte Cookies ist auch waehrend der Sperre erlaubt
+            return None
+        loginBlockedUntil = getLoginBlockedUntil(parseDate(values.get('last_date_login_attempt_failed')),
+                                                 parseDate(values.get('last_date_login_attempt_failed_captcha')), values.get('login_failures', 0))
+        if loginBlockedUntil is not None:
+            return loginBlockedUntil, 'Login nach fehlgeschlagenem Login/Captcha pausiert'
+    except Exception:
+        return None
+    return None
@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from metrics import metrics
+
+""" Gemeinsame Drosselung aller Requests eines Prozesses: Ein Token-Bucket pro (Host, Art des Requests). Logins bekommen einen
+eigenen, deutlich langsameren Bucket, damit ein Lauf ueber viele Accounts nicht die Login-Sperre von EUserv ausloest.
+Meldet der Server eine Ueberlastung (429/503), wird die Rate des Buckets halbiert und erholt sich danach mit jeder erfolgreichen
+Antwort schrittweise wieder (AIMD). """
+
+RATE_KIND_HTTP = 'http'
+RATE_KIND_LOGIN = 'login'
+RATE_KIND_IMAP_LOGIN = 'imap_login'
+# Art des Requests -> (Requests pro Sekunde, Burst)
+RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    RATE_KIND_HTTP: (20.0, 20),
+    RATE_KIND_LOGIN: (1.0, 5),
+    RATE_KIND_IMAP_LOGIN: (1.0, 3),
+}
+# Untergrenze beim Drosseln (Anteil der Basisrate) und Erholung pro erfolgreicher Antwort (Anteil der Basisrate)
+RATE_MIN_FACTOR = 0.05
+RATE_RECOVERY_FACTOR = 0.1
+# Exponentielles Backoff: Zufaellige Wartezeit zwischen 0 und BACKOFF_BASE_SECONDS * 2^Versuch, hoechstens BACKOFF_MAX_SECONDS
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+
+def getBackoffDelay(attempt: int, base: float = BACKOFF_BASE_SECONDS, maximum: float = BACKOFF_MAX_SECONDS) -> float:
+    """ Wartezeit vor Wiederholung Nummer attempt (ab 0) mit "full jitter", damit wiederholende Clients nicht gleichzeitig anfragen. """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int):
+        self.baseRate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """ Nimmt einen Token und gibt zurueck, wie viele Sekunden vor dem Request gewartet werden muss (0 = sofort). Der Stand darf
+        negativ werden, so bekommen gleichzeitig Wartende nacheinander ihren Zeitpunkt zugeteilt. """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            delay = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(delay, self.pausedUntil - now)
+
+    def throttle(self, pauseSeconds: Optional[float] = None):
+        """ Server ist ueberlastet: Rate halbieren und evtl. (Retry-After) eine Zeit lang gar nicht anfragen. """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.rate = max(self.baseRate * RATE_MIN_FACTOR, self.rate / 2)
+            if pauseSeconds is not None:
+                self.pausedUntil = max(self.pausedUntil, now + pauseSeconds)
+
+    def recover(self):
+        if self.rate >= self.baseRate:
+            return
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = min(self.baseRate, self.rate + self.baseRate * RATE_RECOVERY_FACTOR)
+
+
+class RequestScheduler:
+    """ Verwaltet die Token-Buckets, eine Instanz fuer den ganzen Prozess (siehe scheduler). Thread-sicher. """
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]] = RATE_LIMITS):
+        self.limits = limits
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def getBucket(self, host: str, kind: str = RATE_KIND_HTTP) -> TokenBucket:
+        with self.lock:
+            bucket = self.buckets.get((host, kind))
+            if bucket is None:
+                rate, burst = self.limits[kind]
+                bucket = TokenBucket(rate, burst)
+                self.buckets[(host, kind)] = bucket
+            return bucket
+
+    def reserve(self, host: str, kind: str = RATE_KIND_HTTP) -> float:
+        """ Wie TokenBucket.reserve: Der Aufrufer wartet selbst (siehe acquire bzw. EuservClient.request). """
+        delay = self.getBucket(host, kind).reserve()
+        if delay > 0:
+            metrics.inc('euserv_ratelimit_wait_seconds_total', delay, host=host, kind=kind)
+        return delay
+
+    def acquire(self, host: str, kind: str = RATE_KIND_HTTP):
+        """ Blockiert, bis ein Request dieser Art an diesen Host erlaubt ist. """
+        delay = self.reserve(host, kind)
+        if delay > 0:
+            time.sleep(delay)
+
+
+scheduler = RequestScheduler()
@@ -0,0 +1,735 @@
+import argparse
+import email
+import email.policy
+import http.server
+import json
+import os
+import random
+import re
+import secrets
+import select
+import socketserver
+import string
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+""" Lokale Nachbildung von EUserv Kundencenter (HTTP) und Postfach (IMAP) fuer Tests und Benchmarks ohne echten Account.
+Die Antworten des Kundencenters kommen aus fixtures/euserv, die Mails aus fixtures/mails. Fordert das Script eine PIN an, legt
+der HTTP-Server die passende PIN-Mail (nach mailDelay Sekunden) im Postfach des Accounts ab, genau wie EUserv. Beide Server
+koennen jede Anfrage kuenstlich verzoegern (latency), um echte Netzwerklaufzeiten nachzustellen. """
+
+PATH_FIXTURES_MAILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mails')
+PATH_FIXTURES_EUSERV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'euserv')
+# Werte in den Fixture-Mails, die beim Erzeugen neuer Mails ersetzt werden
+FIXTURE_CUSTOMER_ID = '123456'
+FIXTURE_LOGIN_PIN = '482913'
+FIXTURE_CONTRACT_ID = '445566'
+FIXTURE_CONTRACT_PIN = '905118'
+EXTEND_CONTRACT_PREFIX = 'kc2_customer_contract_details_extend_contract_'
+# Kleinstes gueltiges PNG, Inhalt ist egal
+LOGO_PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                         '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+
+def loadTemplate(name: str) -> string.Template:
+    with open(os.path.join(PATH_FIXTURES_EUSERV, name), encoding='utf-8') as infile:
+        return string.Template(infile.read())
+
+
+def toCRLF(raw: bytes) -> bytes:
+    return re.sub(rb'\r?\n', b'\r\n', raw)
+
+
+def buildMail(fixtureName: str, replacements: Dict[str, str], date: datetime) -> bytes:
+    """ Neue Mail auf Basis einer Fixture-Mail: Ersetzt die Fixture-Werte (PIN, Kundennummer, ...) sowie Datum und Message-ID. """
+    with open(os.path.join(PATH_FIXTURES_MAILS, fixtureName), 'rb') as infile:
+        raw = infile.read()
+    for old, new in replacements.items():
+        raw = raw.replace(old.encode(), new.encode())
+    raw = re.sub(rb'(?m)^Date: .*$', b'Date: ' + format_datetime(date).encode(), raw, count=1)
+    raw = re.sub(rb'(?m)^Message-ID: .*$', b'Message-ID: <' + secrets.token_hex(8).encode() + b'@replay.euserv.de>', raw, count=1)
+    return toCRLF(raw)
+
+
+class ReplayMessage:
+
+    def __init__(self, uid: int, raw: bytes, internalDate: datetime):
+        self.uid = uid
+        self.raw = raw
+        self.internalDate = internalDate
+        self.flags: List[str] = []
+        self.obj = email.message_from_bytes(raw)
+
+    def getSection(self, section: str) -> bytes:
+        """ Inhalt von BODY[section] nach rfc3501 (Teilmenge: '', HEADER, TEXT, n, n.MIME, n.n, ...). """
+        section = section.upper()
+        if section == '':
+            return self.raw
+        if section == 'HEADER':
+            return splitHeader(self.raw)[0]
+        if section == 'TEXT':
+            return splitHeader(self.raw)[1]
+        path = section.split('.')
+        suffix = None
+        if path[-1] in ('MIME', 'HEADER', 'TEXT'):
+            suffix = path.pop()
+        part = self.obj
+        for number in path:
+            if not part.is_multipart():
+                # Mails ohne Unterteile haben nur Teil 1 = der Inhalt
+                if number != '1':
+                    return b''
+                return splitHeader(self.raw)[1]
+            subparts = part.get_payload()
+            index = int(number) - 1
+            if index < 0 or index >= len(subparts):
+                return b''
+            part = subparts[index]
+        header, body = splitHeader(part.as_bytes(policy=email.policy.compat32.clone(linesep='\r\n')))
+        if suffix in ('MIME', 'HEADER'):
+            return header
+        return body
+
+
+def splitHeader(raw: bytes) -> Tuple[bytes, bytes]:
+    position = raw.find(b'\r\n\r\n')
+    if position == -1:
+        return raw, b''
+    return raw[:position + 4], raw[position + 4:]
+
+
+class ReplayMailbox:
+    """ Ein Postfach mit nur einem Ordner (INBOX). """
+
+    def __init__(self):
+        self.uidvalidity = random.randint(1, 2 ** 31 - 1)
+        self.nextUID = 1
+        self.messages: List[ReplayMessage] = []
+        self.lock = threading.Lock()
+
+    def append(self, raw: bytes, internalDate: Optional[datetime] = None) -> int:
+        with self.lock:
+            uid = self.nextUID
+            self.nextUID += 1
+            self.messages.append(ReplayMessage(uid, toCRLF(raw), internalDate or datetime.now(tz=timezone.utc)))
+            return uid
+
+    def getMessages(self) -> List[ReplayMessage]:
+        with self.lock:
+            return list(self.messages)
+
+
+class ReplayMailStore:
+    """ Alle Postfaecher beider Server, Postfaecher werden beim ersten Login automatisch angelegt. """
+
+    def __init__(self, seedPath: Optional[str] = None):
+        self.seedPath = seedPath
+        self.mailboxes: Dict[str, ReplayMailbox] = {}
+        self.lock = threading.Lock()
+
+    def getMailbox(self, login: str) -> ReplayMailbox:
+        with self.lock:
+            mailbox = self.mailboxes.get(login)
+            if mailbox is None:
+                mailbox = ReplayMailbox()
+                if self.seedPath is not None:
+                    seedMailbox(mailbox, self.seedPath)
+                self.mailboxes[login] = mailbox
+            return mailbox
+
+    def deliver(self, login: str, raw: bytes, delaySeconds: float = 0):
+        if delaySeconds <= 0:
+            self.getMailbox(login).append(raw)
+            return
+        timer = threading.Timer(delaySeconds, self.getMailbox(login).append, args=(raw,))
+        timer.daemon = True
+        timer.start()
+
+
+def seedMailbox(mailbox: ReplayMailbox, path: str):
+    """ Legt alle .eml Dateien des Ordners im Postfach ab, Eingangsdatum ist das Datum der Mail. """
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith('.eml'):
+            continue
+        with open(os.path.join(path, filename), 'rb') as infile:
+            raw = infile.read()
+        date = email.message_from_bytes(raw).get('Date')
+        mailbox.append(raw, parsedate_to_datetime(date) if date else None)
+
+
+def tokenizeIMAP(line: str) -> list:
+    """ Zerlegt Argumente eines IMAP-Befehls in Atome, Strings und (verschachtelte) Listen. [...] gehoert zum Atom. """
+    stack: List[list] = [[]]
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if char == ' ':
+            i += 1
+        elif char == '(':
+            stack.append([])
+            i += 1
+        elif char == ')':
+            inner = stack.pop()
+            stack[-1].append(inner)
+            i += 1
+        elif char == '"':
+            value = ''
+            i += 1
+            while i < len(line) and line[i] != '"':
+                if line[i] == '\\':
+                    i += 1
+                value += line[i]
+                i += 1
+            stack[-1].append(value)
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < len(line) and (depth > 0 or line[i] not in ' ()"'):
+                if line[i] == '[':
+                    depth += 1
+                elif line[i] == ']':
+                    depth -= 1
+                i += 1
+            stack[-1].append(line[start:i])
+    return stack[0]
+
+
+def parseSequenceSet(sequenceSet: str, maxValue: int) -> Callable[[int], bool]:
+    """ '1:*', '5', '3,4,9:10' -> Pruefunktion. Wie bei echten Servern enthaelt 'n:*' auch bei n > max den groessten Wert. """
+    ranges = []
+    for item in sequenceSet.split(','):
+        bounds = [maxValue if bound == '*' else int(bound) for bound in item.split(':')]
+        ranges.append((min(bounds), max(bounds)))
+    return lambda value: any(low <= value <= high for low, high in ranges)
+
+
+SearchPredicate = Callable[[int, ReplayMessage], bool]
+
+
+def parseSearchKeys(tokens: list, maxUID: int, maxSeq: int) -> SearchPredicate:
+    predicates = []
+    i = 0
+    while i < len(tokens):
+        predicate, i = parseSearchKey(tokens, i, maxUID, maxSeq)
+        predicates.append(predicate)
+    return lambda seq, msg: all(predicate(seq, msg) for predicate in predicates)
+
+
+def parseSearchKey(tokens: list, i: int, maxUID: int, maxSeq: int) -> Tuple[SearchPredicate, int]:
+    token = tokens[i]
+    if isinstance(token, list):
+        return parseSearchKeys(token, maxUID, maxSeq), i + 1
+    key = token.upper()
+    if key == 'ALL':
+        return (lambda seq, msg: True), i + 1
+    if key == 'OR':
+        left, i = parseSearchKey(tokens, i + 1, maxUID, maxSeq)
+        right, i = parseSearchKey(tokens, i, maxUID, maxSeq)
+        return (lambda seq, msg: left(seq, msg) or right(seq, msg)), i
+    if key == 'NOT':
+        inner, i = parseSearchKey(tokens, i + 1, maxUID, maxSeq)
+        return (lambda seq, msg: not inner(seq, msg)), i
+    if key in ('SUBJECT', 'FROM', 'TO'):
+        value = tokens[i + 1].lower()
+        return (lambda seq, msg: value in str(msg.obj.get(key, '')).lower()), i + 2
+    if key in ('SINCE', 'BEFORE', 'ON'):
+        date = datetime.strptime(tokens[i + 1], '%d-%b-%Y').date()
+        compare = {'SINCE': lambda d: d >= date, 'BEFORE': lambda d: d < date, 'ON': lambda d: d == date}[key]
+        return (lambda seq, msg: compare(msg.internalDate.astimezone(timezone.utc).date())), i + 2
+    if key in ('SEEN', 'UNSEEN'):
+        return (lambda seq, msg: ('\\Seen' in msg.flags) == (key == 'SEEN')), i + 1
+    if key == 'UID':
+        contains = parseSequenceSet(tokens[i + 1], maxUID)
+        return (lambda seq, msg: contains(msg.uid)), i + 2
+    if re.fullmatch(r'[\d*:,]+', key):
+        contains = parseSequenceSet(key, maxSeq)
+        return (lambda seq, msg: contains(seq)), i + 1
+    raise ValueError(f'Unbekanntes Suchkriterium {token}')
+
+
+PATTERN_FETCH_BODY = re.compile(r'(?i)^(BODY(?:\.PEEK)?|BINARY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)\.(\d+)>)?$')
+
+
+class ReplayIMAPHandler(socketserver.StreamRequestHandler):
+    """ Eine IMAP-Verbindung. Unterstuetzt genau das, was imap_tools/imaplib und mailservice.py verwenden. """
+
+    server: 'ReplayIMAPServer'
+
+    def setup(self):
+        super().setup()
+        self.mailbox: Optional[ReplayMailbox] = None
+        self.selected = False
+        # Anzahl Mails, die dem Client zuletzt gemeldet wurde
+        self.knownCount = 0
+
+    def send(self, line: str):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+
+    def handle(self):
+        self.send('* OK [CAPABILITY IMAP4rev1 IDLE] Replay IMAP bereit')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if line == '':
+                continue
+            tag, _, rest = line.partition(' ')
+            command, _, arguments = rest.partition(' ')
+            command = command.upper()
+            self.server.countCommand()
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+            try:
+                if not self.handleCommand(tag, command, tokenizeIMAP(arguments)):
+                    return
+            except Exception as e:
+                self.send(f'{tag} BAD {e}')
+            self.wfile.flush()
+
+    def handleCommand(self, tag: str, command: str, arguments: list) -> bool:
+        if command == 'CAPABILITY':
+            self.send('* CAPABILITY IMAP4rev1 IDLE')
+        elif command == 'NOOP':
+            pass
+        elif command == 'LOGOUT':
+            self.send('* BYE Replay IMAP beendet')
+            self.send(f'{tag} OK LOGOUT completed')
+            return False
+        elif command == 'LOGIN':
+            self.mailbox = self.server.store.getMailbox(arguments[0])
+        elif self.mailbox is None:
+            self.send(f'{tag} NO Nicht eingeloggt')
+            return True
+        elif command in ('SELECT', 'EXAMINE'):
+            if arguments[0].upper() != 'INBOX':
+                self.send(f'{tag} NO Ordner existiert nicht')
+                return True
+            self.selected = True
+            self.knownCount = len(self.mailbox.getMessages())
+            self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+            self.send(f'* {self.knownCount} EXISTS')
+            self.send('* 0 RECENT')
+            self.send(f'* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid')
+            self.send(f'* OK [UIDNEXT {self.mailbox.nextUID}] Predicted next UID')
+            self.send(f'{tag} OK [{"READ-ONLY" if command == "EXAMINE" else "READ-WRITE"}] {command} completed')
+            return True
+        elif command == 'STATUS':
+            messages = self.mailbox.getMessages()
+            values = {'MESSAGES': len(messages), 'RECENT': 0, 'UIDNEXT': self.mailbox.nextUID, 'UIDVALIDITY': self.mailbox.uidvalidity,
+                      'UNSEEN': len([msg for msg in messages if '\\Seen' not in msg.flags])}
+            items = ' '.join(f'{item} {values[item.upper()]}' for item in arguments[1])
+            self.send(f'* STATUS "{arguments[0]}" ({items})')
+        elif command == 'UID' and self.selected:
+            subcommand = arguments[0].upper()
+            if subcommand == 'SEARCH':
+                self.search(arguments[1:], byUID=True)
+            elif subcommand == 'FETCH':
+                self.fetch(arguments[1], arguments[2], byUID=True)
+            else:
+                self.send(f'{tag} BAD UID {subcommand} nicht unterstuetzt')
+                return True
+        elif command == 'SEARCH' and self.selected:
+            self.search(arguments, byUID=False)
+        elif command == 'FETCH' and self.selected:
+            self.fetch(arguments[0], arguments[1], byUID=False)
+        elif command == 'IDLE' and self.selected:
+            self.idle(tag)
+            return True
+        else:
+            self.send(f'{tag} BAD {command} nicht unterstuetzt')
+            return True
+        self.send(f'{tag} OK {command} completed')
+        return True
+
+    def search(self, arguments: list, byUID: bool):
+        if len(arguments) >= 2 and isinstance(arguments[0], str) and arguments[0].upper() == 'CHARSET':
+            arguments = arguments[2:]
+        messages = self.mailbox.getMessages()
+        maxUID = messages[-1].uid if len(messages) > 0 else 0
+        predicate = parseSearchKeys(arguments, maxUID, len(messages))
+        results = [str(msg.uid if byUID else seq) for seq, msg in enumerate(messages, start=1) if predicate(seq, msg)]
+        self.send('* SEARCH' + ''.join(' ' + result for result in results))
+
+    def fetch(self, sequenceSet: str, items, byUID: bool):
+        if not isinstance(items, list):
+            items = [items]
+        messages = self.mailbox.getMessages()
+        maxValue = (messages[-1].uid if byUID else len(messages)) if len(messages) > 0 else 0
+        contains = parseSequenceSet(sequenceSet, maxValue)
+        for seq, msg in enumerate(messages, start=1):
+            if contains(msg.uid if byUID else seq):
+                self.fetchMessage(seq, msg, [item.upper() for item in items], byUID)
+
+    def fetchMessage(self, seq: int, msg: ReplayMessage, items: List[str], byUID: bool):
+        # Wie die meisten Server: Einfache Werte zuerst, Literale am Ende (imap_tools sucht die UID vor dem ersten Literal)
+        simple = []
+        literals: List[Tuple[str, bytes]] = []
+        if byUID and 'UID' not in items:
+            items = ['UID'] + items
+        for item in items:
+            bodyRegex = PATTERN_FETCH_BODY.match(item)
+            if item == 'UID':
+                simple.append(f'UID {msg.uid}')
+            elif item == 'FLAGS':
+                simple.append(f'FLAGS ({" ".join(msg.flags)})')
+            elif item == 'RFC822.SIZE':
+                simple.append(f'RFC822.SIZE {len(msg.raw)}')
+            elif item == 'INTERNALDATE':
+                simple.append(f'INTERNALDATE "{msg.internalDate.strftime("%d-%b-%Y %H:%M:%S %z")}"')
+            elif item in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+                literals.append((item, msg.getSection({'RFC822': '', 'RFC822.HEADER': 'HEADER', 'RFC822.TEXT': 'TEXT'}[item])))
+            elif bodyRegex is not None:
+                name, section, start, count = bodyRegex.groups()
+                data = msg.getSection(section)
+                key = f'BODY[{section}]'
+                if start is not None:
+                    data = data[int(start):int(start) + int(count)]
+                    key += f'<{start}>'
+                literals.append((key, data))
+                if '.PEEK' not in name and '\\Seen' not in msg.flags:
+                    msg.flags.append('\\Seen')
+            else:
+                raise ValueError(f'FETCH {item} nicht unterstuetzt')
+        response = f'* {seq} FETCH (' + ' '.join(simple)
+        if len(literals) == 0:
+            self.send(response + ')')
+            return
+        self.wfile.write(response.encode('utf-8'))
+        for index, (key, data) in enumerate(literals):
+            separator = ' ' if index > 0 or len(simple) > 0 else ''
+            self.wfile.write(f'{separator}{key} {{{len(data)}}}\r\n'.encode('utf-8') + data)
+        self.wfile.write(b')\r\n')
+
+    def idle(self, tag: str):
+        """ Meldet neue Mails per '* n EXISTS', bis der Client DONE schickt. Wie Dovecot werden Mails, die seit der letzten
+        Meldung eingegangen sind, direkt nach '+ idling' gemeldet (im selben Paket). """
+        count = len(self.mailbox.getMessages())
+        if count != self.knownCount:
+            self.send('+ idling\r\n* ' + str(count) + ' EXISTS')
+        else:
+            self.send('+ idling')
+        self.wfile.flush()
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+                continue
+            newCount = len(self.mailbox.getMessages())
+            if newCount != count:
+                count = newCount
+                self.send(f'* {count} EXISTS')
+                self.wfile.flush()
+        self.knownCount = count
+        self.send(f'{tag} OK IDLE terminated')
+
+
+class ReplayIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], store: ReplayMailStore, latency: float = 0):
+        super().__init__(address, ReplayIMAPHandler)
+        self.store = store
+        self.latency = latency
+        self.commandCount = 0
+        self.lock = threading.Lock()
+
+    def countCommand(self):
+        with self.lock:
+            self.commandCount += 1
+
+
+class ReplayAccount:
+
+    def __init__(self, email: str, password: str, customerID: str, contractIDs: List[str], imapLogin: str):
+        self.email = email
+        self.password = password
+        self.customerID = customerID
+        self.contractIDs = contractIDs
+        self.imapLogin = imapLogin
+
+
+class ReplaySession:
+    """ Serverseitiger Zustand eines PHPSESSID-Cookies. """
+
+    def __init__(self):
+        self.sess_id: Optional[str] = None
+        self.activated = False
+        self.account: Optional[ReplayAccount] = None
+        self.loginPIN: Optional[str] = None
+        self.loggedIn = False
+        self.openedContractID: Optional[str] = None
+        # Vertrags-ID -> angeforderte PIN, Token -> Vertrags-ID
+        self.contractPINs: Dict[str, str] = {}
+        self.tokens: Dict[str, str] = {}
+
+
+class ReplayEuservHandler(http.server.BaseHTTPRequestHandler):
+    server: 'ReplayEuservServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def getSession(self) -> Tuple[str, ReplaySession]:
+        cookieRegex = re.search(r'PHPSESSID=([0-9a-f]+)', self.headers.get('Cookie', ''))
+        with self.server.lock:
+            if cookieRegex is not None and cookieRegex.group(1) in self.server.sessions:
+                return cookieRegex.group(1), self.server.sessions[cookieRegex.group(1)]
+            phpsessid = secrets.token_hex(16)
+            session = ReplaySession()
+            self.server.sessions[phpsessid] = session
+            return phpsessid, session
+
+    def respond(self, phpsessid: str, body: str, contentType: str = 'text/html; charset=utf-8', status: int = 200):
+        self.respondBytes(phpsessid, body.encode('utf-8'), contentType, status)
+
+    def respondBytes(self, phpsessid: str, body: bytes, contentType: str, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        if phpsessid:
+            self.send_header('Set-Cookie', f'PHPSESSID={phpsessid}; path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def beginRequest(self) -> Optional[Tuple[str, ReplaySession]]:
+        """ None, wenn der Request mit einem simulierten Fehler (429) beantwortet wurde. """
+        self.server.countRequest()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if self.server.errorRate > 0 and random.random() < self.server.errorRate:
+            self.server.countError()
+            self.respondBytes('', b'Too Many Requests', 'text/plain', status=429)
+            return None
+        return self.getSession()
+
+    def do_GET(self):
+        begun = self.beginRequest()
+        if begun is None:
+            return
+        phpsessid, session = begun
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.endswith('/pic/logo_small.png'):
+            session.activated = True
+            self.respondBytes(phpsessid, LOGO_PNG, 'image/png')
+            return
+        if not url.path.endswith('/index.iphp'):
+            self.respond(phpsessid, 'Not found', 'text/plain', status=404)
+            return
+        if 'sess_id' not in query or session.sess_id is None:
+            session.sess_id = secrets.token_hex(16)
+            session.activated = False
+        if query.get('sess_id', session.sess_id) != session.sess_id or not session.loggedIn:
+            self.respond(phpsessid, self.server.render('index.html', sess_id=session.sess_id))
+        elif query.get('show_contract_extension') == '1' and query.get('ord_id') in session.account.contractIDs:
+            session.openedContractID = query['ord_id']
+            self.respond(phpsessid, self.server.render('contract_details.html', sess_id=session.sess_id, contract_id=query['ord_id']))
+        else:
+            self.respond(phpsessid, self.server.renderMainpage(session))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        begun = self.beginRequest()
+        if begun is None:
+            return
+        phpsessid, session = begun
+        subaction = form.get('subaction')
+        if form.get('sess_id') not in (session.sess_id, phpsessid):
+            # Login-Formulare schicken die sess_id, die Verlaengerungs-Requests dagegen den Wert des PHPSESSID-Cookies
+            self.respond(phpsessid, self.server.render('login_failed.html', sess_id=session.sess_id or ''))
+        elif subaction == 'login' and 'pin' in form:
+            if session.loginPIN is not None and form['pin'] == session.loginPIN and form.get('c_id') == session.account.customerID:
+                session.loggedIn = True
+                session.loginPIN = None
+                self.respond(phpsessid, self.server.renderMainpage(session))
+            else:
+                self.respond(phpsessid, self.server.render('login_failed.html', sess_id=session.sess_id))
+        elif subaction == 'login':
+            account = self.server.accounts.get(form.get('email'))
+            if account is None or account.password != form.get('password') or not session.activated:
+                self.respond(phpsessid, self.server.render('login_failed.html', sess_id=session.sess_id))
+                return
+            session.account = account
+            session.loginPIN = f'{random.randint(0, 999999):06d}'
+            self.server.deliverMail(account, 'login_pin.eml', {FIXTURE_CUSTOMER_ID: self.server.getPINMailKey(account.customerID), FIXTURE_LOGIN_PIN: session.loginPIN})
+            self.respond(phpsessid, self.server.render('login_pin.html', sess_id=session.sess_id, customer_id=account.customerID))
+        elif not session.loggedIn:
+            self.respond(phpsessid, self.server.render('login_failed.html', sess_id=session.sess_id))
+        elif subaction == 'show_kc2_security_password_dialog' and session.openedContractID is not None:
+            contractID = session.openedContractID
+            if self.server.singlePendingPIN:
+                # Wie ein Server, der mit jeder neuen Anfrage alle vorherigen PINs verwirft
+                session.contractPINs.clear()
+            session.contractPINs[contractID] = f'{random.randint(0, 999999):06d}'
+            self.server.deliverMail(session.account, 'contract_extend_pin.eml', {FIXTURE_CONTRACT_ID: self.server.getPINMailKey(contractID), FIXTURE_CONTRACT_PIN: session.contractPINs[contractID]})
+            self.respond(phpsessid, self.server.render('security_password_dialog.html'))
+        elif subaction == 'kc2_security_password_get_token':
+            contractID = form.get('ident', '')[len(EXTEND_CONTRACT_PREFIX):]
+            if contractID in session.contractPINs and session.contractPINs[contractID] == form.get('auth'):
+                del session.contractPINs[contractID]
+                token = secrets.token_hex(16)
+                session.tokens[token] = contractID
+                self.respond(phpsessid, self.server.render('security_password_get_token.json', token=token), 'application/json')
+            else:
+                self.respond(phpsessid, self.server.render('security_password_get_token_failed.json'), 'application/json')
+        elif subaction == 'kc2_customer_contract_details_get_extend_contract_confirmation_dialog' and form.get('token') in session.tokens:
+            self.respond(phpsessid, self.server.render('extend_contract_confirmation_dialog.json', contract_id=session.tokens[form['token']],
+                                                       extended_until=self.server.getExtendedUntil()), 'application/json')
+        elif subaction == 'kc2_customer_contract_details_extend_contract_term' and session.tokens.get(form.get('token')) == form.get('ord_id'):
+            contractID = session.tokens.pop(form['token'])
+            self.server.recordExtension(session.account, contractID)
+            self.respond(phpsessid, self.server.render('extend_contract_term.html', extended_until=self.server.getExtendedUntil()))
+        else:
+            self.respond(phpsessid, 'Ungueltige Anfrage', 'text/plain', status=400)
+
+
+class ReplayEuservServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], store: ReplayMailStore, latency: float = 0, mailDelay: float = 0,
+                 singlePendingPIN: bool = False, errorRate: float = 0, unroutablePINs: bool = False, verbose: bool = False):
+        super().__init__(address, ReplayEuservHandler)
+        self.store = store
+        self.latency = latency
+        self.mailDelay = mailDelay
+        self.singlePendingPIN = singlePendingPIN
+        # PIN-Mails ohne Kundennummer bzw. Vertrags-ID (koennen im gemeinsamen Postfach keinem Account zugeordnet werden)
+        self.unroutablePINs = unroutablePINs
+        # Anteil der Requests, die mit 429 abgewiesen werden (testet Wiederholungen und Drosselung des Clients)
+        self.errorRate = errorRate
+        self.verbose = verbose
+        self.accounts: Dict[str, ReplayAccount] = {}
+        self.sessions: Dict[str, ReplaySession] = {}
+        self.templates: Dict[str, string.Template] = {}
+        # (E-Mail, Vertrags-ID) jeder abgeschlossenen Verlaengerung
+        self.extensions: List[Tuple[str, str]] = []
+        self.requestCount = 0
+        self.errorCount = 0
+        self.lock = threading.Lock()
+
+    def addAccount(self, account: ReplayAccount):
+        self.accounts[account.email] = account
+
+    def getPINMailKey(self, key: str) -> str:
+        return '' if self.unroutablePINs else key
+
+    def countRequest(self):
+        with self.lock:
+            self.requestCount += 1
+
+    def countError(self):
+        with self.lock:
+            self.errorCount += 1
+
+    def recordExtension(self, account: ReplayAccount, contractID: str):
+        with self.lock:
+            self.extensions.append((account.email, contractID))
+
+    def render(self, templateName: str, **values: str) -> str:
+        template = self.templates.get(templateName)
+        if template is None:
+            template = loadTemplate(templateName)
+            self.templates[templateName] = template
+        return template.safe_substitute(**values)
+
+    def renderMainpage(self, session: ReplaySession) -> str:
+        contracts = ''.join(self.render('mainpage_contract.html', sess_id=session.sess_id, contract_id=contractID)
+                            for contractID in session.account.contractIDs)
+        return self.render('mainpage.html', sess_id=session.sess_id, customer_id=session.account.customerID, contracts=contracts)
+
+    def getExtendedUntil(self) -> str:
+        return (datetime.now(tz=timezone.utc) + timedelta(days=30)).strftime('%d.%m.%Y')
+
+    def deliverMail(self, account: ReplayAccount, fixtureName: str, replacements: Dict[str, str]):
+        raw = buildMail(fixtureName, replacements, datetime.now(tz=timezone.utc))
+        self.store.deliver(account.imapLogin, raw, self.mailDelay)
+
+
+class ReplayEnvironment:
+    """ Startet beide Server auf freien lokalen Ports in Hintergrund-Threads. """
+
+    def __init__(self, httpLatency: float = 0, imapLatency: float = 0, mailDelay: float = 0, seedPath: Optional[str] = None,
+                 singlePendingPIN: bool = False, httpErrorRate: float = 0, unroutablePINs: bool = False, host: str = '127.0.0.1', httpPort: int = 0,
+                 imapPort: int = 0, verbose: bool = False):
+        self.store = ReplayMailStore(seedPath)
+        self.httpServer = ReplayEuservServer((host, httpPort), self.store, latency=httpLatency, mailDelay=mailDelay,
+                                             singlePendingPIN=singlePendingPIN, errorRate=httpErrorRate, unroutablePINs=unroutablePINs, verbose=verbose)
+        self.imapServer = ReplayIMAPServer((host, imapPort), self.store, latency=imapLatency)
+        self.host = host
+        self.threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in (self.httpServer, self.imapServer)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        for server in (self.httpServer, self.imapServer):
+            server.shutdown()
+            server.server_close()
+
+    def getBaseURL(self) -> str:
+        return f'http://{self.host}:{self.httpServer.server_address[1]}/'
+
+    def addAccount(self, number: int, sharedMailbox: bool = False, contractsPerAccount: int = 1) -> dict:
+        """ Legt einen Account samt Vertraegen und Vertragsverlaengerungs-Mails an und gibt die passende Config zurueck. """
+        email = f'kunde{number}@example.org'
+        contractIDs = [str(400000 + number * 100 + index) for index in range(contractsPerAccount)]
+        imapLogin = 'postfach@example.org' if sharedMailbox else email
+        account = ReplayAccount(email=email, password=secrets.token_hex(8), customerID=str(100000 + number), contractIDs=contractIDs,
+                                imapLogin=imapLogin)
+        self.httpServer.addAccount(account)
+        for contractID in contractIDs:
+            self.store.getMailbox(imapLogin).append(buildMail('contract_notice.eml', {FIXTURE_CONTRACT_ID: contractID}, datetime.now(tz=timezone.utc)))
+        return {
+            'imap_server': self.host,
+            'imap_port': self.imapServer.server_address[1],
+            'imap_ssl': False,
+            'imap_login': imapLogin,
+            'imap_password': 'replay',
+            'euserv_mail_or_user_id': email,
+            'euserv_password': account.password,
+            'euserv_base_url': self.getBaseURL(),
+        }
+
+
+if __name__ == '__main__':
+    """ Startet beide Server dauerhaft und schreibt fuer jeden Account eine Config, z.B. fuer: main.py -c replay_account1.json """
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('-n', '--accounts', help='Anzahl Accounts.', type=int, default=1)
+    my_parser.add_argument('--contracts', help='Vertraege pro Account.', type=int, default=1)
+    my_parser.add_argument('--http-port', help='Port des EUserv-Servers.', type=int, default=8080)
+    my_parser.add_argument('--imap-port', help='Port des IMAP-Servers.', type=int, default=1143)
+    my_parser.add_argument('--http-latency', help='Verzoegerung pro HTTP-Request in Sekunden.', type=float, default=0)
+    my_parser.add_argument('--imap-latency', help='Verzoegerung pro IMAP-Befehl in Sekunden.', type=float, default=0)
+    my_parser.add_argument('--mail-delay', help='Sekunden bis eine angeforderte PIN-Mail im Postfach liegt.', type=float, default=1)
+    my_parser.add_argument('--seed', help='Ordner mit .eml Dateien, die in jedem Postfach liegen.', default=PATH_FIXTURES_MAILS)
+    my_parser.add_argument('--shared-mailbox', help='Alle Accounts teilen sich ein Postfach.', action='store_true')
+    my_parser.add_argument('--single-pending-pin', help='Neue PIN-Anfrage verwirft alle vorherigen PINs.', action='store_true')
+    my_parser.add_argument('--http-error-rate', help='Anteil der HTTP-Requests, die mit 429 abgewiesen werden.', type=float, default=0)
+    my_parser.add_argument('--unroutable-pins', help='PIN-Mails ohne Kundennummer bzw. Vertrags-ID.', action='store_true')
+    args = my_parser.parse_args()
+
+    environment = ReplayEnvironment(httpLatency=args.http_latency, imapLatency=args.imap_latency, mailDelay=args.mail_delay, seedPath=args.seed,
+                                    singlePendingPIN=args.single_pending_pin, httpErrorRate=args.http_error_rate, unroutablePINs=args.unroutable_pins, httpPort=args.http_port, imapPort=args.imap_port, verbose=True)
+    for number in range(1, args.accounts + 1):
+        configpath = f'replay_account{number}.json'
+        with open(configpath, 'w', encoding='utf-8') as outfile:
+            json.dump(environment.addAccount(number, sharedMailbox=args.shared_mailbox, contractsPerAccount=args.contracts), outfile, indent=2)
+        print(f'Config geschrieben: {configpath}')
+    print(f'EUserv: {environment.getBaseURL()} | IMAP: {environment.host}:{environment.imapServer.server_address[1]} | Beenden mit Strg+C')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        environment.close()
@@ -0,0 +1,176 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+PATH_STATE = 'state.sqlite'
+# Eintraege in history und contract_history, die aelter sind, werden geloescht
+HISTORY_RETENTION_DAYS = 400
+# So lange gilt eine bereits verwendete PIN-Mail (UID) als verbraucht. UIDs koennen sich nach einem Neuaufbau des Ordners
+# wiederholen, eine PIN-Mail ist aber ohnehin nur wenige Minuten gueltig
+PIN_MAIL_USED_SECONDS = 24 * 60 * 60
+CONTRACT_OUTCOME_EXTENDED = 'extended'
+CONTRACT_OUTCOME_FAILED = 'failed'
+# Kein Verlaengerungs-Link auf der Startseite des Accounts und ein anderer Account im selben Postfach hat den Vertrag bereits verlaengert
+CONTRACT_OUTCOME_NOT_ON_ACCOUNT = 'not_on_account'
+
+
+class StateStore:
+    """ Laufzeit-Status und Verlauf aller Accounts in einer SQLite-Datenbank (WAL-Modus).
+    Jeder Schluessel eines Accounts ist eine eigene Zeile und wird einzeln per Transaktion geschrieben, so koennen mehrere
+    Prozesse/Threads gleichzeitig schreiben, ohne sich gegenseitig Aenderungen zu ueberschreiben. Schluessel mit einem Eintrag pro
+    Vertrag bzw. Ordner werden per mergeMany eintragsweise geschrieben.
+    Jeder Account bekommt seine eigene Instanz. Sie darf nacheinander von verschiedenen Threads verwendet werden (Daemon). """
+
+    def __init__(self, path: str = PATH_STATE):
+        self.path = path
+        # isolation_level=None -> Transaktionen werden explizit gestartet
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS account_state (account TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                                'updated REAL NOT NULL, PRIMARY KEY (account, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT NOT NULL, '
+                                'time REAL NOT NULL, event TEXT NOT NULL, details TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS history_account_time ON history (account, time)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS history_time ON history (time)')
+        # Ergebnis pro Vertragsverlaengerungs-Mail (notice_key = Message-ID), schneller Zugriff ueber Primaerschluessel und Indizes
+        self.connection.execute('CREATE TABLE IF NOT EXISTS contract_history (account TEXT NOT NULL, notice_key TEXT NOT NULL, '
+                                'contract_id TEXT NOT NULL, time REAL NOT NULL, outcome TEXT NOT NULL, extended_until TEXT, pin_uid INTEGER, '
+                                'seconds REAL, attempts INTEGER NOT NULL, error TEXT, PRIMARY KEY (account, notice_key, contract_id))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS contract_history_contract ON contract_history (account, contract_id, time)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS contract_history_pin_uid ON contract_history (account, pin_uid)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS contract_history_time ON contract_history (time)')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def getAll(self, account: str) -> Dict[str, Any]:
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM account_state WHERE account = ?', (account,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def get(self, account: str, key: str, default: Any = None) -> Any:
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM account_state WHERE account = ? AND key = ?', (account, key)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def setMany(self, account: str, values: Dict[str, Any]):
+        """ Schreibt nur die uebergebenen Schluessel, alle in einer Transaktion. """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('INSERT INTO account_state (account, key, value, updated) VALUES (?, ?, ?, ?) '
+                                            'ON CONFLICT (account, key) DO UPDATE SET value = excluded.value, updated = excluded.updated',
+                                            [(account, key, json.dumps(value), now) for key, value in values.items()])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def mergeMany(self, account: str, values: Dict[str, Dict[str, Any]], removed: Optional[Dict[str, List[str]]] = None) -> Dict[str, Dict[str, Any]]:
+        """ Fuer Schluessel, deren Wert ein dict ist (z.B. ein Eintrag pro Vertrag): Setzt bzw. entfernt (removed) nur die uebergebenen
+        Eintraege, Lesen und Schreiben in einer Transaktion. Eintraege, die ein anderer Prozess inzwischen geschrieben hat, bleiben so
+        erhalten. Gibt die zusammengefuehrten Werte zurueck. """
+        removed = removed or {}
+        now = time.time()
+        merged = {}
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for key in set(values) | set(removed):
+                    row = self.connection.execute('SELECT value FROM account_state WHERE account = ? AND key = ?', (account, key)).fetchone()
+                    value = json.loads(row[0]) if row is not None else {}
+                    value.update(values.get(key, {}))
+                    for entry in removed.get(key, []):
+                        value.pop(entry, None)
+                    merged[key] = value
+                self.connection.executemany('INSERT INTO account_state (account, key, value, updated) VALUES (?, ?, ?, ?) '
+                                            'ON CONFLICT (account, key) DO UPDATE SET value = excluded.value, updated = excluded.updated',
+                                            [(account, key, json.dumps(value), now) for key, value in merged.items()])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return merged
+
+    def addHistory(self, account: str, event: str, details: Optional[dict] = None):
+        with self.lock:
+            self.connection.execute('INSERT INTO history (account, time, event, details) VALUES (?, ?, ?, ?)',
+                                    (account, time.time(), event, json.dumps(details or {})))
+
+    def getHistory(self, account: str, limit: int = 50) -> List[dict]:
+        with self.lock:
+            rows = self.connection.execute('SELECT time, event, details FROM history WHERE account = ? ORDER BY time DESC LIMIT ?',
+                                           (account, limit)).fetchall()
+        return [{'time': row[0], 'event': row[1], 'details': json.loads(row[2])} for row in rows]
+
+    def setContractResult(self, account: str, contractID: str, noticeKeys: List[str], outcome: str, extendedUntil: Optional[str] = None,
+                          pinUID: Optional[int] = None, seconds: Optional[float] = None, error: Optional[str] = None):
+        """ Speichert das Ergebnis eines Vertrags fuer alle zugehoerigen Vertragsverlaengerungs-Mails. Weitere Versuche zur selben
+        Mail ueberschreiben das Ergebnis und erhoehen attempts. """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('INSERT INTO contract_history (account, notice_key, contract_id, time, outcome, extended_until, pin_uid, '
+                                            'seconds, attempts, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?) '
+                                            'ON CONFLICT (account, notice_key, contract_id) DO UPDATE SET time = excluded.time, '
+                                            'outcome = excluded.outcome, extended_until = excluded.extended_until, pin_uid = excluded.pin_uid, '
+                                            'seconds = excluded.seconds, attempts = attempts + 1, error = excluded.error',
+                                            [(account, noticeKey, contractID, now, outcome, extendedUntil, pinUID, seconds, error) for noticeKey in noticeKeys])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def getNoticeOutcome(self, account: str, noticeKey: str) -> Optional[str]:
+        """ Ergebnis der Vertragsverlaengerung zu dieser Mail oder None, wenn sie noch nicht bearbeitet wurde. """
+        with self.lock:
+            row = self.connection.execute('SELECT outcome FROM contract_history WHERE account = ? AND notice_key = ? ORDER BY time DESC LIMIT 1',
+                                          (account, noticeKey)).fetchone()
+        return row[0] if row is not None else None
+
+    def hasExtendedContract(self, account: str, contractID: str) -> bool:
+        """ True, wenn dieser Account den Vertrag bereits einmal verlaengert hat (Verlauf pro Mail bzw. extended_contracts). """
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM contract_history WHERE account = ? AND contract_id = ? AND outcome = ? LIMIT 1',
+                                          (account, contractID, CONTRACT_OUTCOME_EXTENDED)).fetchone()
+        return row is not None or contractID in self.get(account, 'extended_contracts', {})
+
+    def isPINMailUsed(self, account: str, uid: int) -> bool:
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM contract_history WHERE account = ? AND pin_uid = ? AND time >= ? LIMIT 1',
+                                          (account, uid, time.time() - PIN_MAIL_USED_SECONDS)).fetchone()
+        return row is not None
+
+    def getContractHistory(self, account: str, contractID: Optional[str] = None, limit: int = 50) -> List[dict]:
+        columns = ['notice_key', 'contract_id', 'time', 'outcome', 'extended_until', 'pin_uid', 'seconds', 'attempts', 'error']
+        query = f'SELECT {", ".join(columns)} FROM contract_history WHERE account = ?'
+        parameters = [account]
+        if contractID is not None:
+            query += ' AND contract_id = ?'
+            parameters.append(contractID)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY time DESC LIMIT ?', parameters + [limit]).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def expireHistory(self, retentionDays: float = HISTORY_RETENTION_DAYS) -> int:
+        """ Loescht Verlaufseintraege aller Accounts, die aelter als retentionDays sind, und gibt deren Anzahl zurueck. """
+        cutoff = time.time() - retentionDays * 24 * 60 * 60
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                deleted = self.connection.execute('DELETE FROM history WHERE time < ?', (cutoff,)).rowcount
+                deleted += self.connection.execute('DELETE FROM contract_history WHERE time < ?', (cutoff,)).rowcount
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return deleted
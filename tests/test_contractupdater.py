@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from contractupdater import ContractUpdater, runAccounts
+from replayserver import ReplayEnvironment
+from statestore import StateStore, CONTRACT_OUTCOME_FAILED
+
+
+@pytest.fixture
+def environment():
+    environment = ReplayEnvironment()
+    yield environment
+    environment.close()
+
+
+def writeConfigs(environment: ReplayEnvironment, tmp_path, numberofAccounts: int, sharedMailbox: bool = False):
+    configpaths = []
+    for number in range(1, numberofAccounts + 1):
+        configpath = tmp_path / f'account{number}.json'
+        configpath.write_text(json.dumps(environment.addAccount(number, sharedMailbox=sharedMailbox)), encoding='utf-8')
+        configpaths.append(str(configpath))
+    return configpaths
+
+
+def test_missing_extension_link_is_retried(environment, tmp_path):
+    """ Ein Account, ein Postfach: Fehlt der Link, ist das ein Fehler und der naechste Lauf versucht es erneut. """
+    configpaths = writeConfigs(environment, tmp_path, 1)
+    statepath = str(tmp_path / 'state.sqlite')
+    account = environment.httpServer.accounts['kunde1@example.org']
+    account.contractIDs = []
+    assert runAccounts(configpaths, statepath, testLogins=False, maxWorkers=1) == 1
+    updater = ContractUpdater(configpaths[0], statepath)
+    try:
+        assert updater.statestore.getContractHistory(updater.account)[0]['outcome'] == CONTRACT_OUTCOME_FAILED
+    finally:
+        updater.close()
+    account.contractIDs = ['400100']
+    assert runAccounts(configpaths, statepath, testLogins=False, maxWorkers=1) == 0
+    assert environment.httpServer.extensions == [('kunde1@example.org', '400100')]
+
+
+def test_contract_of_other_account_in_shared_mailbox(environment, tmp_path):
+    configpaths = writeConfigs(environment, tmp_path, 2, sharedMailbox=True)
+    statepath = str(tmp_path / 'state.sqlite')
+    # kunde1 kommt zuerst dran: 400200 hat noch niemand verlaengert -> Fehler. kunde2 ueberspringt 400100, das kunde1 gerade verlaengert hat
+    assert runAccounts(configpaths, statepath, testLogins=False, maxWorkers=1) == 1
+    assert sorted(environment.httpServer.extensions) == [('kunde1@example.org', '400100'), ('kunde2@example.org', '400200')]
+    # Jetzt gehoert 400200 nachweislich kunde2 -> Beide Accounts sind erfolgreich, ohne weitere Verlaengerung
+    assert runAccounts(configpaths, statepath, testLogins=False, maxWorkers=1) == 0
+    assert len(environment.httpServer.extensions) == 2
+
+
+def test_shared_mailbox_without_routing_keys(tmp_path):
+    """ PIN-Mails ohne Kundennummer/Vertrags-ID: Gleichzeitige Accounts duerfen nicht die PIN des anderen bekommen. """
+    environment = ReplayEnvironment(unroutablePINs=True)
+    try:
+        configpaths = writeConfigs(environment, tmp_path, 4, sharedMailbox=True)
+        statepath = str(tmp_path / 'state.sqlite')
+        runAccounts(configpaths, statepath, testLogins=False, maxWorkers=4)
+        assert sorted(environment.httpServer.extensions) == [(f'kunde{number}@example.org', f'400{number}00') for number in range(1, 5)]
+        statestore = StateStore(statepath)
+        try:
+            assert all(statestore.get(f'kunde{number}@example.org', 'login_failures') == 0 for number in range(1, 5))
+        finally:
+            statestore.close()
+    finally:
+        environment.close()
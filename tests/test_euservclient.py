@@ -0,0 +1,53 @@
+import pytest
+
+from euservclient import PageReader, stepsOpenSession
+from euservparser import PATTERN_SESS_ID, findSessionID
+
+SESS_ID = '0123456789abcdef0123456789abcdef'
+PAGE = '<html><a href="index.iphp?sess_id=' + SESS_ID + '&amp;action=login">Login</a>' + 'x' * 1000 + '</html>'
+
+
+def readPage(reader: PageReader, chunks) -> PageReader:
+    """ Wie EuservClient.requestOnce, nur ohne Netz. """
+    for chunk in chunks:
+        if reader.feed(chunk):
+            break
+    else:
+        reader.finish()
+    return reader
+
+
+def test_sess_id_split_across_every_position():
+    start = PAGE.index(SESS_ID)
+    for split in range(start - 8, start + len(SESS_ID) + 2):
+        reader = readPage(PageReader(stopPattern=PATTERN_SESS_ID), [PAGE[:split], PAGE[split:]])
+        assert reader.match is not None
+        assert reader.match.group(1) == SESS_ID
+        assert findSessionID(reader.getText()) == SESS_ID
+
+
+def test_sess_id_single_char_chunks():
+    reader = readPage(PageReader(stopPattern=PATTERN_SESS_ID), list(PAGE))
+    assert reader.match.group(1) == SESS_ID
+    # Gelesen wird nur bis kurz hinter den Treffer
+    assert reader.length < PAGE.index(SESS_ID) + len(SESS_ID) + 2
+
+
+def test_sess_id_at_end_of_response():
+    page = 'index.iphp?sess_id=' + SESS_ID
+    reader = readPage(PageReader(stopPattern=PATTERN_SESS_ID), [page[:-4], page[-4:]])
+    assert reader.match.group(1) == SESS_ID
+
+
+def test_open_session_uses_complete_sess_id():
+    steps = stepsOpenSession()
+    url, data, reader = next(steps)
+    assert data is None
+    split = PAGE.index(SESS_ID) + 5
+    url, data, reader = steps.send(readPage(reader, [PAGE[:split], PAGE[split:]]))
+    assert url == 'pic/logo_small.png'
+    url, data, reader = steps.send(reader)
+    assert url.endswith('sess_id=' + SESS_ID)
+    with pytest.raises(StopIteration) as stop:
+        steps.send(reader)
+    assert stop.value.value == SESS_ID
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+from imap_tools import MailMessage
+
+import euservclient
+from euservclient import EuservClient
+from euservparser import isLoggedInEuserv, isPINRequired, isExtensionConfirmed, findCustomerID, findExtendedUntil, \
+    findContractExtensionURLs, findContractExtensionURL
+from mailparser import parseMail, MAIL_TYPE_LOGIN_PIN, MAIL_TYPE_CONTRACT_EXTEND_PIN
+from replayserver import ReplayEuservServer, ReplayMailStore, ReplayAccount
+
+EMAIL = 'kunde1@example.org'
+PASSWORD = 'geheim'
+CUSTOMER_ID = '100001'
+CONTRACT_IDS = ['400100', '400101']
+
+
+@pytest.fixture
+def server():
+    server = ReplayEuservServer(('127.0.0.1', 0), ReplayMailStore())
+    server.addAccount(ReplayAccount(email=EMAIL, password=PASSWORD, customerID=CUSTOMER_ID, contractIDs=list(CONTRACT_IDS), imapLogin=EMAIL))
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server, tmp_path):
+    client = EuservClient(str(tmp_path / 'cookies.txt'), baseURL=f'http://127.0.0.1:{server.server_address[1]}/', account=EMAIL)
+    yield client
+    client.close()
+
+
+def getLastPIN(server: ReplayEuservServer, mailType: str) -> str:
+    """ Die PIN-Mail liegt ohne mailDelay sofort im Postfach des Accounts. """
+    mails = [parseMail(MailMessage.from_bytes(message.raw)) for message in server.store.getMailbox(EMAIL).getMessages()]
+    return [mail for mail in mails if mail is not None and mail.mailType == mailType][-1].pin
+
+
+def login(server: ReplayEuservServer, client: EuservClient) -> str:
+    sess_id = client.openSession()
+    html = client.submitCredentials(sess_id, EMAIL, PASSWORD)
+    assert isPINRequired(html)
+    customerID = findCustomerID(html)
+    assert customerID == CUSTOMER_ID
+    html = client.submitPIN(sess_id, customerID, getLastPIN(server, MAIL_TYPE_LOGIN_PIN))
+    assert isLoggedInEuserv(html)
+    return sess_id
+
+
+def test_login_and_extend_all_contracts(server, client):
+    sess_id = login(server, client)
+    phpsessid = client.getCookie('PHPSESSID')
+    assert phpsessid is not None
+    # Login per gespeicherter Session (wie ContractUpdater.loginEuserv mit Cookies)
+    html = client.openMainpage(sess_id)
+    assert isLoggedInEuserv(html)
+    extensionURLs = findContractExtensionURLs(html)
+    for contractID in CONTRACT_IDS:
+        client.requestExtensionPIN(phpsessid, findContractExtensionURL(extensionURLs, contractID))
+        parsedJson = client.submitExtensionPIN(phpsessid, contractID, getLastPIN(server, MAIL_TYPE_CONTRACT_EXTEND_PIN))
+        assert parsedJson['rs'] == 'success'
+        token = parsedJson['token']['value']
+        extendedUntil = findExtendedUntil(client.getExtensionConfirmationDialog(phpsessid, token))
+        assert extendedUntil is not None
+        assert isExtensionConfirmed(client.confirmExtension(phpsessid, contractID, token))
+    assert server.extensions == [(EMAIL, contractID) for contractID in CONTRACT_IDS]
+
+
+def test_wrong_pin_is_rejected(server, client):
+    login(server, client)
+    phpsessid = client.getCookie('PHPSESSID')
+    html = client.openPage('index.iphp?sess_id=' + server.sessions[phpsessid].sess_id)
+    client.requestExtensionPIN(phpsessid, findContractExtensionURL(findContractExtensionURLs(html), CONTRACT_IDS[0]))
+    assert client.submitExtensionPIN(phpsessid, CONTRACT_IDS[0], '000000')['rs'] != 'success'
+    assert server.extensions == []
+
+
+def test_wrong_password(server, client):
+    sess_id = client.openSession()
+    html = client.submitCredentials(sess_id, EMAIL, 'falsch')
+    assert not isPINRequired(html)
+    assert not isLoggedInEuserv(html)
+
+
+def test_cookies_survive_new_client(server, client, tmp_path):
+    sess_id = login(server, client)
+    client.saveCookies()
+    otherClient = EuservClient(str(tmp_path / 'cookies.txt'), baseURL=client.baseURL, account=EMAIL)
+    try:
+        assert otherClient.hasCookies()
+        assert isLoggedInEuserv(otherClient.openMainpage(sess_id))
+    finally:
+        otherClient.close()
+
+
+def test_retry_after_429(server, client, monkeypatch):
+    server.errorRate = 1.0
+
+    def getBackoffDelay(attempt: int) -> float:
+        # Erster Versuch wurde mit 429 abgewiesen -> Der naechste geht durch
+        server.errorRate = 0
+        return 0
+
+    monkeypatch.setattr(euservclient, 'getBackoffDelay', getBackoffDelay)
+    assert client.openSession() is not None
+    assert server.errorCount == 1
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+from imap_tools import MailMessage
+
+from mailparser import parseMail, decodeMailPart, MAIL_TYPE_LOGIN_PIN, MAIL_TYPE_CONTRACT_EXTEND_PIN, MAIL_TYPE_CONTRACT_NOTICE, \
+    MAIL_TYPE_CONTRACT_CONFIRMATION
+
+PATH_FIXTURES_MAILS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'mails')
+
+
+def loadMail(filename: str) -> MailMessage:
+    with open(os.path.join(PATH_FIXTURES_MAILS, filename), 'rb') as infile:
+        return MailMessage.from_bytes(infile.read())
+
+
+# Datei -> (Typ, PIN, Kundennummer, Vertrags-ID, verlaengert bis)
+EXPECTED = {
+    'login_pin.eml': (MAIL_TYPE_LOGIN_PIN, '482913', '123456', None, None),
+    'login_pin_forwarded.eml': (MAIL_TYPE_LOGIN_PIN, '771204', '123456', None, None),
+    'contract_extend_pin.eml': (MAIL_TYPE_CONTRACT_EXTEND_PIN, '905118', None, '445566', None),
+    'contract_extend_pin_forwarded.eml': (MAIL_TYPE_CONTRACT_EXTEND_PIN, '310877', None, '445566', None),
+    'contract_notice.eml': (MAIL_TYPE_CONTRACT_NOTICE, None, None, '445566', None),
+    'contract_notice_forwarded.eml': (MAIL_TYPE_CONTRACT_NOTICE, None, None, '778899', None),
+    'contract_confirmation.eml': (MAIL_TYPE_CONTRACT_CONFIRMATION, None, None, '445566', '17.04.2027'),
+}
+
+
+def test_corpus_is_covered():
+    filenames = {filename for filename in os.listdir(PATH_FIXTURES_MAILS) if filename.endswith('.eml')}
+    assert filenames == set(EXPECTED) | {'unrelated.eml'}
+
+
+@pytest.mark.parametrize('filename', sorted(EXPECTED))
+def test_parse_fixture(filename):
+    mailType, pin, customerID, contractID, extendedUntil = EXPECTED[filename]
+    mail = parseMail(loadMail(filename))
+    assert mail is not None
+    assert mail.mailType == mailType
+    assert mail.pin == pin
+    assert mail.customerID == customerID
+    assert mail.contractID == contractID
+    assert mail.extendedUntil == extendedUntil
+    assert mail.messageID == '<' + filename[:-len('.eml')] + '@fixture.euserv.de>'
+    assert mail.date.tzinfo is not None
+
+
+def test_unrelated_mail_is_ignored():
+    assert parseMail(loadMail('unrelated.eml')) is None
+
+
+def test_routing_keys():
+    assert parseMail(loadMail('login_pin.eml')).getRoutingKey() == '123456'
+    assert parseMail(loadMail('contract_extend_pin.eml')).getRoutingKey() == '445566'
+
+
+@pytest.mark.parametrize('cut', range(0, 8))
+def test_decode_truncated_base64_part(cut):
+    # Partial Fetch (BODY.PEEK[1]<0.n>) schneidet base64 an beliebiger Stelle ab, auch mitten in einem Block oder Zeilenumbruch
+    partHeaders = b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+    partBody = b'UElOOgo5MDUx\r\nMTgKSWhyIEVV\r\nc2VydiBUZWFt\r\n'
+    partType, text = decodeMailPart(partHeaders, partBody[:len(partBody) - cut])
+    assert partType == 'text/plain'
+    assert text.startswith('PIN:\n905118')
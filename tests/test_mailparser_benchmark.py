@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+from mailparser import parseMail, loadCorpus
+
+pytest.importorskip('pytest_benchmark')
+
+PATH_FIXTURES_MAILS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'mails')
+
+
+def parseCorpus(corpus: list) -> int:
+    return sum(1 for msg in corpus if parseMail(msg) is not None)
+
+
+def test_parse_throughput(benchmark):
+    """ Durchsatz in Mails/s = extra_info['mails'] / Mittelwert. Text-/HTML-Teile sind nach dem ersten Durchlauf gecached
+    (imap_tools cached_property) -> gemessen werden nur Klassifizierung und Extraktion. """
+    corpus = loadCorpus(PATH_FIXTURES_MAILS)
+    benchmark.extra_info['mails'] = len(corpus)
+    assert benchmark(parseCorpus, corpus) == len(corpus) - 1
@@ -0,0 +1,117 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from imap_tools.folder import MailBoxFolderManager
+
+import contractupdater
+from contractupdater import ContractUpdater
+from replayserver import ReplayEnvironment, buildMail, FIXTURE_CONTRACT_ID
+
+
+@pytest.fixture
+def environment():
+    environment = ReplayEnvironment()
+    yield environment
+    environment.close()
+
+
+@pytest.fixture
+def updater(environment, tmp_path, monkeypatch):
+    # Jede Suche soll den Server fragen, die Tests liefern Mails an der IMAP-Verbindung vorbei ein
+    monkeypatch.setattr(contractupdater, 'MAIL_NOTICE_SCAN_SHARE_SECONDS', 0)
+    configpath = tmp_path / 'account1.json'
+    configpath.write_text(json.dumps(environment.addAccount(1)), encoding='utf-8')
+    updater = ContractUpdater(str(configpath), str(tmp_path / 'state.sqlite'))
+    yield updater
+    updater.close()
+
+
+def deliverNotice(environment: ReplayEnvironment, contractID: str) -> int:
+    return environment.store.getMailbox('kunde1@example.org').append(buildMail('contract_notice.eml', {FIXTURE_CONTRACT_ID: contractID},
+                                                                               datetime.now(tz=timezone.utc)))
+
+
+def test_incremental_scan_without_duplicates(environment, updater):
+    assert [notice.contract_id for notice in updater.mailFindContractNotices()] == ['400100']
+    # Nichts Neues: 'n:*' liefert trotzdem die letzte Mail, die darf nicht doppelt auftauchen
+    assert [notice.contract_id for notice in updater.mailFindContractNotices()] == ['400100']
+    uid = deliverNotice(environment, '400199')
+    notices = updater.mailFindContractNotices()
+    assert [notice.contract_id for notice in notices] == ['400100', '400199']
+    assert len({notice.uid for notice in notices}) == 2
+    scanState = next(iter(updater.state.mail_scan_state.values()))
+    assert scanState.last_uid == uid
+
+
+def test_scan_state_is_persisted(environment, updater, tmp_path):
+    updater.mailFindContractNotices()
+    uid = deliverNotice(environment, '400199')
+    other = ContractUpdater(updater.configpath, str(tmp_path / 'state.sqlite'))
+    try:
+        assert [notice.contract_id for notice in other.mailFindContractNotices()] == ['400100', '400199']
+        assert next(iter(other.state.mail_scan_state.values())).last_uid == uid
+    finally:
+        other.close()
+
+
+def test_failed_scan_keeps_previous_state(environment, updater, monkeypatch):
+    updater.mailFindContractNotices()
+    before = {folder: scanState.copy(deep=True) for folder, scanState in updater.state.mail_scan_state.items()}
+    deliverNotice(environment, '400198')
+    deliverNotice(environment, '400199')
+    calls = []
+    parse = contractupdater.parseMail
+
+    def parseMail(msg):
+        # Die erste neue Mail wird noch gelesen, dann bricht der Scan ab
+        calls.append(msg.uid)
+        if len(calls) > 1:
+            raise ValueError('kaputt')
+        return parse(msg)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(contractupdater, 'parseMail', parseMail)
+        with pytest.raises(ValueError):
+            updater.mailFindContractNotices()
+    assert updater.state.mail_scan_state == before
+    assert [notice.contract_id for notice in updater.mailFindContractNotices()] == ['400100', '400198', '400199']
+
+
+def test_uidnext_ahead_of_search(environment, updater, monkeypatch):
+    """ STATUS kennt evtl. schon eine Mail, die die Suche in der ausgewaehlten Sitzung noch nicht liefert. """
+    updater.mailFindContractNotices()
+    status = MailBoxFolderManager.status
+
+    def statusAhead(self, *args, **kwargs):
+        result = status(self, *args, **kwargs)
+        if 'UIDNEXT' in result:
+            result['UIDNEXT'] += 1
+        return result
+
+    with monkeypatch.context() as patch:
+        patch.setattr(MailBoxFolderManager, 'status', statusAhead)
+        updater.mailFindContractNotices()
+    deliverNotice(environment, '400199')
+    assert [notice.contract_id for notice in updater.mailFindContractNotices()] == ['400100', '400199']
+
+
+def test_scan_is_shared_between_accounts(environment, tmp_path):
+    configpaths = []
+    for number in range(1, 4):
+        configpath = tmp_path / f'account{number}.json'
+        configpath.write_text(json.dumps(environment.addAccount(number, sharedMailbox=True)), encoding='utf-8')
+        configpaths.append(str(configpath))
+    updaters = [ContractUpdater(configpath, str(tmp_path / 'state.sqlite')) for configpath in configpaths]
+    try:
+        updaters[0].mailFindContractNotices()
+        commandsBefore = environment.imapServer.commandCount
+        for updater in updaters[1:]:
+            assert [notice.contract_id for notice in updater.mailFindContractNotices()] == ['400100', '400200', '400300']
+            # Jeder Account hat seinen eigenen Stand (und eigene Objekte)
+            assert updater.state.mail_scan_state == updaters[0].state.mail_scan_state
+            assert updater.state.mail_scan_state is not updaters[0].state.mail_scan_state
+        assert environment.imapServer.commandCount == commandsBefore
+    finally:
+        for updater in updaters:
+            updater.close()
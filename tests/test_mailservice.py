@@ -0,0 +1,140 @@
+import imaplib
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+from imap_tools.folder import MailBoxFolderManager
+
+import mailservice
+from mailparser import MAIL_TYPE_LOGIN_PIN
+from mailservice import MailService, IMAP_ATTEMPTS, IMAP_ERROR_DELAY_SECONDS, IMAP_ERROR_DELAY_MAX_SECONDS
+from replayserver import ReplayEnvironment, buildMail, FIXTURE_LOGIN_PIN
+
+LOGIN = 'kunde1@example.org'
+
+
+@pytest.fixture
+def environment():
+    environment = ReplayEnvironment()
+    environment.addAccount(1)
+    yield environment
+    environment.close()
+
+
+@pytest.fixture
+def service(environment):
+    service = MailService(server=environment.host, login=LOGIN, password='replay', port=environment.imapServer.server_address[1], ssl=False)
+    yield service
+    service.stopped = True
+    service.wake()
+    service.thread.join(timeout=5)
+
+
+def test_first_fetch_does_not_skip_mail_counted_by_status(environment, service, monkeypatch):
+    """ STATUS UIDNEXT kennt evtl. schon eine Mail, die die Suche noch nicht liefert -> Die naechste PIN-Mail darf nicht verloren gehen. """
+    status = MailBoxFolderManager.status
+
+    def statusAhead(self, *args, **kwargs):
+        result = status(self, *args, **kwargs)
+        if 'UIDNEXT' in result:
+            result['UIDNEXT'] += 1
+        return result
+
+    monkeypatch.setattr(MailBoxFolderManager, 'status', statusAhead)
+
+    def deliverAfterFirstFetch():
+        while service.lastUID is None:
+            time.sleep(0.01)
+        environment.store.getMailbox(LOGIN).append(buildMail('login_pin.eml', {FIXTURE_LOGIN_PIN: '111222'}, datetime.now(tz=timezone.utc)))
+        service.wake()
+
+    threading.Thread(target=deliverAfterFirstFetch, daemon=True).start()
+    assert service.waitForPIN(MAIL_TYPE_LOGIN_PIN, 'Login-PIN', secondsWaitMax=5) == '111222'
+
+
+class FakeIMAPLoop:
+    """ MailService ohne Server: fetchNewMails liefert bzw. wirft nacheinander outcomes, Wartezeiten werden aufgezeichnet statt abgewartet. """
+
+    def __init__(self, monkeypatch, outcomes: list, numberofDelays: int):
+        self.outcomes = iter(outcomes)
+        self.numberofDelays = numberofDelays
+        self.delays = []
+        self.sleeps = []
+        self.done = threading.Event()
+        loop = self
+
+        def waitForActivity(service, secondsPollDelay):
+            if secondsPollDelay is None:
+                # Nichts zu beobachten -> Warten auf wake()
+                threading.Event().wait(0.005)
+                return
+            loop.delays.append(secondsPollDelay)
+            if len(loop.delays) >= loop.numberofDelays:
+                service.stopped = True
+                loop.done.set()
+
+        def fetchNewMails(service):
+            outcome = next(loop.outcomes)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        monkeypatch.setattr(MailService, 'connect', lambda service: None)
+        monkeypatch.setattr(MailService, 'waitForActivity', waitForActivity)
+        monkeypatch.setattr(MailService, 'fetchNewMails', fetchNewMails)
+        monkeypatch.setattr(mailservice, 'getBackoffDelay', lambda attempt: float(attempt))
+        monkeypatch.setattr(mailservice.time, 'sleep', self.sleeps.append)
+        self.service = MailService(server='imap.example', login='postfach@example.org', password='geheim')
+
+    def stop(self):
+        self.service.stopped = True
+        self.service.wake()
+        self.service.thread.join(timeout=5)
+
+
+def test_fatal_errors_back_off_exponentially(monkeypatch):
+    loop = FakeIMAPLoop(monkeypatch, [ValueError('kaputt')] * 9, numberofDelays=9)
+    loop.service.addNoticeListener(lambda mail: None)
+    assert loop.done.wait(5)
+    assert loop.delays == [30, 60, 120, 240, 480, 960, 1920, IMAP_ERROR_DELAY_MAX_SECONDS, IMAP_ERROR_DELAY_MAX_SECONDS]
+    loop.stop()
+
+
+def test_success_resets_error_delay(monkeypatch):
+    loop = FakeIMAPLoop(monkeypatch, [ValueError('kaputt'), ValueError('kaputt'), [], ValueError('kaputt')], numberofDelays=4)
+    loop.service.addNoticeListener(lambda mail: None)
+    assert loop.done.wait(5)
+    assert loop.delays == [IMAP_ERROR_DELAY_SECONDS, IMAP_ERROR_DELAY_SECONDS * 2, loop.service.secondsPollDelayMin, IMAP_ERROR_DELAY_SECONDS]
+    loop.stop()
+
+
+def test_transient_errors_are_retried_before_waiters_fail(monkeypatch):
+    loop = FakeIMAPLoop(monkeypatch, [OSError('Verbindung weg')] * IMAP_ATTEMPTS, numberofDelays=IMAP_ATTEMPTS)
+    with pytest.raises(OSError):
+        loop.service.waitForPIN(MAIL_TYPE_LOGIN_PIN, 'Login-PIN', secondsWaitMax=5)
+    assert loop.done.wait(5)
+    # Backoff nach den ersten Versuchen, erst nach IMAP_ATTEMPTS Fehlern bekommt der Wartende den Fehler
+    assert loop.delays == [0.0, 1.0, 2.0, 3.0, IMAP_ERROR_DELAY_SECONDS]
+    loop.stop()
+
+
+def test_job_retries_transient_errors(monkeypatch):
+    loop = FakeIMAPLoop(monkeypatch, [], numberofDelays=1)
+    calls = []
+
+    def job(mailbox):
+        calls.append(mailbox)
+        if len(calls) < 3:
+            raise imaplib.IMAP4.abort('Verbindung weg')
+        return 'ok'
+
+    assert loop.service.call(job) == 'ok'
+    assert len(calls) == 3
+    # Erste Wiederholung sofort (neue Verbindung), danach mit Backoff
+    assert loop.sleeps == [0.0]
+    calls.clear()
+    with pytest.raises(ValueError):
+        loop.service.call(lambda mailbox: calls.append(mailbox) or int('kaputt'))
+    assert len(calls) == 1
+    loop.stop()
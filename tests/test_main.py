@@ -0,0 +1,28 @@
+import json
+
+from main import printHistory
+from statestore import StateStore, CONTRACT_OUTCOME_EXTENDED
+
+
+def test_print_history(tmp_path, capsys):
+    configpath = tmp_path / 'config.json'
+    configpath.write_text(json.dumps({'euserv_mail_or_user_id': 'kunde'}), encoding='utf-8')
+    statepath = str(tmp_path / 'state.sqlite')
+    statestore = StateStore(statepath)
+    try:
+        statestore.addHistory('kunde', 'login', {'customer_id': '1'})
+        statestore.setContractResult('kunde', '400100', ['<notice@example.org>'], CONTRACT_OUTCOME_EXTENDED, extendedUntil='16.11.2026')
+        statestore.addHistory('andere', 'login', {'customer_id': '2'})
+    finally:
+        statestore.close()
+    printHistory([str(configpath)], statepath, limit=20)
+    output = capsys.readouterr().out
+    assert 'Vertrag 400100: extended' in output and 'bis 16.11.2026' in output
+    assert "login {'customer_id': '1'}" in output
+    assert "'2'" not in output
+
+
+def test_print_history_without_database(tmp_path, capsys):
+    printHistory([], str(tmp_path / 'state.sqlite'), limit=20)
+    assert 'existiert nicht' in capsys.readouterr().out
+    assert not (tmp_path / 'state.sqlite').exists()
@@ -0,0 +1,111 @@
+import json
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from contractupdater import runAccounts
+from precheck import getNoActionReason, getLoginBlockedUntil, MIN_DAYS_UNTIL_NEXT_ATTEMPT, LOGIN_BACKOFF_CAPTCHA_HOURS
+from replayserver import ReplayEnvironment
+from statestore import StateStore, CONTRACT_OUTCOME_FAILED, CONTRACT_OUTCOME_NOT_ON_ACCOUNT
+
+
+@pytest.fixture
+def paths(tmp_path):
+    configpath = tmp_path / 'config.json'
+    configpath.write_text(json.dumps({'euserv_mail_or_user_id': 'kunde'}), encoding='utf-8')
+    return str(configpath), str(tmp_path / 'state.sqlite')
+
+
+def saveState(statepath: str, values: dict):
+    statestore = StateStore(statepath)
+    try:
+        statestore.setMany('kunde', values)
+    finally:
+        statestore.close()
+
+
+def test_login_blocked_without_session(paths):
+    configpath, statepath = paths
+    saveState(statepath, {'last_date_login_attempt_failed_captcha': datetime.now(tz=timezone.utc).isoformat(), 'session': None})
+    reason = getNoActionReason(configpath, statepath)
+    assert reason is not None and reason[0] > datetime.now(tz=timezone.utc)
+
+
+def test_session_allows_run(paths):
+    configpath, statepath = paths
+    saveState(statepath, {'last_date_login_attempt_failed_captcha': datetime.now(tz=timezone.utc).isoformat(),
+                          'session': {'sess_id': 'abc', 'customer_id': '1'}})
+    assert getNoActionReason(configpath, statepath) is None
+
+
+def test_database_is_not_modified(paths):
+    configpath, statepath = paths
+    # Datenbank ohne Tabellen: Die Vorpruefung legt nichts an und ueberlaesst die Entscheidung dem normalen Lauf
+    sqlite3.connect(statepath).close()
+    assert getNoActionReason(configpath, statepath) is None
+    connection = sqlite3.connect(statepath)
+    try:
+        assert connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == []
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    finally:
+        connection.close()
+
+
+def test_no_action_after_extension(tmp_path):
+    """ Der uebliche taegliche Lauf nach einer Verlaengerung endet in der Vorpruefung. """
+    environment = ReplayEnvironment()
+    try:
+        configpath = tmp_path / 'account1.json'
+        configpath.write_text(json.dumps(environment.addAccount(1)), encoding='utf-8')
+        statepath = str(tmp_path / 'state.sqlite')
+        assert getNoActionReason(str(configpath), statepath) is None
+        assert runAccounts([str(configpath)], statepath, testLogins=False, maxWorkers=1) == 0
+        nextAttempt, reason = getNoActionReason(str(configpath), statepath)
+        assert nextAttempt > datetime.now(tz=timezone.utc) + timedelta(days=MIN_DAYS_UNTIL_NEXT_ATTEMPT)
+    finally:
+        environment.close()
+
+
+def test_open_notice_needs_run(paths):
+    configpath, statepath = paths
+    now = datetime.now(tz=timezone.utc)
+    notices = [{'uid': 1, 'contract_id': '400100', 'date': now.isoformat(), 'message_id': '<a@example.org>'},
+               {'uid': 2, 'contract_id': '400200', 'date': now.isoformat(), 'message_id': '<b@example.org>'}]
+    saveState(statepath, {'extended_contracts': {'400100': now.isoformat()},
+                          'mail_scan_state': {'INBOX': {'uidvalidity': 1, 'last_uid': 2, 'notices': notices}}})
+    # 400200 wurde noch nicht bearbeitet
+    assert getNoActionReason(configpath, statepath) is None
+    statestore = StateStore(statepath)
+    try:
+        statestore.setContractResult('kunde', '400200', ['<b@example.org>'], CONTRACT_OUTCOME_FAILED)
+        assert getNoActionReason(configpath, statepath) is None
+        statestore.setContractResult('kunde', '400200', ['<b@example.org>'], CONTRACT_OUTCOME_NOT_ON_ACCOUNT)
+        assert getNoActionReason(configpath, statepath) is not None
+        # Ein laenger zurueckliegend verlaengerter Vertrag kann jederzeit eine neue Mail bekommen
+        statestore.setMany('kunde', {'extended_contracts': {'400100': now.isoformat(), '400300': (now - timedelta(days=30)).isoformat()}})
+        assert getNoActionReason(configpath, statepath) is None
+    finally:
+        statestore.close()
+
+
+@pytest.mark.parametrize('numberofFailures, minutes', [(0, 30), (1, 30), (2, 60), (3, 120), (6, 960), (7, 24 * 60), (20, 24 * 60)])
+def test_failed_login_block_doubles_up_to_maximum(numberofFailures, minutes):
+    lastFailed = datetime.now(tz=timezone.utc) - timedelta(minutes=1)
+    assert getLoginBlockedUntil(lastFailed, None, numberofFailures) == lastFailed + timedelta(minutes=minutes)
+
+
+def test_captcha_login_block():
+    lastFailedCaptcha = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    assert getLoginBlockedUntil(None, lastFailedCaptcha, 0) == lastFailedCaptcha + timedelta(hours=LOGIN_BACKOFF_CAPTCHA_HOURS)
+    # Die laengere Sperre gewinnt
+    lastFailed = datetime.now(tz=timezone.utc)
+    assert getLoginBlockedUntil(lastFailed, lastFailedCaptcha, 1) == lastFailedCaptcha + timedelta(hours=LOGIN_BACKOFF_CAPTCHA_HOURS)
+
+
+def test_expired_login_block():
+    now = datetime.now(tz=timezone.utc)
+    assert getLoginBlockedUntil(None, None, 0) is None
+    assert getLoginBlockedUntil(now - timedelta(minutes=31), None, 1) is None
+    assert getLoginBlockedUntil(now - timedelta(minutes=31), None, 2) is not None
+    assert getLoginBlockedUntil(None, now - timedelta(hours=LOGIN_BACKOFF_CAPTCHA_HOURS, minutes=1), 0) is None
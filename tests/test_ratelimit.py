@@ -0,0 +1,103 @@
+import httpx
+import pytest
+
+import ratelimit
+from euservclient import EuservClient, getRetryAfterSeconds
+from ratelimit import TokenBucket, RequestScheduler, getBackoffDelay, RATE_KIND_HTTP, RATE_MIN_FACTOR, RATE_RECOVERY_FACTOR, \
+    BACKOFF_MAX_SECONDS
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def test_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2.0, burst=2)
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    # Nach einer Sekunde sind zwei Token nachgefuellt, die beiden Wartenden haben sie schon verbraucht
+    clock.now += 1
+    assert bucket.reserve() == 0.5
+
+
+def test_throttle_halves_rate_down_to_minimum(clock):
+    bucket = TokenBucket(rate=10.0, burst=1)
+    bucket.throttle()
+    assert bucket.rate == 5.0
+    for _ in range(20):
+        bucket.throttle()
+    assert bucket.rate == pytest.approx(10.0 * RATE_MIN_FACTOR)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(1 / (10.0 * RATE_MIN_FACTOR))
+
+
+def test_recover_restores_base_rate(clock):
+    bucket = TokenBucket(rate=10.0, burst=1)
+    bucket.throttle()
+    bucket.recover()
+    assert bucket.rate == pytest.approx(5.0 + 10.0 * RATE_RECOVERY_FACTOR)
+    for _ in range(10):
+        bucket.recover()
+    assert bucket.rate == 10.0
+
+
+def test_retry_after_pauses_bucket(clock):
+    bucket = TokenBucket(rate=10.0, burst=5)
+    bucket.throttle(pauseSeconds=30)
+    assert bucket.reserve() == 30.0
+    clock.now += 20
+    assert bucket.reserve() == 10.0
+    clock.now += 10
+    assert bucket.reserve() == 0.0
+    # Eine kuerzere Pause verkuerzt eine laufende nicht
+    bucket.throttle(pauseSeconds=60)
+    bucket.throttle(pauseSeconds=5)
+    assert bucket.reserve() == 60.0
+
+
+def test_scheduler_bucket_per_host_and_kind(clock):
+    scheduler = RequestScheduler({RATE_KIND_HTTP: (1.0, 1)})
+    assert scheduler.reserve('a.example') == 0.0
+    assert scheduler.reserve('b.example') == 0.0
+    assert scheduler.reserve('a.example') == 1.0
+    assert scheduler.getBucket('a.example') is scheduler.getBucket('a.example')
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr(ratelimit.random, 'uniform', lambda low, high: high)
+    assert [getBackoffDelay(attempt) for attempt in range(4)] == [1.0, 2.0, 4.0, 8.0]
+    assert getBackoffDelay(20) == BACKOFF_MAX_SECONDS
+
+
+@pytest.mark.parametrize('headers, expected', [({'Retry-After': '12'}, 12.0), ({'Retry-After': '100000'}, BACKOFF_MAX_SECONDS),
+                                               ({'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'}, None), ({}, None)])
+def test_retry_after_header(headers, expected):
+    assert getRetryAfterSeconds(httpx.Response(429, headers=headers)) == expected
+
+
+def test_throttle_and_recover_on_response(clock, tmp_path, monkeypatch):
+    scheduler = RequestScheduler()
+    monkeypatch.setattr('euservclient.scheduler', scheduler)
+    client = EuservClient(str(tmp_path / 'cookies.txt'), baseURL='http://euserv.example/')
+    try:
+        request = httpx.Request('GET', 'http://euserv.example/index.iphp')
+        bucket = scheduler.getBucket('euserv.example')
+        baseRate = bucket.rate
+        client.onResponse(httpx.Response(503, headers={'Retry-After': '7'}, request=request))
+        assert bucket.rate == baseRate / 2
+        assert bucket.pausedUntil == clock.now + 7
+        client.onResponse(httpx.Response(200, request=request))
+        assert bucket.rate == pytest.approx(baseRate / 2 + baseRate * RATE_RECOVERY_FACTOR)
+    finally:
+        client.close()
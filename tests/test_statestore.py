@@ -0,0 +1,44 @@
+import json
+
+from contractupdater import ContractUpdater, MailScanState
+from replayserver import ReplayEnvironment
+from statestore import StateStore
+
+
+def test_merge_keeps_entries_of_other_writers(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    first = StateStore(path)
+    second = StateStore(path)
+    try:
+        first.setMany('kunde', {'extended_contracts': {'1': 'a', '2': 'b'}})
+        assert second.mergeMany('kunde', {'extended_contracts': {'3': 'c'}}, {'extended_contracts': ['1']}) == \
+            {'extended_contracts': {'2': 'b', '3': 'c'}}
+        assert first.mergeMany('kunde', {'extended_contracts': {'2': 'x'}}) == {'extended_contracts': {'2': 'x', '3': 'c'}}
+        assert second.get('kunde', 'extended_contracts') == {'2': 'x', '3': 'c'}
+    finally:
+        first.close()
+        second.close()
+
+
+def test_overlapping_runs_do_not_drop_entries(tmp_path):
+    """ Zwei Laeufe (z.B. Cronjob und Daemon) mit demselben, vorher geladenen Status schreiben nacheinander. """
+    environment = ReplayEnvironment()
+    configpath = tmp_path / 'account1.json'
+    configpath.write_text(json.dumps(environment.addAccount(1)), encoding='utf-8')
+    statepath = str(tmp_path / 'state.sqlite')
+    updaters = [ContractUpdater(str(configpath), statepath), ContractUpdater(str(configpath), statepath)]
+    try:
+        updaters[0].onContractExtended('400100', '16.11.2026')
+        updaters[1].onContractExtended('400101', '17.11.2026')
+        updaters[0].mergeState('mail_scan_state', {'INBOX': MailScanState(uidvalidity=1, last_uid=5)})
+        updaters[1].mergeState('mail_scan_state', {'Archiv': MailScanState(uidvalidity=2, last_uid=7)})
+        updaters.append(ContractUpdater(str(configpath), statepath))
+        state = updaters[2].state
+        assert set(state.extended_contracts) == {'400100', '400101'}
+        assert set(state.mail_scan_state) == {'INBOX', 'Archiv'}
+        # Der zweite Lauf kennt danach auch den Eintrag des ersten
+        assert set(updaters[1].state.extended_contracts) == {'400100', '400101'}
+    finally:
+        for updater in updaters:
+            updater.close()
+        environment.close()